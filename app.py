@@ -1,39 +1,88 @@
 import glob
 import zipfile
-from flask import Flask, g, request, redirect, render_template, send_file, abort, session, url_for, make_response
+from flask import (Flask, g, request, redirect, render_template, send_file, abort, session, url_for,
+                   make_response, jsonify, stream_with_context)
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
-from flask_session import Session
-from urllib.parse import urlparse
 import logging
 import shutil
+import sqlite3
 import os
 import tempfile
 import subprocess
-import uuid
-import base64
+import io
+import itertools
+import json
 from datetime import datetime
+import uuid
+import click
+import hmac
+import time
 
-from auth import requires_auth, init_saml_auth, prepare_flask_request
-from database import init_db, get_db, close_db, record_click, get_link_stats, get_weekly_click_data
+from auth import current_user, requires_auth, requires_api_token, init_saml_auth, prepare_flask_request
+from database import (init_db, get_db, get_read_db, close_db, record_click, get_link_stats,
+                      resolve_link, resolve_links, commit_link_changes, get_link_cache,
+                      backfill_rollups, build_search_match, rebuild_search_index,
+                      fetch_keyset_page, cached_count, begin_write, migrate_legacy_uploads,
+                      forget_link_clicks, backfill_visitor_sketches, purge_expired_links,
+                      build_link_snapshot)
 from config import Config
+from file_delivery import send_upload
+import link_access
+from link_access import check_access, normalize_expiry, hash_link_password
+from blob_store import stage_upload, commit_blob, discard_staged
+from metrics import get_metrics, collect as collect_metrics
+from url_utils import is_valid_url, normalize_url
+import bulk
+from click_retention import run_retention
+from session_store import init_sessions, purge_expired_sessions
+import click_stats
+import cluster
+import resumable_upload
+from code_allocator import get_code_allocator
+from redirect_cache import counted_by_beacon, parse_redirect_status, redirect_response
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Paths taken by the app's own routes rather than short links
+RESERVED_SHORT_LINKS = ('admin', 'metrics', 'api')
+
 app = Flask(__name__)
 app.config.from_object(Config)
-Session(app)
+init_sessions(app, get_db, get_read_db)
+if app.config['TRUSTED_PROXIES']:
+    # request.remote_addr becomes the visitor's address from X-Forwarded-For
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
 
 # Make sure this directory exists or is configured properly
 # e.g. app.config['UPLOAD_FOLDER'] = '/path/to/uploads'
-if not hasattr(app.config, 'UPLOAD_FOLDER'):
-    app.config['UPLOAD_FOLDER'] = os.path.join(os.getcwd(), 'uploads')
+# Stored file paths are absolute, as send_file resolves relative ones
+# against the app's root rather than the working directory
+app.config['UPLOAD_FOLDER'] = os.path.abspath(app.config.get('UPLOAD_FOLDER') or 'uploads')
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
 # Initialize database
+if app.config['INIT_DB_ON_STARTUP']:
+    with app.app_context():
+        init_db()
+
+def _warn_shadowed_links():
+    """Links named before their name was reserved can't be reached any more."""
+    placeholders = ', '.join('?' * len(RESERVED_SHORT_LINKS))
+    try:
+        rows = get_read_db().execute(
+            f'SELECT short_link FROM links WHERE short_link IN ({placeholders})',
+            RESERVED_SHORT_LINKS).fetchall()
+    except sqlite3.OperationalError:
+        return  # No schema yet
+    for row in rows:
+        logger.warning(f'Link "{row["short_link"]}" is shadowed by a built-in route of the same '
+                       f'name and can no longer be opened; rename it from the admin page')
+
 with app.app_context():
-    init_db()
+    _warn_shadowed_links()
 
 def _http_auth_required():
     """Helper function to return a 401 with WWW-Authenticate header."""
@@ -41,17 +90,6 @@ def _http_auth_required():
     response.headers["WWW-Authenticate"] = 'Basic realm="URLShortener"'
     return response
 
-def is_valid_url(url):
-    """Minimal check to ensure URL is http or https, and has a netloc."""
-    parsed = urlparse(url)
-    return parsed.scheme in ['http', 'https'] and parsed.netloc
-
-def normalize_url(url):
-    """If the URL doesn’t start with http:// or https://, prepend https://."""
-    if url and not (url.startswith('http://') or url.startswith('https://')):
-        return 'https://' + url
-    return url
-
 @app.route('/download-repo')
 @requires_auth
 def download_repo():
@@ -164,107 +202,101 @@ def logout():
     else:
         return redirect(auth.logout())
 
-@app.route('/admin')
-@requires_auth
-def admin():
-    page = request.args.get("page", 1, type=int)
-    per_page = 50
-    offset = (page - 1) * per_page
-    
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Get total count
-    c.execute("SELECT COUNT(*) as count FROM links")
-    total_links = c.fetchone()["count"]
-    total_pages = (total_links + per_page - 1) // per_page
-    
-    # Get paginated links (including basic info like unique visitors, etc.)
-    c.execute("""
-        SELECT l.*, 
-               COUNT(DISTINCT c.ip_address) as unique_visitors,
-               COUNT(c.id) as total_clicks
-        FROM links l
-        LEFT JOIN clicks c ON l.short_link = c.short_link
-        GROUP BY l.short_link
-        ORDER BY l.created_at DESC
-        LIMIT ? OFFSET ?
-    """, (per_page, offset))
-    
-    links = c.fetchall()
-    return render_template("admin.html", 
-                           links=links,
-                           user=session.get("user"),
-                           page=page,
-                           total_pages=total_pages,
-                           total_links=total_links)
+LINK_LISTING_QUERY = """
+    SELECT l.*, 
+           COALESCE(t.unique_visitors, 0) as unique_visitors,
+           COALESCE(t.total_clicks, 0) as total_clicks
+    FROM links l
+    LEFT JOIN link_click_totals t ON l.short_link = t.short_link
+"""
 
-@app.route('/admin/search')
-@requires_auth
-def search_links():
-    search_term = request.args.get("q", "").strip()
+def _list_links(search_term=""):
+    """
+    Fetch one page of the admin link listing, optionally filtered by a
+    search term. Pages are addressed by cursor (see fetch_keyset_page);
+    `page` is only carried along so the template can show a page number.
+    """
+    cursor = request.args.get("cursor") or None
+    before = request.args.get("direction") == "prev"
     page = request.args.get("page", 1, type=int)
     per_page = 50
-    offset = (page - 1) * per_page
-    
-    logger.info(f"Searching for: {search_term} (page {page})")
     
-    conn = get_db()
-    c = conn.cursor()
+    conn = get_read_db()
+    match_query = build_search_match(search_term)
     
-    if search_term:
+    if match_query:
+        # Search the full-text index, best matches first
+        total_links = cached_count(conn, """
+            SELECT COUNT(*) FROM links_fts WHERE links_fts MATCH ?
+        """, (match_query,))
+        query = """
+            SELECT l.*, 
+                   COALESCE(t.unique_visitors, 0) as unique_visitors,
+                   COALESCE(t.total_clicks, 0) as total_clicks,
+                   bm25(links_fts, 10.0, 2.0, 2.0, 1.0) as score
+            FROM links_fts f
+            JOIN links l ON l.rowid = f.rowid
+            LEFT JOIN link_click_totals t ON l.short_link = t.short_link
+            WHERE links_fts MATCH ?
+        """
+        params = (match_query,)
+        keys, descending = ("score", "short_link"), False
+    elif search_term:
+        # Terms shorter than a trigram can't use the index
         search_pattern = f"%{search_term}%"
-        # Get total count for search
-        c.execute("""
-            SELECT COUNT(*) as count 
+        params = (search_pattern, search_pattern, search_pattern, search_pattern)
+        total_links = cached_count(conn, """
+            SELECT COUNT(*)
             FROM links 
             WHERE short_link LIKE ? 
                OR target_url LIKE ? 
                OR filename LIKE ?
                OR description LIKE ?
-        """, (search_pattern, search_pattern, search_pattern, search_pattern))
-        total_links = c.fetchone()["count"]
-        
-        # Get paginated search results
-        c.execute("""
-            SELECT l.*, 
-                   COUNT(DISTINCT c.ip_address) as unique_visitors,
-                   COUNT(c.id) as total_clicks
-            FROM links l
-            LEFT JOIN clicks c ON l.short_link = c.short_link
+        """, params)
+        query = LINK_LISTING_QUERY + """
             WHERE l.short_link LIKE ? 
                OR l.target_url LIKE ? 
                OR l.filename LIKE ?
                OR l.description LIKE ?
-            GROUP BY l.short_link
-            ORDER BY l.created_at DESC
-            LIMIT ? OFFSET ?
-        """, (search_pattern, search_pattern, search_pattern, search_pattern, per_page, offset))
+        """
+        keys, descending = ("created_at", "short_link"), True
     else:
-        # Get total count
-        c.execute("SELECT COUNT(*) as count FROM links")
-        total_links = c.fetchone()["count"]
-        
-        # Get paginated results
-        c.execute("""
-            SELECT l.*, 
-                   COUNT(DISTINCT c.ip_address) as unique_visitors,
-                   COUNT(c.id) as total_clicks
-            FROM links l
-            LEFT JOIN clicks c ON l.short_link = c.short_link
-            GROUP BY l.short_link
-            ORDER BY l.created_at DESC
-            LIMIT ? OFFSET ?
-        """, (per_page, offset))
-    
-    total_pages = (total_links + per_page - 1) // per_page
-    links = c.fetchall()
-    logger.info(f"Found {total_links} results, showing page {page} of {total_pages}")
-    return render_template("_links_table.html",
-                           links=links,
-                           page=page,
-                           total_pages=total_pages,
-                           total_links=total_links)
+        total_links = cached_count(conn, "SELECT COUNT(*) FROM links")
+        query, params = LINK_LISTING_QUERY, ()
+        keys, descending = ("created_at", "short_link"), True
+    
+    try:
+        links, next_cursor, prev_cursor = fetch_keyset_page(
+            conn, query, params, keys,
+            cursor=cursor, before=before, descending=descending, per_page=per_page
+        )
+    except ValueError:
+        abort(400)
+    
+    return {
+        "links": links,
+        "page": page,
+        "total_pages": (total_links + per_page - 1) // per_page,
+        "total_links": total_links,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+    }
+
+@app.route('/admin')
+@requires_auth
+def admin():
+    listing = _list_links()
+    return render_template("admin.html", user=current_user(), **listing)
+
+@app.route('/admin/search')
+@requires_auth
+def search_links():
+    search_term = request.args.get("q", "").strip()
+    logger.info(f"Searching for: {search_term}")
+    
+    listing = _list_links(search_term)
+    logger.info(f"Found {listing['total_links']} results, showing page {listing['page']} of {listing['total_pages']}")
+    return render_template("_links_table.html", **listing)
 
 @app.route('/admin/create', methods=['POST'])
 @requires_auth
@@ -277,6 +309,10 @@ def create_link():
     short_link = request.form['short_link'].strip()
     target_url = request.form['target_url'].strip()
     description = request.form.get('description', '').strip()
+    # Left blank: generate a code that no link uses yet
+    generated = not short_link
+    if generated:
+        short_link = get_code_allocator().allocate()[0]
     
     # Optional fields
     expires_at = request.form.get('expires_at', '').strip()
@@ -285,8 +321,8 @@ def create_link():
     basic_auth_pass = request.form.get('basic_auth_pass', '').strip()
     
     # Validate short_link
-    if short_link == 'admin':
-        return 'Cannot use reserved word "admin"', 400
+    if short_link in RESERVED_SHORT_LINKS:
+        return f'Cannot use reserved word "{short_link}"', 400
     
     # Normalize URL first (prepend https:// if needed)
     if target_url:
@@ -295,6 +331,11 @@ def create_link():
         if not is_valid_url(target_url):
             return "Invalid URL", 400
     
+    try:
+        redirect_status = parse_redirect_status(request.form.get('redirect_status'))
+    except ValueError as e:
+        return str(e), 400
+    
     # If user checked the "require_guid" box, generate a GUID
     guid_required = None
     if require_guid == 'on':
@@ -303,30 +344,44 @@ def create_link():
     # If expires_at is empty, store NULL
     if not expires_at:
         expires_at = None
+    else:
+        try:
+            expires_at = normalize_expiry(expires_at)
+        except ValueError:
+            return "Invalid expiry date", 400
     
     # If basic_auth_user or pass is empty, store NULL
     if not basic_auth_user:
         basic_auth_user = None
     if not basic_auth_pass:
         basic_auth_pass = None
+    basic_auth_pass = hash_link_password(basic_auth_pass)
     
     conn = get_db()
     c = conn.cursor()
-    c.execute('''
-        INSERT OR REPLACE INTO links 
-        (short_link, target_url, is_file, created_by, description, expires_at, guid_required, basic_auth_user, basic_auth_pass) 
-        VALUES (?, ?, 0, ?, ?, ?, ?, ?, ?)
-    ''', (
-        short_link,
-        target_url,
-        session['user'].get('preferred_username'),
-        description,
-        expires_at,
-        guid_required,
-        basic_auth_user,
-        basic_auth_pass
-    ))
-    conn.commit()
+    while True:
+        c.execute(f'''
+            {'INSERT OR IGNORE' if generated else 'INSERT OR REPLACE'} INTO links 
+            (short_link, target_url, is_file, created_by, description, expires_at, guid_required, basic_auth_user, basic_auth_pass, redirect_status) 
+            VALUES (?, ?, 0, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            short_link,
+            target_url,
+            current_user().get('preferred_username'),
+            description,
+            expires_at,
+            guid_required,
+            basic_auth_user,
+            basic_auth_pass,
+            redirect_status
+        ))
+        if c.rowcount:
+            break
+        # A generated code that someone picked by hand; release the write
+        # lock before reserving another
+        conn.rollback()
+        short_link = get_code_allocator().allocate()[0]
+    commit_link_changes(conn)
     return redirect('/admin')
 
 @app.route('/admin/upload', methods=['POST'])
@@ -349,8 +404,10 @@ def upload_file():
     basic_auth_pass = request.form.get('basic_auth_pass', '').strip()
     
     # Validate short_link
-    if short_link == 'admin':
-        return 'Cannot use reserved word "admin"', 400
+    if not short_link:
+        return 'Missing short link', 400
+    if short_link in RESERVED_SHORT_LINKS:
+        return f'Cannot use reserved word "{short_link}"', 400
     
     if file.filename == '':
         return 'No selected file', 400
@@ -358,10 +415,6 @@ def upload_file():
     # Secure the filename
     filename = secure_filename(file.filename)
     
-    # Save the file. Example path: "uploads/<short_link>_<actualfilename>"
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], short_link + '_' + filename)
-    file.save(file_path)
-    
     # Possibly generate GUID
     guid_required = None
     if require_guid == 'on':
@@ -370,35 +423,169 @@ def upload_file():
     # If expires_at is empty, store None/NULL
     if not expires_at:
         expires_at = None
+    else:
+        try:
+            expires_at = normalize_expiry(expires_at)
+        except ValueError:
+            return "Invalid expiry date", 400
     
     # If either basic_auth_user or pass is empty, store None/NULL
     if not basic_auth_user:
         basic_auth_user = None
     if not basic_auth_pass:
         basic_auth_pass = None
+    basic_auth_pass = hash_link_password(basic_auth_pass)
+    
+    # Only once every field is valid, hash the upload while streaming it
+    # into the blob store's staging area; identical content is stored
+    # once, as "uploads/blobs/<xx>/<sha256>"
+    upload_folder = app.config['UPLOAD_FOLDER']
+    staged_path, digest, size = stage_upload(file.stream, upload_folder)
     
     conn = get_db()
     c = conn.cursor()
-    c.execute('''
-        INSERT OR REPLACE INTO links
-        (short_link, target_url, is_file, filename, created_by, description,
-         expires_at, guid_required, basic_auth_user, basic_auth_pass)
-        VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        short_link,
-        file_path,  # The local path goes into target_url
-        filename,   # The original uploaded filename
-        session['user'].get('preferred_username'),
-        description,
-        expires_at,
-        guid_required,
-        basic_auth_user,
-        basic_auth_pass
-    ))
-    conn.commit()
+    try:
+        begin_write(conn)
+        file_path = commit_blob(conn, staged_path, digest, size, upload_folder)
+        c.execute('''
+            INSERT OR REPLACE INTO links
+            (short_link, target_url, is_file, filename, blob_digest, created_by, description,
+             expires_at, guid_required, basic_auth_user, basic_auth_pass)
+            VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            short_link,
+            file_path,  # The blob's local path goes into target_url
+            filename,   # The original uploaded filename
+            digest,
+            current_user().get('preferred_username'),
+            description,
+            expires_at,
+            guid_required,
+            basic_auth_user,
+            basic_auth_pass
+        ))
+        commit_link_changes(conn)
+    finally:
+        discard_staged(staged_path)
     
     return redirect('/admin')
 
+def _upload_status(upload, ranges):
+    offset = resumable_upload.upload_offset(ranges)
+    response = jsonify(id=upload['id'], length=upload['length'], offset=offset,
+                       missing=resumable_upload.missing_ranges(ranges, upload['length']),
+                       url=url_for('upload_status', upload_id=upload['id']))
+    response.headers['Upload-Offset'] = str(offset)
+    response.headers['Upload-Length'] = str(upload['length'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/admin/api/uploads', methods=['POST'])
+@requires_auth
+def create_upload():
+    """
+    Start a resumable upload. Takes a JSON object with `length` (bytes),
+    the link fields of /admin/upload plus `filename`, and optionally
+    `checksum` (hex SHA-256 of the whole file).
+    """
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict):
+        return jsonify(error='Expected a JSON object'), 400
+    length = values.get('length')
+    if not isinstance(length, int) or not 0 <= length <= app.config['MAX_CONTENT_LENGTH']:
+        return jsonify(error=f"length must be between 0 and {app.config['MAX_CONTENT_LENGTH']}"), 400
+    try:
+        checksum = resumable_upload.parse_file_checksum(values.get('checksum'))
+        link = resumable_upload.validate_link_fields(values, RESERVED_SHORT_LINKS)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    db = get_db()
+    upload_folder = app.config['UPLOAD_FOLDER']
+    resumable_upload.purge_expired_uploads(db, upload_folder)
+    upload_id = resumable_upload.create_upload(
+        db, upload_folder, length, link, current_user().get('preferred_username'),
+        checksum, app.config['UPLOAD_SESSION_TTL'])
+    response = _upload_status(resumable_upload.get_upload(db, upload_id), [])
+    response.status_code = 201
+    response.headers['Location'] = response.json['url']
+    return response
+
+@app.route('/admin/api/uploads/<upload_id>', methods=['GET'])
+@requires_auth
+def upload_status(upload_id):
+    """Bytes received so far and the ranges still missing (HEAD for headers only)."""
+    db = get_db()
+    upload = resumable_upload.get_upload(db, upload_id)
+    if upload is None:
+        abort(404)
+    return _upload_status(upload, resumable_upload.received_ranges(db, upload_id))
+
+@app.route('/admin/api/uploads/<upload_id>', methods=['PATCH'])
+@requires_auth
+def upload_chunk(upload_id):
+    """
+    Write the request body at the byte offset in the Upload-Offset header.
+    Chunks may arrive in any order and in parallel; an optional
+    "Upload-Checksum: sha256 <base64>" header is checked before the chunk
+    counts as received.
+    """
+    db = get_db()
+    upload = resumable_upload.get_upload(db, upload_id)
+    if upload is None:
+        abort(404)
+    offset = request.headers.get('Upload-Offset', '')
+    if not offset.isdigit():
+        return jsonify(error='Missing or invalid Upload-Offset header'), 400
+    if request.content_length is None:
+        return jsonify(error='Missing Content-Length header'), 411
+    try:
+        checksum = resumable_upload.parse_chunk_checksum(request.headers.get('Upload-Checksum'))
+        ranges = resumable_upload.write_chunk(db, upload, int(offset), request.stream,
+                                              request.content_length, app.config['UPLOAD_FOLDER'],
+                                              checksum)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except FileNotFoundError:
+        return jsonify(error='Upload was finalized, deleted or expired'), 404
+    response = _upload_status(upload, ranges)
+    response.status_code = 200
+    return response
+
+@app.route('/admin/api/uploads/<upload_id>', methods=['DELETE'])
+@requires_auth
+def delete_upload(upload_id):
+    """Abandon an upload and delete what was received."""
+    db = get_db()
+    if resumable_upload.get_upload(db, upload_id) is None:
+        abort(404)
+    resumable_upload.delete_upload(db, upload_id, app.config['UPLOAD_FOLDER'])
+    return '', 204
+
+@app.route('/admin/api/uploads/<upload_id>/finalize', methods=['POST'])
+@requires_auth
+def finalize_upload(upload_id):
+    """
+    Verify the complete file against its checksum (from creation or a JSON
+    body's `checksum`) and create the link.
+    """
+    db = get_db()
+    upload = resumable_upload.get_upload(db, upload_id)
+    if upload is None:
+        abort(404)
+    values = request.get_json(silent=True)
+    try:
+        checksum = resumable_upload.parse_file_checksum(
+            values.get('checksum') if isinstance(values, dict) else None)
+        short_link = resumable_upload.finalize_upload(db, upload, app.config['UPLOAD_FOLDER'], checksum)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except FileNotFoundError:
+        # Another request finalized or deleted it first
+        return jsonify(error='Upload was already finalized or deleted'), 409
+    return jsonify(short_link=short_link, url=url_for('redirect_link', short_link=short_link,
+                                                      _external=True)), 201
+
 
 @app.route('/admin/edit/<short_link>', methods=['GET', 'POST'])
 @requires_auth
@@ -434,8 +621,8 @@ def edit_link(short_link):
         basic_auth_pass = request.form.get('basic_auth_pass', '').strip()
         
         # Validate
-        if new_short_link == "admin":
-            return "Cannot use reserved word \"admin\"", 400
+        if new_short_link in RESERVED_SHORT_LINKS:
+            return f"Cannot use reserved word \"{new_short_link}\"", 400
         
         # If user wants a GUID
         guid_required = None
@@ -445,27 +632,42 @@ def edit_link(short_link):
         # If expires_at is empty, store NULL
         if not expires_at:
             expires_at = None
+        else:
+            try:
+                expires_at = normalize_expiry(expires_at)
+            except ValueError:
+                return "Invalid expiry date", 400
         
-        # If either basic_auth_user or pass is empty, store NULL
+        # Passwords are stored hashed, so the form can't show the current
+        # one; leaving it blank keeps it. Clearing the username removes auth.
         if not basic_auth_user:
             basic_auth_user = None
-        if not basic_auth_pass:
             basic_auth_pass = None
+        elif not basic_auth_pass:
+            basic_auth_pass = current_link["basic_auth_pass"]
+        basic_auth_pass = hash_link_password(basic_auth_pass)
+        
+        # File replaced by this edit that no other link uses, removed once
+        # the edit is committed
+        replaced_file = None
         
         # If it's a file-based link
         if current_link["is_file"]:
             file = request.files.get("file")
             if file and file.filename:
                 # (A) User uploaded a new file
-                try:
-                    # Delete the old file if it exists
-                    os.remove(current_link["target_url"])
-                except OSError:
-                    pass
+                if current_link["blob_digest"] is None:
+                    # Files from before the blob store belong to one link only
+                    replaced_file = current_link["target_url"]
                 
                 filename = secure_filename(file.filename)
-                file_path = os.path.join(app.config["UPLOAD_FOLDER"], new_short_link + "_" + filename)
-                file.save(file_path)
+                upload_folder = app.config["UPLOAD_FOLDER"]
+                staged_path, digest, size = stage_upload(file.stream, upload_folder)
+                try:
+                    begin_write(conn)
+                    file_path = commit_blob(conn, staged_path, digest, size, upload_folder)
+                finally:
+                    discard_staged(staged_path)
                 
                 if short_link == new_short_link:
                     # Update same row
@@ -473,6 +675,7 @@ def edit_link(short_link):
                         UPDATE links
                         SET target_url = ?,
                             filename = ?,
+                            blob_digest = ?,
                             description = ?,
                             expires_at = ?,
                             guid_required = ?,
@@ -482,6 +685,7 @@ def edit_link(short_link):
                     """, (
                         file_path,
                         filename,
+                        digest,
                         description,
                         expires_at,
                         guid_required,
@@ -493,14 +697,15 @@ def edit_link(short_link):
                     # If short_link changed, create new row and delete old
                     c.execute("""
                         INSERT OR REPLACE INTO links
-                        (short_link, target_url, is_file, filename, created_by, description,
+                        (short_link, target_url, is_file, filename, blob_digest, created_by, description,
                          expires_at, guid_required, basic_auth_user, basic_auth_pass)
-                        VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?)
+                        VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?)
                     """, (
                         new_short_link,
                         file_path,
                         filename,
-                        session["user"].get("preferred_username"),
+                        digest,
+                        current_user().get("preferred_username"),
                         description,
                         expires_at,
                         guid_required,
@@ -508,6 +713,7 @@ def edit_link(short_link):
                         basic_auth_pass
                     ))
                     c.execute("DELETE FROM links WHERE short_link = ?", (short_link,))
+                    forget_link_clicks(conn, short_link)
             
             else:
                 # (B) No new file uploaded; keep current file path & filename
@@ -533,14 +739,15 @@ def edit_link(short_link):
                     # Short link changed, so re‐insert with same file, remove old
                     c.execute("""
                         INSERT OR REPLACE INTO links
-                        (short_link, target_url, is_file, filename, created_by, description,
+                        (short_link, target_url, is_file, filename, blob_digest, created_by, description,
                          expires_at, guid_required, basic_auth_user, basic_auth_pass)
-                        VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?)
+                        VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?)
                     """, (
                         new_short_link,
                         current_link["target_url"],
                         current_link["filename"],
-                        session["user"].get("preferred_username"),
+                        current_link["blob_digest"],
+                        current_user().get("preferred_username"),
                         description,
                         expires_at,
                         guid_required,
@@ -548,6 +755,7 @@ def edit_link(short_link):
                         basic_auth_pass
                     ))
                     c.execute("DELETE FROM links WHERE short_link = ?", (short_link,))
+                    forget_link_clicks(conn, short_link)
         
         else:
             # It's not a file link; it's a URL link
@@ -556,6 +764,10 @@ def edit_link(short_link):
                 target_url = normalize_url(target_url)
                 if not is_valid_url(target_url):
                     return "Invalid URL", 400
+            try:
+                redirect_status = parse_redirect_status(request.form.get('redirect_status'))
+            except ValueError as e:
+                return str(e), 400
             
             if short_link == new_short_link:
                 # Update same row
@@ -566,7 +778,8 @@ def edit_link(short_link):
                         expires_at = ?,
                         guid_required = ?,
                         basic_auth_user = ?,
-                        basic_auth_pass = ?
+                        basic_auth_pass = ?,
+                        redirect_status = ?
                     WHERE short_link = ?
                 """, (
                     target_url,
@@ -575,6 +788,7 @@ def edit_link(short_link):
                     guid_required,
                     basic_auth_user,
                     basic_auth_pass,
+                    redirect_status,
                     short_link
                 ))
             else:
@@ -582,102 +796,331 @@ def edit_link(short_link):
                 c.execute("""
                     INSERT OR REPLACE INTO links
                     (short_link, target_url, is_file, created_by, description,
-                     expires_at, guid_required, basic_auth_user, basic_auth_pass)
-                    VALUES (?, ?, 0, ?, ?, ?, ?, ?, ?)
+                     expires_at, guid_required, basic_auth_user, basic_auth_pass, redirect_status)
+                    VALUES (?, ?, 0, ?, ?, ?, ?, ?, ?, ?)
                 """, (
                     new_short_link,
                     target_url,
-                    session["user"].get("preferred_username"),
+                    current_user().get("preferred_username"),
                     description,
                     expires_at,
                     guid_required,
                     basic_auth_user,
-                    basic_auth_pass
+                    basic_auth_pass,
+                    redirect_status
                 ))
                 c.execute("DELETE FROM links WHERE short_link = ?", (short_link,))
+                forget_link_clicks(conn, short_link)
         
-        conn.commit()
+        commit_link_changes(conn)
+        if replaced_file is not None:
+            try:
+                os.remove(replaced_file)
+            except OSError:
+                pass
         return redirect("/admin")
 
+@app.route('/admin/import', methods=['POST'])
+@requires_auth
+def import_links():
+    """
+    Bulk-create URL links from CSV or JSON lines, sent either as the `file`
+    form field or as the raw request body. Returns a JSON report with the
+    rows that were rejected and why.
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        stream, filename, content_type = upload.stream, upload.filename, upload.content_type
+    else:
+        stream, filename, content_type = request.stream, None, request.content_type
+    fmt = request.values.get('format') or bulk.guess_format(filename, content_type)
+    on_conflict = request.values.get('on_conflict', 'replace')
+    if fmt not in bulk.FORMATS or on_conflict not in bulk.CONFLICT_POLICIES:
+        return 'Invalid format or on_conflict', 400
+
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    report = bulk.import_links(
+        get_db(),
+        bulk.iter_records(text, fmt),
+        created_by=current_user().get('preferred_username'),
+        on_conflict=on_conflict,
+        batch_size=app.config['BULK_IMPORT_BATCH_SIZE'],
+        reserved=RESERVED_SHORT_LINKS
+    )
+    return jsonify(report)
+
+@app.route('/admin/export')
+@requires_auth
+def export_links():
+    """Stream every link as CSV (default) or JSON lines."""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in bulk.FORMATS:
+        abort(400)
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = app.response_class(
+        stream_with_context(bulk.export_links(get_read_db(), fmt)), mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', filename=f'links.{fmt}')
+    return response
+
 @app.route('/admin/stats/<short_link>')
 @requires_auth
 def link_stats(short_link):
-    stats = get_link_stats(short_link)
-    
-    # Add weekly click data (past 26 weeks)
-    weekly_clicks = get_weekly_click_data(short_link, num_weeks=26)
-    stats['weekly_clicks'] = weekly_clicks
-    
-    return render_template('stats.html', short_link=short_link, stats=stats)
+    unique_mode = request.args.get('uniques') or None
+    start = request.args.get('from') or None
+    end = request.args.get('to') or None
+    if unique_mode not in (None, 'exact', 'approx'):
+        abort(400)
+    for day in (start, end):
+        if day is not None:
+            try:
+                datetime.strptime(day, '%Y-%m-%d')
+            except ValueError:
+                abort(400)
+    stats = get_link_stats(short_link, unique_mode, start, end)
+    # The chart and breakdowns are fetched from the stats API by the page
+    return render_template('stats.html', short_link=short_link, stats=stats,
+                           date_from=start or '', date_to=end or '')
+
+def _stats_range(granularity='day'):
+    return click_stats.parse_range(request.args.get('from'), request.args.get('to'), granularity)
+
+def _stats_limit():
+    limit = request.args.get('limit', '10')
+    if not limit.isdigit() or not 1 <= int(limit) <= 1000:
+        raise ValueError('limit must be between 1 and 1000')
+    return int(limit)
+
+@app.route('/admin/api/stats/<short_link>/series')
+@requires_auth
+def stats_series(short_link):
+    """Clicks per hour, day, week or month; see click_stats.click_series()."""
+    granularity = request.args.get('granularity', 'day')
+    try:
+        start, end = _stats_range(granularity)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    points = click_stats.click_series(get_read_db(), short_link, granularity, start, end)
+    return jsonify(short_link=short_link, granularity=granularity,
+                   **{'from': start.isoformat(), 'to': end.isoformat()}, points=points)
+
+@app.route('/admin/api/stats/<short_link>/breakdown/<by>')
+@requires_auth
+def stats_breakdown(short_link, by):
+    """Clicks by referer host or browser family over a date range."""
+    if by not in click_stats.BREAKDOWNS:
+        abort(404)
+    try:
+        start, end = _stats_range()
+        limit = _stats_limit()
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    breakdown = click_stats.click_breakdown(get_read_db(), short_link, by, start, end, limit)
+    return jsonify(short_link=short_link, by=by,
+                   **{'from': start.isoformat(), 'to': end.isoformat()}, **breakdown)
+
+@app.route('/admin/api/stats/top')
+@requires_auth
+def stats_top_links():
+    """Most-clicked links, over all time or between ?from= and ?to=."""
+    try:
+        limit = _stats_limit()
+        start = end = None
+        if request.args.get('from') or request.args.get('to'):
+            start, end = _stats_range('month')
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(links=click_stats.top_links(get_read_db(), start, end, limit))
+
+@app.route('/admin/cache-stats')
+@requires_auth
+def cache_stats():
+    """Link cache counters for the worker that served this request."""
+    return jsonify(pid=os.getpid(), link_cache=get_link_cache().stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Prometheus metrics merged from every worker's latest snapshot. Only
+    served with a METRICS_TOKEN configured and presented.
+    """
+    token = app.config['METRICS_TOKEN']
+    if not token or not app.config['METRICS_ENABLED']:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+    # Include this worker's latest numbers rather than its last snapshot
+    get_metrics().flush()
+    response = make_response(collect_metrics(app.config['METRICS_DIR']))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+@app.route('/api/links', methods=['POST'])
+@requires_api_token
+def api_create_links():
+    """
+    Create links from {"links": [{"target_url": ..., ...}, ...]}, with the
+    fields of the bulk import. Links without a short_link get a generated
+    code; existing links are never replaced. Replies with one result per
+    link, in order: its short_link and url, or an error.
+    """
+    values = request.get_json(silent=True)
+    records = values.get('links') if isinstance(values, dict) else None
+    if not isinstance(records, list) or not all(isinstance(record, dict) for record in records):
+        return jsonify(error='Expected {"links": [...]} with a list of objects'), 400
+    limit = app.config['API_CREATE_MAX_LINKS']
+    if len(records) > limit:
+        return jsonify(error=f'At most {limit} links per request'), 400
+    results = bulk.create_links(get_db(), records, get_code_allocator().allocate,
+                                created_by=g.api_client, reserved=RESERVED_SHORT_LINKS)
+    for result in results:
+        if 'error' not in result:
+            result['url'] = url_for('redirect_link', short_link=result['short_link'], _external=True)
+    created = sum('error' not in result for result in results)
+    return jsonify(links=results, created=created, failed=len(results) - created)
+
+# Links looked up per query when streaming /api/resolve
+RESOLVE_CHUNK_SIZE = 500
+
+def _resolved_link(short_link, link, now):
+    """What /api/resolve reports about one link; never secrets or file paths."""
+    if link is None:
+        return {'short_link': short_link, 'found': False}
+    policy = link['policy']
+    requires = []
+    if policy.auth_user is not None:
+        requires.append('basic_auth')
+    if policy.guid:
+        requires.append('guid')
+    return {
+        'short_link': short_link,
+        'found': True,
+        'url': url_for('redirect_link', short_link=short_link, _external=True),
+        'target_url': None if link['is_file'] else link['target_url'],
+        'is_file': bool(link['is_file']),
+        'filename': link['filename'],
+        'expires_at': link['expires_at'],
+        'expired': policy.expires is not None and now > policy.expires,
+        'redirect_status': None if link['is_file'] else link['redirect_status'] or 302,
+        'requires': requires,
+    }
+
+def _ndjson_short_links(stream):
+    """Short links from an NDJSON body: JSON strings or {"short_link": ...} objects."""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            value = json.loads(line)
+        except ValueError:
+            value = line.decode('utf-8', 'replace')
+        if isinstance(value, dict):
+            value = value.get('short_link')
+        yield str(value)
+
+@app.route('/api/resolve', methods=['POST'])
+@requires_api_token
+def api_resolve():
+    """
+    Resolve many short links without following them or recording clicks.
+    A JSON body {"short_links": [...]} gets a JSON reply in the same order.
+    An NDJSON body (one short link per line) gets an NDJSON reply,
+    streamed as the body is read, for batches of any size.
+    """
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl', 'text/plain'):
+        def generate():
+            short_links = _ndjson_short_links(request.stream)
+            while True:
+                chunk = list(itertools.islice(short_links, RESOLVE_CHUNK_SIZE))
+                if not chunk:
+                    break
+                links = resolve_links(chunk)
+                now = time.time()
+                yield ''.join(json.dumps(_resolved_link(short_link, links[short_link], now)) + '\n'
+                              for short_link in chunk)
+        return app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    values = request.get_json(silent=True)
+    short_links = values.get('short_links') if isinstance(values, dict) else None
+    if not isinstance(short_links, list) or not all(isinstance(value, str) for value in short_links):
+        return jsonify(error='Expected {"short_links": [...]} with a list of strings'), 400
+    limit = app.config['API_RESOLVE_MAX_LINKS']
+    if len(short_links) > limit:
+        return jsonify(error=f'At most {limit} short links per request; send NDJSON for more'), 400
+    links = resolve_links(short_links)
+    now = time.time()
+    return jsonify(links=[_resolved_link(short_link, links[short_link], now)
+                          for short_link in short_links])
+
+@app.route('/beacon/<short_link>', methods=['POST'])
+@requires_api_token
+def click_beacon(short_link):
+    """
+    Count a click on a cacheable URL link, reported by the CDN or edge
+    worker that served it (CLICK_BEACON_ENABLED). An optional JSON body
+    describes the visitor: ip_address, user_agent, referer, and the
+    request's method and headers, for the click filter.
+    """
+    if not app.config['CLICK_BEACON_ENABLED']:
+        abort(404)
+    link = resolve_link(short_link)
+    if link is None or not counted_by_beacon(link) or check_access(link) != link_access.ALLOWED:
+        abort(404)
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict):
+        values = {}
+    headers = values.get('headers')
+    headers = {str(k).lower(): str(v) for k, v in headers.items()} if isinstance(headers, dict) else {}
+    record_click(
+        short_link=short_link,
+        ip_address=str(values.get('ip_address') or request.remote_addr),
+        user_agent=str(values.get('user_agent') or headers.get('user-agent') or ''),
+        referer=values.get('referer') or headers.get('referer'),
+        headers=headers,
+        method=str(values.get('method') or 'GET').upper()
+    )
+    return '', 204, {'Cache-Control': 'no-store'}
 
 @app.route('/<short_link>')
 def redirect_link(short_link):
     if short_link == 'admin':
         return redirect('/admin')
         
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''
-        SELECT target_url, is_file, filename,
-               expires_at, guid_required, basic_auth_user, basic_auth_pass
-        FROM links
-        WHERE short_link = ?
-    ''', (short_link,))
-    result = c.fetchone()
+    metrics = get_metrics()
+    with metrics.timer('redirect_stage_duration_seconds', stage='lookup'):
+        result = resolve_link(short_link)
     
     if result is None:
         abort(404)
     
-    # 1) Check if expired
-    expires_at = result['expires_at']
-    if expires_at:
-        try:
-            expires_dt = datetime.strptime(expires_at, "%Y-%m-%d %H:%M:%S")
-            if datetime.utcnow() > expires_dt:
-                abort(404)  # Link expired
-        except ValueError:
-            # If parsing fails, ignore or log an error
-            pass
+    with metrics.timer('redirect_stage_duration_seconds', stage='access_check'):
+        access = check_access(result, request.headers.get('Authorization'), request.args.get('s'))
+    if access == link_access.NOT_FOUND:
+        abort(404)  # Link expired
+    if access == link_access.AUTH_REQUIRED:
+        return _http_auth_required()
+    if access == link_access.FORBIDDEN:
+        abort(403)  # Wrong or missing GUID
     
-    # 2) Check Basic Auth
-    if result['basic_auth_user'] is not None:
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Basic '):
-            return _http_auth_required()
-        
-        # Decode base64
-        encoded_credentials = auth_header.split(' ', 1)[1].strip()
-        try:
-            decoded_bytes = base64.b64decode(encoded_credentials)
-            decoded_str = decoded_bytes.decode('utf-8')
-            incoming_user, incoming_pass = decoded_str.split(':', 1)
-        except Exception:
-            return _http_auth_required()
-        
-        # Compare with stored credentials
-        if (incoming_user != result['basic_auth_user'] or
-                incoming_pass != result['basic_auth_pass']):
-            return _http_auth_required()
-    
-    # 3) Check GUID
-    if result['guid_required']:
-        passed_guid = request.args.get('s')
-        if passed_guid != result['guid_required']:
-            abort(403)  # Wrong or missing GUID
-    
-    # If we pass all checks, record the click
-    record_click(
-        short_link=short_link,
-        ip_address=request.remote_addr,
-        user_agent=request.user_agent.string,
-        referer=request.referrer
-    )
+    # If we pass all checks, record the click, unless the edge in front
+    # reports it through the beacon
+    if not (app.config['CLICK_BEACON_ENABLED'] and counted_by_beacon(result)):
+        with metrics.timer('redirect_stage_duration_seconds', stage='record_click'):
+            record_click(
+                short_link=short_link,
+                ip_address=request.remote_addr,
+                user_agent=request.user_agent.string,
+                referer=request.referrer,
+                headers=request.headers,
+                method=request.method
+            )
     
     # Finally, serve the file or redirect
     if result['is_file']:  # If it's a file
-        return send_file(result['target_url'], download_name=result['filename'])
+        with metrics.timer('redirect_stage_duration_seconds', stage='send_file'):
+            return send_upload(result['target_url'], result['filename'], etag=result['blob_digest'])
     else:  # If it's a URL
-        return redirect(result['target_url'])
+        return redirect_response(result, app.config['REDIRECT_CACHE_MAX_AGE'])
 
 @app.route('/admin/delete', methods=['POST'])
 @requires_auth
@@ -688,10 +1131,12 @@ def delete_link():
     c = conn.cursor()
     
     # Get file info before deletion
-    c.execute('SELECT is_file, target_url FROM links WHERE short_link = ?', (short_link,))
+    c.execute('SELECT is_file, target_url, blob_digest FROM links WHERE short_link = ?', (short_link,))
     result = c.fetchone()
     
-    if result and result['is_file']:
+    # Blobs are removed by commit_link_changes() once nothing references
+    # them; files from before the blob store belong to this link alone
+    if result and result['is_file'] and result['blob_digest'] is None:
         # Delete the file if it exists
         try:
             os.remove(result['target_url'])
@@ -700,14 +1145,146 @@ def delete_link():
     
     # Delete from database
     c.execute('DELETE FROM links WHERE short_link = ?', (short_link,))
-    conn.commit()
+    forget_link_clicks(conn, short_link)
+    commit_link_changes(conn)
     
     return redirect('/admin')
 
+@app.cli.command('backfill-rollups')
+def backfill_rollups_command():
+    """Rebuild the click rollup tables from the raw clicks table."""
+    backfill_rollups(get_db())
+    click.echo('Click rollups rebuilt.')
+
+@app.cli.command('build-snapshot')
+def build_snapshot_command():
+    """Write the memory-mapped link snapshot used for redirect lookups."""
+    snapshot = build_link_snapshot()
+    if snapshot is None:
+        click.echo('Another process is already writing the link snapshot.')
+    else:
+        click.echo(f'Wrote {snapshot.count} link(s) to {snapshot.path}.')
+
+@app.cli.command('backfill-sketches')
+def backfill_sketches_command():
+    """Rebuild the unique-visitor HyperLogLog sketches from the raw clicks table."""
+    backfill_visitor_sketches(get_db())
+    click.echo('Visitor sketches rebuilt.')
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Rebuild the full-text index used by the admin search."""
+    rebuild_search_index(get_db())
+    click.echo('Search index rebuilt.')
+
+@app.cli.command('migrate-uploads')
+def migrate_uploads_command():
+    """Move files uploaded before the blob store into it."""
+    moved = migrate_legacy_uploads(get_db(), app.config['UPLOAD_FOLDER'])
+    click.echo(f'Moved {moved} file(s) into the blob store.')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def start_node_sync():
+    if app.config['CLUSTER_HUB_URL']:
+        cluster.get_node_sync(app)
+
+@app.after_request
+def observe_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        get_metrics().observe(
+            'http_request_duration_seconds',
+            time.perf_counter() - started,
+            (('endpoint', request.endpoint or 'unmatched'),
+             ('method', request.method),
+             ('status', str(response.status_code)))
+        )
+    return response
+
+@app.cli.command('purge-expired')
+def purge_expired_command():
+    """Delete links whose expiry date has passed."""
+    purged = purge_expired_links(get_db())
+    click.echo(f'Purged {purged} expired link(s).')
+
+@app.cli.command('purge-uploads')
+def purge_uploads_command():
+    """Delete resumable uploads that were abandoned before finishing."""
+    purged = resumable_upload.purge_expired_uploads(get_db(), app.config['UPLOAD_FOLDER'])
+    click.echo(f'Purged {purged} abandoned upload(s).')
+
+@app.cli.command('purge-sessions')
+def purge_sessions_command():
+    """Delete expired sessions (SESSION_BACKEND=sqlite)."""
+    purged = purge_expired_sessions(get_db())
+    click.echo(f'Purged {purged} expired session(s).')
+
+@app.cli.command('prune-clicks')
+@click.option('--retention-days', type=int, help='Defaults to CLICK_RETENTION_DAYS.')
+def prune_clicks_command(retention_days):
+    """Archive raw clicks past the retention window and purge deleted links' clicks."""
+    if retention_days is None:
+        retention_days = app.config['CLICK_RETENTION_DAYS']
+    report = run_retention(
+        get_db(),
+        retention_days,
+        app.config['CLICK_ARCHIVE_DIR'],
+        batch_size=app.config['CLICK_PRUNE_BATCH_SIZE'],
+        pause=app.config['CLICK_PRUNE_PAUSE_MS'] / 1000.0
+    )
+    for month, count in report['archived'].items():
+        click.echo(f'Archived {count} clicks from {month}.')
+    click.echo(f"Purged {report['purged']} clicks of deleted links.")
+
+@app.cli.command('import-links')
+@click.argument('path', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'fmt', type=click.Choice(bulk.FORMATS), help='Defaults to the file extension.')
+@click.option('--on-conflict', type=click.Choice(bulk.CONFLICT_POLICIES), default='replace', show_default=True)
+@click.option('--created-by', default='import', show_default=True)
+def import_links_command(path, fmt, on_conflict, created_by):
+    """Bulk-create URL links from a CSV or JSON-lines file ('-' for stdin)."""
+    report = bulk.import_links(
+        get_db(),
+        bulk.iter_records(path, fmt or bulk.guess_format(path.name)),
+        created_by=created_by,
+        on_conflict=on_conflict,
+        batch_size=app.config['BULK_IMPORT_BATCH_SIZE'],
+        reserved=RESERVED_SHORT_LINKS
+    )
+    for error in report['errors']:
+        click.echo(f"line {error['line']}: {error['short_link'] or '-'}: {error['error']}", err=True)
+    click.echo(f"{report['imported']} imported, {report['skipped']} skipped (existing), "
+               f"{report['failed']} failed of {report['rows']} rows.")
+
+@app.cli.command('export-links')
+@click.argument('path', type=click.File('w'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(bulk.FORMATS), default='csv', show_default=True)
+def export_links_command(path, fmt):
+    """Write every link as CSV or JSON lines (default: stdout)."""
+    for chunk in bulk.export_links(get_read_db(), fmt):
+        path.write(chunk)
+
+@app.cli.command('cluster-sync')
+def cluster_sync_command():
+    """Run one sync pass with the cluster hub (CLUSTER_HUB_URL)."""
+    if not app.config['CLUSTER_HUB_URL']:
+        raise click.ClickException('CLUSTER_HUB_URL is not set.')
+    hub = cluster.open_hub(app.config['CLUSTER_HUB_URL'])
+    try:
+        report = cluster.sync_once(get_db(), hub, app.config['NODE_ID'],
+                                   app.config['CLUSTER_SYNC_BATCH_SIZE'],
+                                   app.config['UNIQUE_VISITOR_MODE'] == 'exact')
+    finally:
+        hub.close()
+    click.echo(', '.join(f'{key.replace("_", " ")}: {count}' for key, count in report.items()))
+
 @app.teardown_appcontext
 def cleanup(exc):
-    if hasattr(g, "db"):
-        g.db.close()
+    close_db(exc)
 
 if __name__ == '__main__':
     # Adjust as needed, but normally we'd use WSGI (Gunicorn, etc.)
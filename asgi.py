@@ -0,0 +1,210 @@
+"""
+ASGI entry point: serves public short-link redirects natively and passes
+every other request to the Flask app.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 8080 --workers 4
+
+A sync gunicorn worker handles one request at a time, so a slow client
+downloading a file holds the worker until the download finishes. Here,
+link lookups and file reads run on a bounded thread pool and the event
+loop only waits on them. Thousands of redirects and downloads can be in
+flight per process. The admin and SSO routes still run as the normal
+Flask (WSGI) app through asgiref's adapter.
+"""
+import asyncio
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import HTTPException, NotFound, Forbidden, RequestedRangeNotSatisfiable
+from werkzeug.http import dump_options_header, http_date, parse_date, parse_etags, parse_range_header
+
+import cluster
+import link_access
+from app import app as flask_app, _http_auth_required
+from database import resolve_link, record_click, drain_click_queue
+from link_access import check_access
+from redirect_cache import counted_by_beacon, redirect_response
+
+CHUNK_SIZE = 256 * 1024
+
+wsgi_application = WsgiToAsgi(flask_app)
+executor = ThreadPoolExecutor(max_workers=flask_app.config['ASGI_THREADS'],
+                              thread_name_prefix='asgi')
+url_adapter = flask_app.url_map.bind('localhost')
+
+
+async def run_sync(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+def _resolve(short_link):
+    with flask_app.app_context():
+        return resolve_link(short_link)
+
+
+def _client_address(scope, headers):
+    """The visitor's address, trusting X-Forwarded-For as ProxyFix does in app.py."""
+    trusted = flask_app.config['TRUSTED_PROXIES']
+    forwarded_for = headers.get('x-forwarded-for')
+    if trusted and forwarded_for:
+        forwarded = [part.strip() for part in forwarded_for.split(',')]
+        if len(forwarded) >= trusted:
+            return forwarded[-trusted]
+    client = scope.get('client')
+    return client[0] if client else None
+
+
+def _record_click(short_link, ip_address, user_agent, referer, headers, method):
+    with flask_app.app_context():
+        record_click(short_link, ip_address, user_agent, referer, headers, method)
+
+
+async def send_response(send, response, head=False):
+    """Send a fully built (non-streaming) Werkzeug response."""
+    body = b'' if head else response.get_data()
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                    for k, v in response.headers.items()],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_file(send, link, headers, head=False):
+    """
+    Stream a file link's file: conditional requests get 304, a single
+    byte range gets 206, and reads happen on the thread pool so the event
+    loop never blocks on disk.
+    """
+    path = link['target_url']
+    try:
+        st = await run_sync(os.stat, path)
+    except OSError:
+        return await send_response(send, NotFound().get_response(), head)
+
+    size = st.st_size
+    etag = link['blob_digest'] or f'{size:x}-{st.st_mtime_ns:x}'
+    last_modified = http_date(st.st_mtime)
+    mimetype = mimetypes.guess_type(link['filename'] or '')[0] or 'application/octet-stream'
+    response_headers = [
+        (b'content-type', mimetype.encode('latin-1')),
+        (b'content-disposition', dump_options_header('inline', {'filename': link['filename']}).encode('latin-1')),
+        (b'etag', f'"{etag}"'.encode('latin-1')),
+        (b'last-modified', last_modified.encode('latin-1')),
+        (b'accept-ranges', b'bytes'),
+        (b'cache-control', b'no-cache'),
+    ]
+
+    if_none_match = headers.get('if-none-match')
+    if_modified_since = parse_date(headers.get('if-modified-since'))
+    if ((if_none_match and parse_etags(if_none_match).contains(etag)) or
+            (not if_none_match and if_modified_since and int(st.st_mtime) <= if_modified_since.timestamp())):
+        await send({'type': 'http.response.start', 'status': 304, 'headers': response_headers})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    status, start, length = 200, 0, size
+    range_header = headers.get('range')
+    if_range = headers.get('if-range')
+    if range_header and size and (not if_range or parse_etags(if_range).contains(etag)):
+        parsed = parse_range_header(range_header)
+        span = parsed.range_for_length(size) if parsed else None
+        if span is None:
+            return await send_response(send, RequestedRangeNotSatisfiable(length=size).get_response(), head)
+        start, stop = span
+        status, length = 206, stop - start
+        response_headers.append((b'content-range', f'bytes {start}-{stop - 1}/{size}'.encode('latin-1')))
+
+    response_headers.append((b'content-length', str(length).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+    if head:
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    f = await run_sync(open, path, 'rb')
+    try:
+        await run_sync(f.seek, start)
+        remaining = length
+        while remaining > 0:
+            chunk = await run_sync(f.read, min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+        if remaining > 0:
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        await run_sync(f.close)
+
+
+async def serve_redirect(scope, receive, send, short_link):
+    """The async equivalent of app.redirect_link()."""
+    head = scope['method'] == 'HEAD'
+    link = await run_sync(_resolve, short_link)
+    if link is None:
+        return await send_response(send, NotFound().get_response(), head)
+
+    # Offloaded file delivery only needs headers; let the Flask view do it
+    if link['is_file'] and flask_app.config['FILE_DELIVERY_MODE'] != 'direct':
+        return await wsgi_application(scope, receive, send)
+
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    guid = query.get('s', [None])[0]
+
+    access = check_access(link, headers.get('authorization'), guid)
+    if access == link_access.NOT_FOUND:
+        return await send_response(send, NotFound().get_response(), head)
+    if access == link_access.AUTH_REQUIRED:
+        with flask_app.app_context():
+            return await send_response(send, _http_auth_required(), head)
+    if access == link_access.FORBIDDEN:
+        return await send_response(send, Forbidden().get_response(), head)
+
+    click = (short_link, _client_address(scope, headers), headers.get('user-agent', ''), headers.get('referer'), headers, scope['method'])
+    # With beacons on, the edge in front reports clicks on cacheable links
+    if not (flask_app.config['CLICK_BEACON_ENABLED'] and counted_by_beacon(link)):
+        if flask_app.config['CLICK_QUEUE_OVERFLOW'] == 'block' or not flask_app.config['CLICK_QUEUE_ENABLED']:
+            # Could wait on a full buffer or on SQLite; keep that off the loop
+            await run_sync(_record_click, *click)
+        else:
+            _record_click(*click)
+
+    if link['is_file']:
+        return await send_file(send, link, headers, head)
+    return await send_response(send, redirect_response(link, flask_app.config['REDIRECT_CACHE_MAX_AGE']), head)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Redirects served here skip Flask's before_request hooks
+            if flask_app.config['CLUSTER_HUB_URL']:
+                cluster.get_node_sync(flask_app)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await run_sync(drain_click_queue, flask_app)
+            await run_sync(cluster.stop_node_sync, flask_app)
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+        try:
+            endpoint, args = url_adapter.match(scope['path'], method='GET')
+        except HTTPException:
+            endpoint = None
+        if endpoint == 'redirect_link' and args['short_link'] != 'admin':
+            return await serve_redirect(scope, receive, send, args['short_link'])
+
+    return await wsgi_application(scope, receive, send)
@@ -1,21 +1,37 @@
 from functools import wraps
-from flask import session, redirect, url_for, current_app, request, g
-from onelogin.saml2.auth import OneLogin_Saml2_Auth
-from onelogin.saml2.utils import OneLogin_Saml2_Utils
+from flask import session, redirect, url_for, current_app, request, g, jsonify
+import hmac
 import json
 import os
+import threading
 from urllib.parse import urlparse
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+SAML_SETTINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'saml', 'settings.json')
+
+# settings.json parsed into python3-saml's settings object, which
+# requests share; reloaded when the file's mtime changes
+_saml_settings = {'mtime': None, 'settings': None}
+_saml_settings_lock = threading.Lock()
+
+def load_saml_settings(path=SAML_SETTINGS_PATH):
+    # python3-saml pulls in lxml and xmlsec; only SSO requests need them
+    from onelogin.saml2.settings import OneLogin_Saml2_Settings
+    mtime = os.stat(path).st_mtime_ns
+    with _saml_settings_lock:
+        if _saml_settings['mtime'] != mtime:
+            with open(path, 'r') as f:
+                _saml_settings['settings'] = OneLogin_Saml2_Settings(json.load(f))
+            _saml_settings['mtime'] = mtime
+            logger.info(f"SAML settings loaded from {path}")
+        return _saml_settings['settings']
+
 def init_saml_auth(req):
-    saml_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'saml')
-    with open(os.path.join(saml_path, 'settings.json'), 'r') as f:
-        settings = json.load(f)
-        logger.debug(f"SAML Settings loaded: {json.dumps(settings, indent=2)}")
-    auth = OneLogin_Saml2_Auth(req, settings)
+    from onelogin.saml2.auth import OneLogin_Saml2_Auth
+    auth = OneLogin_Saml2_Auth(req, load_saml_settings())
     return auth
 
 def prepare_flask_request(request):
@@ -35,15 +51,52 @@ def prepare_flask_request(request):
         'query_string': request.query_string
     }
 
+def parse_api_tokens(value):
+    """API_TOKENS is a comma-separated list of name:token pairs."""
+    tokens = {}
+    for item in (value or '').split(','):
+        name, sep, token = item.strip().partition(':')
+        if sep and name and token:
+            tokens[name] = token
+    return tokens
+
+def requires_api_token(f):
+    """
+    For endpoints called by other services: requires "Authorization:
+    Bearer <token>" with one of API_TOKENS and sets g.api_client to the
+    token's name. With no tokens configured the endpoints don't exist.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        tokens = parse_api_tokens(current_app.config['API_TOKENS'])
+        if not tokens:
+            return jsonify(error='Not found'), 404
+        authorization = request.headers.get('Authorization', '')
+        for name, token in tokens.items():
+            if hmac.compare_digest(authorization, f'Bearer {token}'):
+                g.api_client = name
+                return f(*args, **kwargs)
+        return jsonify(error='Invalid or missing API token'), 401, {'WWW-Authenticate': 'Bearer'}
+    return decorated
+
+# Who every request acts as when SSO is off. It is not put in the session,
+# so requests without a cookie (health checks, scripts) don't each leave a
+# stored session behind.
+LOCAL_USER = {
+    'preferred_username': 'local_user',
+    'name': 'Local User'
+}
+
+def current_user():
+    """The signed-in user's attributes; LOCAL_USER when SSO is off."""
+    if not current_app.config['ENABLE_SSO']:
+        return LOCAL_USER
+    return session.get('user')
+
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         if not current_app.config['ENABLE_SSO']:
-            if 'user' not in session:
-                session['user'] = {
-                    'preferred_username': 'local_user',
-                    'name': 'Local User'
-                }
             return f(*args, **kwargs)
             
         if not session.get('user'):
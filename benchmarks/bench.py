@@ -0,0 +1,317 @@
+"""
+Benchmark the redirect hot path and the admin pages.
+
+Seeds a throwaway SQLite database with LINKS links and CLICKS clicks, then
+measures per-endpoint latency through Flask's WSGI test client, and
+throughput under a multi-process load generator (either more test clients
+in forked processes sharing the database, like gunicorn workers, or real
+HTTP requests against a running server with --url). Results are written
+as JSON so runs from different versions can be compared with --compare.
+
+    python benchmarks/bench.py --links 10000 --clicks 10000000 --output before.json
+    python benchmarks/bench.py --links 10000 --clicks 10000000 --compare before.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# Set by setup_app(); forked load-generator processes inherit them
+app = None
+short_links = []
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, math.ceil(pct / 100.0 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'throughput_rps': round(count / elapsed, 1) if elapsed else 0.0,
+        'mean_ms': round(sum(latencies) / count * 1000, 3) if count else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def seed_database(path, num_links, num_clicks, days=180, batch_size=50000):
+    """Fill a fresh database with links and clicks spread over `days` days."""
+    from database import backfill_rollups
+
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    now = datetime.datetime.utcnow()
+    rng = random.Random(42)
+
+    links = []
+    for i in range(num_links):
+        created = now - datetime.timedelta(seconds=rng.randint(0, days * 86400))
+        links.append((
+            f'link{i:07d}',
+            f'https://example.com/{rng.choice(["docs", "blog", "shop", "news"])}/{i}',
+            f'Seeded link {i} for {rng.choice(["spring", "summer", "launch", "promo"])} campaign',
+            created.strftime('%Y-%m-%d %H:%M:%S'),
+        ))
+    with db:
+        db.executemany('''
+            INSERT INTO links (short_link, target_url, description, created_at)
+            VALUES (?, ?, ?, ?)
+        ''', links)
+
+    # Skew clicks towards a few hot links, like real traffic
+    weights = [1.0 / (rank + 1) for rank in range(num_links)]
+    remaining = num_clicks
+    while remaining > 0:
+        count = min(batch_size, remaining)
+        targets = rng.choices(links, weights=weights, k=count)
+        rows = []
+        for link in targets:
+            clicked = now - datetime.timedelta(seconds=rng.randint(0, days * 86400))
+            rows.append((
+                link[0],
+                f'10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}',
+                'Mozilla/5.0 (bench)',
+                None,
+                clicked.strftime('%Y-%m-%d %H:%M:%S'),
+            ))
+        with db:
+            db.executemany('''
+                INSERT INTO clicks (short_link, ip_address, user_agent, referer, clicked_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+        remaining -= count
+
+    backfill_rollups(db)
+    db.close()
+    return [link[0] for link in links]
+
+
+def setup_app(workdir, num_links, num_clicks):
+    global app, short_links
+
+    os.chdir(workdir)
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'shortener.db')
+    os.environ.setdefault('ENABLE_SSO', 'false')
+    # Every request comes from one address, so don't let it be taken for a bot
+    os.environ.setdefault('CLICK_FILTER_MODE', 'off')
+
+    import app as app_module
+    logging.getLogger().setLevel(logging.WARNING)
+    app = app_module.app
+    app.config['TESTING'] = True
+
+    started = time.perf_counter()
+    short_links = seed_database(os.environ['DATABASE_PATH'], num_links, num_clicks)
+    return time.perf_counter() - started
+
+
+def endpoint_scenarios():
+    """(name, callable(client, rng) -> response) pairs measured in-process."""
+    hot = short_links[0]
+
+    def record_click_only(client, rng):
+        from database import record_click
+        with app.test_request_context('/' + hot):
+            record_click(hot, '10.0.0.1', 'Mozilla/5.0 (bench)', None)
+        return None
+
+    return [
+        ('redirect_hot', lambda client, rng: client.get('/' + hot)),
+        ('redirect_random', lambda client, rng: client.get('/' + rng.choice(short_links))),
+        ('redirect_404', lambda client, rng: client.get(f'/missing{rng.randint(0, 10 ** 6)}')),
+        ('record_click', record_click_only),
+        ('admin_listing', lambda client, rng: client.get('/admin')),
+        ('search_links', lambda client, rng: client.get(
+            '/admin/search?q=' + rng.choice(['campaign', 'spring', 'shop/1', 'link00012']))),
+        ('link_stats', lambda client, rng: client.get('/admin/stats/' + hot)),
+    ]
+
+
+def run_in_process(requests_per_endpoint, selected):
+    results = {}
+    client = app.test_client()
+    rng = random.Random(7)
+    for name, scenario in endpoint_scenarios():
+        if selected and name not in selected:
+            continue
+        # Warm caches and the connection pool first
+        for _ in range(min(20, requests_per_endpoint)):
+            scenario(client, rng)
+
+        latencies = []
+        errors = 0
+        started = time.perf_counter()
+        for _ in range(requests_per_endpoint):
+            t0 = time.perf_counter()
+            response = scenario(client, rng)
+            latencies.append(time.perf_counter() - t0)
+            if response is not None and response.status_code >= 500:
+                errors += 1
+        results[name] = summarize(latencies, errors, time.perf_counter() - started)
+        print(f"  {name:16s} p50={results[name]['p50_ms']:.3f}ms "
+              f"p99={results[name]['p99_ms']:.3f}ms rps={results[name]['throughput_rps']}")
+    return results
+
+
+def _load_worker(args):
+    """One load-generator process: hit redirects for `duration` seconds."""
+    url, duration, seed = args
+    rng = random.Random(seed)
+    latencies = []
+    errors = 0
+
+    if url:
+        class NoRedirect(urllib.request.HTTPRedirectHandler):
+            def redirect_request(self, *a, **kw):
+                return None
+        opener = urllib.request.build_opener(NoRedirect)
+
+        def hit(path):
+            try:
+                opener.open(url.rstrip('/') + path, timeout=30).close()
+                return 200
+            except urllib.error.HTTPError as e:
+                return e.code
+            except OSError:
+                return 599
+    else:
+        client = app.test_client()
+
+        def hit(path):
+            return client.get(path).status_code
+
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        # Mostly the hot links, some long tail
+        if rng.random() < 0.8:
+            path = '/' + short_links[rng.randint(0, min(9, len(short_links) - 1))]
+        else:
+            path = '/' + rng.choice(short_links)
+        t0 = time.perf_counter()
+        status = hit(path)
+        latencies.append(time.perf_counter() - t0)
+        if status >= 500:
+            errors += 1
+
+    if not url:
+        from database import drain_click_queue
+        drain_click_queue(app)
+    return latencies, errors
+
+
+def run_load(processes, duration, url):
+    ctx = multiprocessing.get_context('fork')
+    started = time.perf_counter()
+    with ctx.Pool(processes) as pool:
+        parts = pool.map(_load_worker, [(url, duration, seed) for seed in range(processes)])
+    elapsed = time.perf_counter() - started
+
+    latencies = [lat for part, _ in parts for lat in part]
+    errors = sum(err for _, err in parts)
+    result = summarize(latencies, errors, elapsed)
+    result['processes'] = processes
+    result['target'] = url or 'wsgi-test-client'
+    print(f"  redirect_load    p50={result['p50_ms']:.3f}ms p99={result['p99_ms']:.3f}ms "
+          f"rps={result['throughput_rps']} ({processes} processes)")
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline_path, results):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    print(f"\nCompared with {baseline_path} (positive = slower):")
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        for metric in ('p50_ms', 'p99_ms'):
+            if before[metric]:
+                change = (current[metric] - before[metric]) / before[metric] * 100
+                print(f"  {name:16s} {metric} {before[metric]:.3f} -> {current[metric]:.3f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--links', type=int, default=10000)
+    parser.add_argument('--clicks', type=int, default=200000)
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests per endpoint for the in-process run')
+    parser.add_argument('--endpoints', nargs='*', help='only run these in-process scenarios')
+    parser.add_argument('--processes', type=int, default=4, help='load generator processes')
+    parser.add_argument('--duration', type=float, default=10.0, help='load test seconds')
+    parser.add_argument('--url', help='load-test a running server instead of forked test clients')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='earlier results JSON to compare against')
+    parser.add_argument('--workdir', help='keep the seeded database here instead of a temp dir')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='urlshortener-bench-')
+    output = os.path.abspath(args.output)
+    os.makedirs(workdir, exist_ok=True)
+
+    print(f"Seeding {args.links} links / {args.clicks} clicks in {workdir}")
+    seed_seconds = setup_app(workdir, args.links, args.clicks)
+    print(f"  seeded in {seed_seconds:.1f}s")
+
+    print("In-process (WSGI test client):")
+    results = run_in_process(args.requests, args.endpoints)
+    if args.processes > 0 and args.duration > 0:
+        print("Load generator:")
+        results['redirect_load'] = run_load(args.processes, args.duration, args.url)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'links': args.links,
+            'clicks': args.clicks,
+            'requests_per_endpoint': args.requests,
+            'seed_seconds': round(seed_seconds, 2),
+        },
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import hashlib
+import logging
+import os
+import tempfile
+import uuid
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+DIGEST_ALGORITHM = 'sha256'
+
+
+def blob_path(upload_folder, digest):
+    """Where the blob with this digest lives: uploads/blobs/ab/abcdef..."""
+    return os.path.join(upload_folder, 'blobs', digest[:2], digest)
+
+
+def staging_dir(upload_folder):
+    # Staged files must be on the same filesystem as the blobs so that
+    # committing one is a rename rather than a copy
+    path = os.path.join(upload_folder, 'blobs', 'tmp')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def stage_upload(stream, upload_folder):
+    """
+    Copy an upload stream to a staging file in chunks, hashing it on the
+    way. Returns (staged_path, digest, size).
+    """
+    hasher = hashlib.new(DIGEST_ALGORITHM)
+    size = 0
+    fd, staged_path = tempfile.mkstemp(dir=staging_dir(upload_folder))
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(staged_path)
+        raise
+    return staged_path, hasher.hexdigest(), size
+
+
+def discard_staged(staged_path):
+    try:
+        os.remove(staged_path)
+    except OSError:
+        pass
+
+
+def commit_blob(db, staged_path, digest, size, upload_folder):
+    """
+    Move a staged upload into the store under its digest and register it.
+    Returns the blob's path.
+
+    Must run inside a write transaction (BEGIN IMMEDIATE) that also inserts
+    the referencing link. Holding SQLite's write lock is what keeps
+    collect_garbage() in another worker from deleting the file in between.
+    If the blob already exists the staged copy has identical content, so
+    replacing the file is harmless. The row goes in first, so a file is
+    never in the store without one.
+    """
+    path = blob_path(upload_folder, digest)
+    db.execute('''
+        INSERT OR IGNORE INTO blobs (digest, path, size)
+        VALUES (?, ?, ?)
+    ''', (digest, path, size))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(staged_path, path)
+    return path
+
+
+def collect_garbage(db):
+    """
+    Unregister blobs that no link references any more and move their files
+    aside, removing prefix directories left empty. Reference counts are
+    maintained by triggers on `links`. Call this inside the write
+    transaction that removed the references, before committing it; then
+    pass the result to remove_garbage() once the commit has succeeded, or
+    to restore_garbage() if it failed.
+    """
+    moved = []
+    rows = db.execute('SELECT digest, path FROM blobs WHERE refcount <= 0').fetchall()
+    for row in rows:
+        db.execute('DELETE FROM blobs WHERE digest = ?', (row['digest'],))
+        path = row['path']
+        # Still under the write lock, so no commit_blob() can race this
+        trash_dir = os.path.join(os.path.dirname(os.path.dirname(path)), 'tmp')
+        trash_path = os.path.join(trash_dir, f"{row['digest']}.{uuid.uuid4().hex}.garbage")
+        try:
+            os.makedirs(trash_dir, exist_ok=True)
+            os.replace(path, trash_path)
+        except FileNotFoundError:
+            continue
+        except OSError:
+            logger.exception(f"Failed to move blob {path} aside")
+            continue
+        moved.append((path, trash_path))
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass  # Other blobs share the prefix
+    return moved
+
+
+def remove_garbage(moved):
+    """Delete the files collect_garbage() moved aside."""
+    for _path, trash_path in moved:
+        try:
+            os.remove(trash_path)
+        except OSError:
+            logger.exception(f"Failed to remove blob {trash_path}")
+
+
+def restore_garbage(moved):
+    """Put back the files collect_garbage() moved aside."""
+    for path, trash_path in moved:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(trash_path, path)
+        except OSError:
+            logger.exception(f"Failed to restore blob {path}")
+
+
+def hash_file(path):
+    hasher = hashlib.new(DIGEST_ALGORITHM)
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            size += len(chunk)
+    return hasher.hexdigest(), size
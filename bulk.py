@@ -0,0 +1,237 @@
+import csv
+import io
+import json
+import uuid
+
+from database import begin_write, commit_link_changes
+from link_access import hash_link_password, normalize_expiry
+from redirect_cache import parse_redirect_status
+from url_utils import is_valid_url, normalize_url
+
+FORMATS = ('csv', 'jsonl')
+CONFLICT_POLICIES = ('replace', 'skip')
+
+# Columns accepted by import_links(); only short_link and target_url are required
+IMPORT_FIELDS = (
+    'short_link', 'target_url', 'description', 'expires_at',
+    'guid_required', 'basic_auth_user', 'basic_auth_pass', 'redirect_status'
+)
+EXPORT_FIELDS = (
+    'short_link', 'target_url', 'is_file', 'filename', 'description', 'created_at',
+    'created_by', 'expires_at', 'guid_required', 'basic_auth_user', 'basic_auth_pass',
+    'redirect_status'
+)
+
+# Per-row errors kept in the import report; the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+
+
+def guess_format(filename, content_type=None):
+    name = (filename or '').lower()
+    if name.endswith(('.jsonl', '.ndjson', '.json')) or 'ndjson' in (content_type or '') \
+            or 'jsonl' in (content_type or ''):
+        return 'jsonl'
+    return 'csv'
+
+
+def iter_records(stream, fmt):
+    """
+    Yield (line_number, record) from a text stream, where record is a dict
+    or, for lines that can't be parsed, the ValueError describing why.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_number, ValueError(f'Invalid JSON: {e}')
+                continue
+            if not isinstance(record, dict):
+                record = ValueError('Expected a JSON object')
+            yield line_number, record
+    else:
+        raise ValueError(f'Unknown format: {fmt!r}')
+
+
+def _optional(record, field):
+    value = record.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def validate_record(record, reserved=()):
+    """
+    Validate and normalize one imported record the way create_link does.
+    Returns the row to insert or raises ValueError.
+    """
+    short_link = _optional(record, 'short_link')
+    if not short_link:
+        raise ValueError('Missing short_link')
+    if '/' in short_link:
+        raise ValueError('short_link cannot contain "/"')
+    if short_link in reserved:
+        raise ValueError(f'Cannot use reserved word "{short_link}"')
+
+    target_url = normalize_url(_optional(record, 'target_url'))
+    if not target_url:
+        raise ValueError('Missing target_url')
+    if not is_valid_url(target_url):
+        raise ValueError('Invalid URL')
+
+    expires_at = _optional(record, 'expires_at')
+    if expires_at:
+        expires_at = normalize_expiry(expires_at)
+
+    guid_required = _optional(record, 'guid_required')
+    if guid_required and guid_required.lower() in ('true', 'yes', 'on', '1'):
+        guid_required = str(uuid.uuid4())
+    elif guid_required and guid_required.lower() in ('false', 'no', 'off', '0'):
+        guid_required = None
+
+    return (
+        short_link,
+        target_url,
+        _optional(record, 'description') or '',
+        expires_at,
+        guid_required,
+        _optional(record, 'basic_auth_user'),
+        # Exported passwords are already hashed and pass through unchanged
+        hash_link_password(_optional(record, 'basic_auth_pass')),
+        parse_redirect_status(record.get('redirect_status')),
+    )
+
+
+def import_links(db, records, created_by=None, on_conflict='replace', batch_size=1000, reserved=()):
+    """
+    Insert validated records from iter_records() in transactions of
+    `batch_size` rows. Invalid rows are reported and skipped rather than
+    aborting the import. With on_conflict='skip', existing short links are
+    left alone; with 'replace' they are overwritten, as in create_link.
+    """
+    if on_conflict not in CONFLICT_POLICIES:
+        raise ValueError(f'Unknown conflict policy: {on_conflict!r}')
+    verb = 'INSERT OR REPLACE' if on_conflict == 'replace' else 'INSERT OR IGNORE'
+    query = f'''
+        {verb} INTO links
+        (short_link, target_url, is_file, created_by, description, expires_at,
+         guid_required, basic_auth_user, basic_auth_pass, redirect_status)
+        VALUES (?, ?, 0, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    report = {'rows': 0, 'imported': 0, 'skipped': 0, 'failed': 0, 'errors': []}
+
+    def write(batch):
+        begin_write(db)
+        cursor = db.executemany(query, batch)
+        # Leave the link snapshot to be rebuilt once, after the import
+        commit_link_changes(db, snapshot=False)
+        report['imported'] += cursor.rowcount
+        report['skipped'] += len(batch) - cursor.rowcount
+
+    batch = []
+    for line_number, record in records:
+        report['rows'] += 1
+        try:
+            if isinstance(record, Exception):
+                raise record
+            row = validate_record(record, reserved)
+        except ValueError as e:
+            report['failed'] += 1
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                short_link = record.get('short_link') if isinstance(record, dict) else None
+                report['errors'].append({'line': line_number, 'short_link': short_link, 'error': str(e)})
+            continue
+        batch.append(row[:2] + (created_by,) + row[2:])
+        if len(batch) >= batch_size:
+            write(batch)
+            batch = []
+    if batch:
+        write(batch)
+    return report
+
+
+def create_links(db, records, allocate, created_by=None, reserved=()):
+    """
+    Create links from import-style records, generating a short_link with
+    allocate(count) for each record without one. Unlike import_links(),
+    existing links are never replaced: a chosen short_link that is taken
+    is an error, and a generated one that is taken is swapped for another.
+    Returns one result per record, in order: the inserted row's
+    short_link and target_url, or an error.
+    """
+    results = [None] * len(records)
+    codes = iter(allocate(sum(1 for record in records if not _optional(record, 'short_link'))))
+    pending = []
+    for index, record in enumerate(records):
+        generated = not _optional(record, 'short_link')
+        if generated:
+            record = dict(record, short_link=next(codes))
+        try:
+            pending.append((index, generated, validate_record(record, reserved)))
+        except ValueError as e:
+            results[index] = {'error': str(e)}
+
+    query = '''
+        INSERT OR IGNORE INTO links
+        (short_link, target_url, is_file, created_by, description, expires_at,
+         guid_required, basic_auth_user, basic_auth_pass, redirect_status)
+        VALUES (?, ?, 0, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    while pending:
+        taken = []
+        begin_write(db)
+        for index, generated, row in pending:
+            if db.execute(query, row[:2] + (created_by,) + row[2:]).rowcount:
+                results[index] = {'short_link': row[0], 'target_url': row[1]}
+            elif generated:
+                taken.append((index, row))
+            else:
+                results[index] = {'short_link': row[0], 'error': 'short_link already exists'}
+        commit_link_changes(db)
+        # New codes are reserved outside the write transaction
+        codes = allocate(len(taken))
+        pending = [(index, True, (code,) + row[1:]) for (index, row), code in zip(taken, codes)]
+    return results
+
+
+def export_links(db, fmt, chunk_size=1000):
+    """
+    Yield the links table as CSV or JSONL text, one chunk of rows at a
+    time. Rows are read in short_link order with keyset pagination, so
+    neither the table nor a long-running read transaction is held.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format: {fmt!r}')
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(EXPORT_FIELDS)
+
+    last = None
+    while True:
+        rows = db.execute(f'''
+            SELECT {', '.join(EXPORT_FIELDS)}
+            FROM links
+            {'WHERE short_link > ?' if last is not None else ''}
+            ORDER BY short_link
+            LIMIT ?
+        ''', ((last,) if last is not None else ()) + (chunk_size,)).fetchall()
+        for row in rows:
+            if fmt == 'csv':
+                writer.writerow(['' if value is None else value for value in row])
+            else:
+                buffer.write(json.dumps(dict(row), separators=(',', ':')) + '\n')
+        if buffer.tell():
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1]['short_link']
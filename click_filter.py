@@ -0,0 +1,146 @@
+"""
+Tells human clicks from the automated traffic that follows short links:
+crawlers and link-preview bots, email security scanners that open every
+link in a message, and browsers prefetching a page the user may never
+visit. record_click() asks the worker's ClickFilter about each click
+before it is queued; depending on CLICK_FILTER_MODE a filtered click is
+dropped or stored as a bot click, which stays out of the rollups.
+
+The checks are cheap enough for the redirect path: a request header
+lookup, one precompiled pattern per distinct User-Agent (cached), and a
+per-IP counter in a bounded in-memory table. The rate check is opt-in:
+it only works when every visitor's own address reaches the app (see
+TRUSTED_PROXIES). The table is per worker, so with several workers an
+address can click a little more often than CLICK_FILTER_RATE_LIMIT
+before it is caught.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from flask import current_app
+
+MODES = ('off', 'tag', 'drop')
+
+# Reasons a click is filtered, as used in the clicks_filtered_total metric
+AGENT = 'agent'
+PREFETCH = 'prefetch'
+HEAD = 'head'
+RATE = 'rate'
+
+BOT_AGENT_PATTERN = re.compile('|'.join((
+    # Crawlers, HTTP libraries and headless browsers. "bot" alone would
+    # match device names such as CUBOT, so only as a word, as a versioned
+    # product token ("ExampleBot/1.0") or in a known crawler's name
+    r'\bbot\b|bot/|googlebot|bingbot|yandexbot|duckduckbot|applebot|petalbot|amazonbot',
+    r'crawl|spider|slurp|curl|wget|python-|httpclient|okhttp|go-http-client|headless',
+    r'java/|libwww|scrapy|phantomjs|lighthouse|pingdom|uptime',
+    # Link previews in chat and social apps
+    r'facebookexternalhit|facebookcatalog|slack|twitterbot|linkedinbot|whatsapp|telegrambot',
+    r'discordbot|skypeuripreview|embedly|iframely|vkshare|google-pagerenderer',
+    r'googleimageproxy|bingpreview',
+    # Email and link security scanners
+    r'barracuda|proofpoint|mimecast|symantec|forcepoint|trendmicro|safelinks|microsoft office',
+    r'ms-office|zscaler|fortiguard|checkpoint|sophos|urldefense|mailscanner',
+)), re.IGNORECASE)
+
+# Headers browsers send with speculative requests: Sec-Purpose (Chrome's
+# prefetch and prerender), Purpose (older Chrome and Safari), X-Moz (Firefox)
+# and X-Purpose (Safari's link previews)
+PREFETCH_HEADERS = ('sec-purpose', 'purpose', 'x-moz', 'x-purpose')
+PREFETCH_VALUES = re.compile(r'prefetch|prerender|preview', re.IGNORECASE)
+
+
+@lru_cache(maxsize=4096)
+def is_bot_agent(user_agent):
+    """
+    True for a User-Agent that names a known bot or scanner. A missing one
+    is not evidence either way (privacy tools strip it), so it counts.
+    """
+    return bool(user_agent) and BOT_AGENT_PATTERN.search(user_agent) is not None
+
+
+def is_prefetch(headers):
+    """True if `headers` (anything with a case-insensitive .get, or a dict
+    with lower-case keys) mark the request as a prefetch or preview."""
+    for name in PREFETCH_HEADERS:
+        value = headers.get(name)
+        if value and PREFETCH_VALUES.search(value):
+            return True
+    return False
+
+
+class RateTable:
+    """
+    Clicks per IP address in fixed windows of `window` seconds, for at
+    most `max_size` addresses; the least recently seen are forgotten
+    first. Thread-safe.
+    """
+
+    def __init__(self, limit, window=60.0, max_size=10000):
+        self.limit = limit
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit(self, ip_address, now=None):
+        """Count a click; True if the address is over the limit."""
+        now = now or time.monotonic()
+        with self._lock:
+            entry = self._entries.get(ip_address)
+            if entry is None or now - entry[0] >= self.window:
+                entry = [now, 0]
+                self._entries[ip_address] = entry
+                if len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(ip_address)
+            entry[1] += 1
+            return entry[1] > self.limit
+
+
+class ClickFilter:
+    """
+    Classifies clicks; one per worker. classify() returns None for a click
+    that looks human, or the reason it doesn't.
+    """
+
+    def __init__(self, mode='tag', rate_limit=0, rate_window=60.0, table_size=10000):
+        if mode not in MODES:
+            raise ValueError(f'CLICK_FILTER_MODE must be one of {", ".join(MODES)}')
+        self.mode = mode
+        self.pid = os.getpid()
+        self.rates = RateTable(rate_limit, rate_window, table_size) if rate_limit > 0 else None
+
+    def classify(self, ip_address, user_agent, headers=None, method='GET'):
+        if method == 'HEAD':
+            return HEAD
+        if headers is not None and is_prefetch(headers):
+            return PREFETCH
+        if is_bot_agent(user_agent):
+            return AGENT
+        if self.rates is not None and self.rates.hit(ip_address):
+            return RATE
+        return None
+
+
+def get_click_filter():
+    """Return this worker's click filter, creating it on first use."""
+    click_filter = current_app.extensions.get('click_filter')
+    if click_filter is None or click_filter.pid != os.getpid():
+        config = current_app.config
+        click_filter = ClickFilter(
+            mode=config['CLICK_FILTER_MODE'],
+            rate_limit=config['CLICK_FILTER_RATE_LIMIT'],
+            rate_window=config['CLICK_FILTER_RATE_WINDOW'],
+            table_size=config['CLICK_FILTER_TABLE_SIZE']
+        )
+        current_app.extensions['click_filter'] = click_filter
+    return click_filter
@@ -0,0 +1,246 @@
+import glob
+import json
+import logging
+import os
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('block', 'drop', 'spill')
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ClickQueue:
+    """
+    Bounded in-memory buffer of click rows with a background flusher.
+
+    Redirects call put() and return immediately; a daemon thread writes the
+    buffered rows with a single executemany() per transaction once
+    batch_size rows are waiting or flush_interval seconds have passed.
+
+    When the buffer is full, `overflow` decides what happens to new clicks:
+      - 'block': wait up to block_timeout seconds for room, then drop
+      - 'drop':  discard the click
+      - 'spill': append it to a JSON-lines file in spill_dir, which the
+                 flusher loads back into the database once it catches up
+
+    `connect` is a zero-argument callable returning a new sqlite3
+    connection and `insert` is called as insert(db, rows) inside a
+    transaction; the queue commits.
+    """
+
+    def __init__(self, connect, insert, batch_size=500, flush_interval=0.25,
+                 max_size=10000, overflow='block', block_timeout=1.0, spill_dir=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown click queue overflow policy: {overflow!r}")
+        if overflow == 'spill' and not spill_dir:
+            raise ValueError("The 'spill' overflow policy requires a spill directory")
+
+        self._connect = connect
+        self._insert = insert
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.spill_dir = spill_dir
+
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._spill_lock = threading.Lock()
+        self._stopping = False
+        self._thread = None
+        self._db = None
+        self.pid = os.getpid()
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.flush_errors = 0
+
+    @property
+    def spill_path(self):
+        return os.path.join(self.spill_dir, f'clicks-{self.pid}.jsonl')
+
+    def start(self):
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='click-flusher', daemon=True)
+        self._thread.start()
+
+    def put(self, row):
+        """Queue one click row. Never raises on overflow; see `overflow`."""
+        with self._cond:
+            if self._stopping:
+                overflowed = True
+            elif len(self._buffer) < self.max_size:
+                overflowed = False
+            elif self.overflow == 'block':
+                overflowed = not self._cond.wait_for(
+                    lambda: len(self._buffer) < self.max_size or self._stopping,
+                    timeout=self.block_timeout
+                ) or self._stopping
+            else:
+                overflowed = True
+
+            if not overflowed:
+                self._buffer.append(row)
+                self.enqueued += 1
+                if len(self._buffer) >= self.batch_size:
+                    self._cond.notify_all()
+                return
+
+        if self.overflow == 'spill':
+            self._spill([row])
+        else:
+            self.dropped += 1
+
+    def depth(self):
+        return len(self._buffer)
+
+    def stats(self):
+        return {
+            'depth': len(self._buffer),
+            'max_size': self.max_size,
+            'enqueued': self.enqueued,
+            'written': self.written,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'flush_errors': self.flush_errors,
+        }
+
+    def close(self, timeout=10.0):
+        """Stop accepting clicks and write out everything still buffered."""
+        with self._cond:
+            if self._stopping:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _take_batch(self):
+        batch = []
+        while self._buffer and len(batch) < self.batch_size:
+            batch.append(self._buffer.popleft())
+        self._cond.notify_all()
+        return batch
+
+    def _run(self):
+        self._load_spilled(orphans=True)
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._buffer) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                batch = self._take_batch()
+                stopping = self._stopping
+
+            if batch:
+                if not self._write(batch):
+                    if self.spill_dir:
+                        self._spill(batch)
+                    else:
+                        self.dropped += len(batch)
+            elif self.spill_dir:
+                self._load_spilled()
+
+            if stopping and not self._buffer:
+                break
+
+        self._load_spilled()
+
+    def _get_db(self):
+        if self._db is None:
+            self._db = self._connect()
+        return self._db
+
+    def _write(self, rows):
+        try:
+            db = self._get_db()
+            with db:
+                self._insert(db, rows)
+            self.written += len(rows)
+            return True
+        except Exception:
+            self.flush_errors += 1
+            logger.exception(f"Failed to write {len(rows)} clicks")
+            return False
+
+    def _spill(self, rows, count=True):
+        if not rows:
+            return
+        with self._spill_lock:
+            try:
+                with open(self.spill_path, 'a') as f:
+                    for row in rows:
+                        f.write(json.dumps(row) + '\n')
+                if count:
+                    self.spilled += len(rows)
+            except OSError:
+                logger.exception(f"Failed to spill {len(rows)} clicks to {self.spill_path}")
+                self.dropped += len(rows)
+
+    def _load_spilled(self, orphans=False):
+        """
+        Write spilled clicks back to the database. Normally only this
+        worker's own spill file is loaded; with orphans=True, files left
+        behind by workers that are no longer running are loaded too, as are
+        files a worker had claimed for loading when it died. Clicks from a
+        claimed file that were written before the crash are written again.
+        """
+        if not self.spill_dir:
+            return
+
+        paths = [self.spill_path]
+        if orphans:
+            for path in glob.glob(os.path.join(self.spill_dir, 'clicks-*.jsonl')):
+                try:
+                    pid = int(os.path.basename(path)[len('clicks-'):-len('.jsonl')])
+                except ValueError:
+                    continue
+                if pid != self.pid and not _pid_alive(pid):
+                    paths.append(path)
+            # Only called before this worker loads anything, so a claim
+            # under its own pid is a leftover from an earlier process
+            for path in glob.glob(os.path.join(self.spill_dir, 'clicks-*.jsonl.*.loading')):
+                try:
+                    pid = int(path.rsplit('.', 2)[1])
+                except ValueError:
+                    continue
+                if pid == self.pid or not _pid_alive(pid):
+                    paths.append(path)
+
+        for path in paths:
+            with self._spill_lock:
+                if not os.path.exists(path):
+                    continue
+                spilled = path[:path.index('.jsonl') + len('.jsonl')]
+                claimed = f'{spilled}.{self.pid}.loading'
+                try:
+                    if path != claimed:
+                        os.rename(path, claimed)
+                except OSError:
+                    continue
+
+            with open(claimed) as f:
+                rows = [tuple(json.loads(line)) for line in f if line.strip()]
+            for i in range(0, len(rows), self.batch_size):
+                if not self._write(rows[i:i + self.batch_size]):
+                    # Still failing; put the rest back for the next attempt
+                    self._spill(rows[i:], count=False)
+                    break
+            os.remove(claimed)
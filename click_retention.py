@@ -0,0 +1,161 @@
+"""
+Click retention: keeps the raw `clicks` table down to a rolling window.
+
+Whole calendar months older than the retention window are written to
+gzip-compressed JSON-lines files (one per month) and then deleted in small
+batches. Their rollups (totals, hourly and daily counts) stay, so the
+admin listing and stats pages are unaffected. Each batch is its own short
+write transaction, so redirects recording clicks are never blocked for
+long.
+
+Raw clicks and visitors of deleted links (see database.forget_link_clicks)
+are purged the same way.
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+CLICK_FIELDS = ('id', 'short_link', 'ip_address', 'user_agent', 'referer', 'clicked_at', 'is_bot')
+
+
+def _month_bounds(month):
+    """'YYYY-MM' -> ('YYYY-MM-01', first day of the next month)."""
+    start = datetime.datetime.strptime(month, '%Y-%m')
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+
+def months_to_archive(db, retention_days, now=None):
+    """Months with raw clicks whose every day is older than retention_days."""
+    now = now or datetime.datetime.utcnow()
+    cutoff = (now - datetime.timedelta(days=retention_days)).replace(day=1).strftime('%Y-%m-%d')
+    months = []
+    start = ''
+    while True:
+        # Jump straight to the next month that has clicks, via the index
+        oldest = db.execute('SELECT MIN(clicked_at) FROM clicks WHERE clicked_at >= ?',
+                            (start,)).fetchone()[0]
+        if oldest is None or oldest >= cutoff:
+            return months
+        months.append(oldest[:7])
+        start = _month_bounds(oldest[:7])[1]
+
+
+def _delete_in_batches(db, delete_sql, params, batch_size, pause):
+    """Run a `... LIMIT ?` delete repeatedly, one short transaction each."""
+    deleted = 0
+    while True:
+        with db:
+            count = db.execute(delete_sql, params + (batch_size,)).rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+        time.sleep(pause)
+
+
+def archive_month(db, month, archive_dir, batch_size=5000, pause=0.05):
+    """
+    Archive and delete one month of raw clicks. Returns the number of
+    clicks archived, or None if the month was already done. Safe to re-run
+    after an interruption: a logged month is not re-exported, only its
+    remaining rows deleted.
+    """
+    start, end = _month_bounds(month)
+    logged = db.execute('SELECT path, completed_at FROM click_archive_log WHERE month = ?',
+                        (month,)).fetchone()
+    if logged is not None and logged['completed_at'] is not None:
+        return None
+
+    if logged is None:
+        os.makedirs(archive_dir, exist_ok=True)
+        path = os.path.join(archive_dir, f'clicks-{month}.jsonl.gz')
+        tmp_path = path + '.tmp'
+        count = 0
+        last_id = 0
+        # Read in id order, in chunks, outside any write transaction
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as out:
+            while True:
+                rows = db.execute(f'''
+                    SELECT {', '.join(CLICK_FIELDS)}
+                    FROM clicks
+                    WHERE clicked_at >= ? AND clicked_at < ? AND id > ?
+                    ORDER BY id
+                    LIMIT ?
+                ''', (start, end, last_id, batch_size)).fetchall()
+                for row in rows:
+                    out.write(json.dumps(dict(row), separators=(',', ':')) + '\n')
+                count += len(rows)
+                if len(rows) < batch_size:
+                    break
+                last_id = rows[-1]['id']
+        os.replace(tmp_path, path)
+        with db:
+            db.execute('''
+                INSERT INTO click_archive_log (month, path, clicks)
+                VALUES (?, ?, ?)
+            ''', (month, path, count))
+        logger.info(f'Archived {count} clicks from {month} to {path}')
+    else:
+        count = db.execute('SELECT clicks FROM click_archive_log WHERE month = ?',
+                           (month,)).fetchone()[0]
+
+    _delete_in_batches(db, '''
+        DELETE FROM clicks WHERE id IN (
+            SELECT id FROM clicks
+            WHERE clicked_at >= ? AND clicked_at < ?
+            LIMIT ?
+        )
+    ''', (start, end), batch_size, pause)
+    with db:
+        db.execute('UPDATE click_archive_log SET completed_at = CURRENT_TIMESTAMP WHERE month = ?',
+                   (month,))
+    return count
+
+
+def purge_deleted_links(db, batch_size=5000, pause=0.05):
+    """
+    Delete the raw clicks recorded before each tombstone, and any visitor
+    rows left by links deleted before forget_link_clicks() removed them,
+    then the tombstone itself. Returns the number of clicks removed.
+    """
+    purged = 0
+    tombstones = db.execute('SELECT short_link, deleted_at FROM link_tombstones').fetchall()
+    for tombstone in tombstones:
+        params = (tombstone['short_link'], tombstone['deleted_at'])
+        purged += _delete_in_batches(db, '''
+            DELETE FROM clicks WHERE id IN (
+                SELECT id FROM clicks
+                WHERE short_link = ? AND clicked_at <= ?
+                LIMIT ?
+            )
+        ''', params, batch_size, pause)
+        _delete_in_batches(db, '''
+            DELETE FROM link_visitors
+            WHERE short_link = ?1 AND ip_address IN (
+                SELECT ip_address FROM link_visitors
+                WHERE short_link = ?1 AND first_seen <= ?2
+                LIMIT ?3
+            )
+        ''', params, batch_size, pause)
+        with db:
+            db.execute('DELETE FROM link_tombstones WHERE short_link = ? AND deleted_at = ?', params)
+    return purged
+
+
+def run_retention(db, retention_days, archive_dir, batch_size=5000, pause=0.05):
+    """
+    One pass of the retention job: purge deleted links' clicks, then
+    archive every month past the window if retention_days is set.
+    """
+    report = {'purged': purge_deleted_links(db, batch_size, pause), 'archived': {}}
+    if retention_days:
+        for month in months_to_archive(db, retention_days):
+            count = archive_month(db, month, archive_dir, batch_size, pause)
+            if count is not None:
+                report['archived'][month] = count
+    return report
@@ -0,0 +1,182 @@
+"""
+Click time series, referer / user-agent breakdowns and top links, read
+from the pre-bucketed rollup tables that database.update_rollups()
+maintains as clicks are recorded, never from the raw `clicks` table.
+
+Hourly counts live in link_click_hourly and daily counts in
+link_click_daily; weeks (starting on Monday) and months are summed from
+the daily counts, so any date range can be charted at any granularity.
+All times are UTC.
+"""
+import datetime
+import re
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+from click_filter import BOT_AGENT_PATTERN
+
+GRANULARITIES = ('hour', 'day', 'week', 'month')
+
+# Breakdown name -> (rollup table, key column)
+BREAKDOWNS = {
+    'referer': ('link_click_referers', 'referer_host'),
+    'agent': ('link_click_agents', 'agent_family'),
+}
+
+# Days charted when the request gives no start date
+DEFAULT_SPANS = {'hour': 2, 'day': 30, 'week': 26 * 7, 'month': 365}
+
+# Largest series returned in one response; page through longer ranges
+MAX_POINTS = 2000
+
+# First match wins, so more specific browsers come before the engines
+# they build on (Edge and Opera before Chrome, Chrome before Safari)
+AGENT_FAMILIES = (
+    ('Bot', BOT_AGENT_PATTERN),
+    ('Edge', re.compile(r'Edg(?:e|A|iOS)?/')),
+    ('Opera', re.compile(r'OPR/|Opera')),
+    ('Samsung Internet', re.compile(r'SamsungBrowser/')),
+    ('Chrome', re.compile(r'Chrome/|CriOS/')),
+    ('Firefox', re.compile(r'Firefox/|FxiOS/')),
+    ('Safari', re.compile(r'Safari/')),
+    ('Internet Explorer', re.compile(r'MSIE |Trident/')),
+)
+
+
+@lru_cache(maxsize=4096)
+def agent_family(user_agent):
+    """Browser family of a User-Agent header, e.g. 'Chrome', 'Bot' or 'Other'."""
+    if not user_agent:
+        return 'Unknown'
+    for family, pattern in AGENT_FAMILIES:
+        if pattern.search(user_agent):
+            return family
+    return 'Other'
+
+
+def referer_host(referer):
+    """Host name of a Referer header; '' for direct visits and garbage."""
+    if not referer:
+        return ''
+    try:
+        return (urlsplit(referer).hostname or '')[:255]
+    except ValueError:
+        return ''
+
+
+def parse_range(start, end, granularity, today=None):
+    """
+    Turn optional 'YYYY-MM-DD' start and end strings into inclusive dates.
+    Missing ends default to today and DEFAULT_SPANS days before it.
+    Raises ValueError for bad dates or ranges over MAX_POINTS buckets.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'Unknown granularity: {granularity!r}')
+    try:
+        end = datetime.date.fromisoformat(end) if end else (today or datetime.datetime.utcnow().date())
+        start = (datetime.date.fromisoformat(start) if start
+                 else end - datetime.timedelta(days=DEFAULT_SPANS[granularity] - 1))
+    except ValueError:
+        raise ValueError('Dates must be YYYY-MM-DD')
+    if start > end:
+        raise ValueError('from is after to')
+    if _bucket_count(start, end, granularity) > MAX_POINTS:
+        raise ValueError(f'Range has more than {MAX_POINTS} {granularity}s')
+    return start, end
+
+
+def _bucket(day, granularity):
+    """Label of the bucket that a date falls in."""
+    if granularity == 'week':
+        return (day - datetime.timedelta(days=day.weekday())).isoformat()
+    if granularity == 'month':
+        return day.isoformat()[:7]
+    return day.isoformat()
+
+
+def _bucket_count(start, end, granularity):
+    days = (end - start).days + 1
+    if granularity == 'hour':
+        return days * 24
+    if granularity == 'week':
+        return (days + start.weekday() + 6) // 7
+    if granularity == 'month':
+        return (end.year - start.year) * 12 + end.month - start.month + 1
+    return days
+
+
+def _buckets(start, end, granularity):
+    """Every bucket label from start to end, so series have no gaps."""
+    days = (end - start).days + 1
+    if granularity == 'hour':
+        return [f'{start + datetime.timedelta(days=i)} {hour:02d}'
+                for i in range(days) for hour in range(24)]
+    labels = []
+    for i in range(days):
+        label = _bucket(start + datetime.timedelta(days=i), granularity)
+        if not labels or labels[-1] != label:
+            labels.append(label)
+    return labels
+
+
+def click_series(db, short_link, granularity, start, end):
+    """
+    Clicks per bucket between two dates (inclusive), as a list of
+    {'t': label, 'clicks': n} with zeros for empty buckets. Labels are
+    'YYYY-MM-DD HH' for hours, the day for days, the Monday for weeks
+    and 'YYYY-MM' for months.
+    """
+    counts = dict.fromkeys(_buckets(start, end, granularity), 0)
+    if granularity == 'hour':
+        rows = db.execute('''
+            SELECT hour, clicks FROM link_click_hourly
+            WHERE short_link = ? AND hour BETWEEN ? AND ?
+        ''', (short_link, f'{start} 00', f'{end} 23')).fetchall()
+        for hour, clicks in rows:
+            counts[hour] += clicks
+    else:
+        rows = db.execute('''
+            SELECT day, clicks FROM link_click_daily
+            WHERE short_link = ? AND day BETWEEN ? AND ?
+        ''', (short_link, start.isoformat(), end.isoformat())).fetchall()
+        for day, clicks in rows:
+            counts[_bucket(datetime.date.fromisoformat(day), granularity)] += clicks
+    return [{'t': label, 'clicks': clicks} for label, clicks in counts.items()]
+
+
+def click_breakdown(db, short_link, by, start, end, limit=10):
+    """
+    Clicks between two dates by referer host or user-agent family: the
+    `limit` largest as {'key', 'clicks'} items, plus the sum of the rest.
+    """
+    table, column = BREAKDOWNS[by]
+    rows = db.execute(f'''
+        SELECT {column}, SUM(clicks) AS clicks FROM {table}
+        WHERE short_link = ? AND day BETWEEN ? AND ?
+        GROUP BY {column}
+        ORDER BY clicks DESC, {column}
+    ''', (short_link, start.isoformat(), end.isoformat())).fetchall()
+    return {
+        'items': [{'key': key, 'clicks': clicks} for key, clicks in rows[:limit]],
+        'other': sum(clicks for _key, clicks in rows[limit:]),
+    }
+
+
+def top_links(db, start=None, end=None, limit=10):
+    """The `limit` most-clicked links, over all time or between two dates."""
+    if start is None and end is None:
+        rows = db.execute('''
+            SELECT short_link, total_clicks FROM link_click_totals
+            ORDER BY total_clicks DESC, short_link
+            LIMIT ?
+        ''', (limit,)).fetchall()
+    else:
+        rows = db.execute('''
+            SELECT short_link, SUM(clicks) AS clicks FROM link_click_daily
+            WHERE day BETWEEN ? AND ?
+            GROUP BY short_link
+            ORDER BY clicks DESC, short_link
+            LIMIT ?
+        ''', ((start or datetime.date.min).isoformat(), (end or datetime.date.max).isoformat(),
+              limit)).fetchall()
+    return [{'short_link': short_link, 'clicks': clicks} for short_link, clicks in rows]
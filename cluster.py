@@ -0,0 +1,479 @@
+"""
+Multi-node deployments: every node keeps serving redirects from its own
+SQLite database, which is kept in step with the other nodes through a
+shared hub database (PostgreSQL, or an SQLite file on shared storage).
+
+The hub holds the current links (hub_links), an append-only feed of link
+changes (hub_link_changes) and every node's clicks (hub_clicks). One
+worker per node, the one holding the node's sync lock, runs NodeSync,
+which every CLUSTER_SYNC_INTERVAL seconds:
+
+1. publishes local link changes, queued in link_outbox by triggers on
+   the links table, as their current rows (or deletions);
+2. ships clicks recorded on this node;
+3. applies other nodes' link changes through commit_link_changes(), so
+   every worker's link cache picks them up on its next generation check;
+4. merges other nodes' clicks into the local clicks and rollup tables.
+
+The last writer in feed order wins. Link changes still waiting in the
+outbox take precedence over incoming ones, and go out on the next pass.
+Uploaded files are not copied; UPLOAD_FOLDER must be shared storage.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+
+from database import begin_write, commit_link_changes, forget_link_clicks, get_pool, insert_clicks
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+HUB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hub_links (
+    short_link TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_by TEXT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS hub_link_changes (
+    id {id_type},
+    short_link TEXT NOT NULL,
+    data TEXT,
+    node_id TEXT NOT NULL,
+    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS hub_clicks (
+    id {id_type},
+    node_id TEXT NOT NULL,
+    local_id BIGINT NOT NULL,
+    short_link TEXT NOT NULL,
+    ip_address TEXT NOT NULL,
+    user_agent TEXT,
+    referer TEXT,
+    clicked_at TEXT NOT NULL,
+    UNIQUE (node_id, local_id)
+);
+CREATE TABLE IF NOT EXISTS hub_counters (
+    name TEXT PRIMARY KEY,
+    next_id BIGINT NOT NULL
+);
+'''
+
+
+class Hub:
+    """
+    The shared database. Subclasses provide the connection, the id column
+    type and how to serialize writers, so readers following a feed by id
+    never skip a row that commits late.
+    """
+
+    id_type = None
+
+    def _execute(self, cursor, sql, params=()):
+        cursor.execute(sql, params)
+
+    def _executemany(self, cursor, sql, rows):
+        cursor.executemany(sql, rows)
+
+    def setup(self):
+        with self.transaction() as cursor:
+            for statement in HUB_SCHEMA.format(id_type=self.id_type).split(';'):
+                if statement.strip():
+                    self._execute(cursor, statement)
+
+    def publish_links(self, node_id, changes):
+        """Store (short_link, data) pairs, data None for deletions, and feed them."""
+        with self.transaction(lock='hub_link_changes') as cursor:
+            for short_link, data in changes:
+                if data is None:
+                    self._execute(cursor, 'DELETE FROM hub_links WHERE short_link = ?', (short_link,))
+                else:
+                    self._execute(cursor, '''
+                        INSERT INTO hub_links (short_link, data, updated_by, updated_at)
+                        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                        ON CONFLICT (short_link) DO UPDATE SET
+                            data = excluded.data,
+                            updated_by = excluded.updated_by,
+                            updated_at = excluded.updated_at
+                    ''', (short_link, data, node_id))
+            self._executemany(cursor, '''
+                INSERT INTO hub_link_changes (short_link, data, node_id) VALUES (?, ?, ?)
+            ''', [(short_link, data, node_id) for short_link, data in changes])
+
+    def link_changes(self, after, limit):
+        """Feed entries (id, short_link, data, node_id) after `after`, in order."""
+        with self.transaction() as cursor:
+            self._execute(cursor, '''
+                SELECT id, short_link, data, node_id FROM hub_link_changes
+                WHERE id > ? ORDER BY id LIMIT ?
+            ''', (after, limit))
+            return cursor.fetchall()
+
+    def publish_clicks(self, node_id, rows):
+        """Store (local_id, short_link, ip_address, user_agent, referer, clicked_at) rows."""
+        with self.transaction(lock='hub_clicks') as cursor:
+            self._executemany(cursor, '''
+                INSERT INTO hub_clicks
+                    (node_id, local_id, short_link, ip_address, user_agent, referer, clicked_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (node_id, local_id) DO NOTHING
+            ''', [(node_id,) + tuple(row) for row in rows])
+
+    def clicks(self, node_id, after, limit):
+        """Other nodes' clicks after `after`: (id, node_id, short_link, ip_address, user_agent, referer, clicked_at)."""
+        with self.transaction() as cursor:
+            self._execute(cursor, '''
+                SELECT id, node_id, short_link, ip_address, user_agent, referer, clicked_at
+                FROM hub_clicks
+                WHERE id > ? AND node_id <> ?
+                ORDER BY id LIMIT ?
+            ''', (after, node_id, limit))
+            return cursor.fetchall()
+
+    def reserve_ids(self, name, count, floor=0):
+        """Reserve `count` values of a shared counter, none below `floor`; returns the first."""
+        with self.transaction(lock='hub_counters') as cursor:
+            self._execute(cursor, 'SELECT next_id FROM hub_counters WHERE name = ?', (name,))
+            row = cursor.fetchone()
+            start = max(row[0] if row else 0, floor)
+            self._execute(cursor, '''
+                INSERT INTO hub_counters (name, next_id) VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET next_id = excluded.next_id
+            ''', (name, start + count))
+        return start
+
+
+class SqliteHub(Hub):
+    """A hub in an SQLite file, for nodes sharing a volume (and for testing)."""
+
+    id_type = 'INTEGER PRIMARY KEY AUTOINCREMENT'
+
+    def __init__(self, path, busy_timeout=30):
+        self.conn = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None,
+                                    check_same_thread=False)
+
+    @contextmanager
+    def transaction(self, lock=None):
+        # BEGIN IMMEDIATE serializes writers, so ids commit in order
+        cursor = self.conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE' if lock else 'BEGIN')
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+
+    def close(self):
+        self.conn.close()
+
+
+class PostgresHub(Hub):
+    """
+    A hub in PostgreSQL, through psycopg 3. Experimental: it has not been
+    run against a live server yet; SqliteHub is the tested backend.
+    """
+
+    id_type = 'BIGSERIAL PRIMARY KEY'
+
+    def __init__(self, dsn):
+        try:
+            import psycopg
+        except ImportError:
+            raise RuntimeError('A PostgreSQL CLUSTER_HUB_URL needs psycopg: pip install "psycopg[binary]"')
+        self.conn = psycopg.connect(dsn, autocommit=True)
+
+    def _execute(self, cursor, sql, params=()):
+        cursor.execute(sql.replace('?', '%s'), params)
+
+    def _executemany(self, cursor, sql, rows):
+        cursor.executemany(sql.replace('?', '%s'), rows)
+
+    @contextmanager
+    def transaction(self, lock=None):
+        with self.conn.transaction():
+            with self.conn.cursor() as cursor:
+                if lock:
+                    # Sequence values are handed out before commit; one
+                    # writer at a time keeps feed ids in commit order
+                    cursor.execute(f'LOCK TABLE {lock} IN SHARE ROW EXCLUSIVE MODE')
+                yield cursor
+
+    def close(self):
+        self.conn.close()
+
+
+def open_hub(url):
+    """Hub for a CLUSTER_HUB_URL: postgresql://... or sqlite:///path/to/hub.db."""
+    if url.startswith(('postgresql://', 'postgres://')):
+        hub = PostgresHub(url)
+    elif url.startswith('sqlite:///'):
+        hub = SqliteHub(url[len('sqlite:///'):])
+    else:
+        raise ValueError(f'Unsupported CLUSTER_HUB_URL: {url!r}')
+    hub.setup()
+    return hub
+
+
+def join_cluster(db, node_id=None):
+    """
+    Record this node's id, which turns on the link_outbox triggers, and
+    return it. On first joining, every existing link is queued for
+    publishing and every click recorded so far will be shipped.
+
+    The id is kept for good: the hub tells a node's own changes and clicks
+    apart by it, so a node that came back under another id would pull its
+    own clicks back in. Without `node_id` one is generated on first
+    joining; a `node_id` that differs from the recorded one is refused.
+    """
+    row = db.execute('SELECT node_id FROM node_sync WHERE id = 1').fetchone()
+    if row['node_id'] is not None:
+        if node_id and node_id != row['node_id']:
+            raise RuntimeError(f"NODE_ID is {node_id!r}, but this node joined the "
+                               f"cluster as {row['node_id']!r}")
+        return row['node_id']
+    node_id = node_id or uuid.uuid4().hex
+    begin_write(db)
+    db.execute('INSERT INTO link_outbox (short_link) SELECT short_link FROM links')
+    db.execute('UPDATE node_sync SET node_id = ? WHERE id = 1', (node_id,))
+    db.commit()
+    return node_id
+
+
+def _link_columns(db):
+    return [row[1] for row in db.execute('PRAGMA table_info(links)')]
+
+
+def push_links(db, hub, node_id, batch_size):
+    """Publish queued link changes. Returns how many links were published."""
+    queued = db.execute('SELECT id, short_link FROM link_outbox ORDER BY id LIMIT ?',
+                        (batch_size,)).fetchall()
+    if not queued:
+        return 0
+    changes = []
+    for short_link in dict.fromkeys(row['short_link'] for row in queued):
+        row = db.execute('SELECT * FROM links WHERE short_link = ?', (short_link,)).fetchone()
+        changes.append((short_link, json.dumps(dict(row), separators=(',', ':')) if row else None))
+    hub.publish_links(node_id, changes)
+    with db:
+        db.execute('DELETE FROM link_outbox WHERE id <= ?', (queued[-1]['id'],))
+    return len(changes)
+
+
+def _register_blob(db, digest, path):
+    """
+    Give a pulled file link's blob a row here, as commit_blob() does for
+    local uploads, so the link counts towards its refcount and removing a
+    local link to the same content can't take the file with it.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0  # Not on the shared UPLOAD_FOLDER yet
+    db.execute('''
+        INSERT OR IGNORE INTO blobs (digest, path, size)
+        VALUES (?, ?, ?)
+    ''', (digest, path, size))
+
+
+def pull_links(db, hub, node_id, batch_size):
+    """Apply other nodes' link changes. Returns how many links changed."""
+    after = db.execute('SELECT links_pulled FROM node_sync WHERE id = 1').fetchone()[0]
+    entries = hub.link_changes(after, batch_size)
+    if not entries:
+        return 0
+
+    # Only the newest entry per link matters; our own are already applied
+    latest = {}
+    for _id, short_link, data, origin in entries:
+        latest[short_link] = (data, origin)
+    begin_write(db)
+    pending = {row[0] for row in db.execute('SELECT DISTINCT short_link FROM link_outbox')}
+    outbox_end = db.execute('SELECT COALESCE(MAX(id), 0) FROM link_outbox').fetchone()[0]
+    columns = set(_link_columns(db))
+    applied = 0
+    for short_link, (data, origin) in latest.items():
+        if origin == node_id or short_link in pending:
+            continue
+        if data is None:
+            if db.execute('DELETE FROM links WHERE short_link = ?', (short_link,)).rowcount:
+                forget_link_clicks(db, short_link)
+        else:
+            link = {key: value for key, value in json.loads(data).items() if key in columns}
+            if link.get('blob_digest'):
+                _register_blob(db, link['blob_digest'], link['target_url'])
+            db.execute(f'''
+                INSERT OR REPLACE INTO links ({', '.join(link)})
+                VALUES ({', '.join('?' * len(link))})
+            ''', tuple(link.values()))
+        applied += 1
+    # The triggers queued what we just applied; it isn't ours to publish
+    db.execute('DELETE FROM link_outbox WHERE id > ?', (outbox_end,))
+    db.execute('UPDATE node_sync SET links_pulled = ? WHERE id = 1', (entries[-1][0],))
+    if applied:
+        commit_link_changes(db)
+    else:
+        db.commit()
+    return applied
+
+
+def push_clicks(db, hub, node_id, batch_size):
+    """Ship clicks recorded on this node. Returns how many were shipped."""
+    after = db.execute('SELECT clicks_pushed FROM node_sync WHERE id = 1').fetchone()[0]
+    rows = db.execute('''
+        SELECT id, short_link, ip_address, user_agent, referer, clicked_at FROM clicks
+        WHERE id > ? AND node_id IS NULL AND is_bot = 0
+        ORDER BY id LIMIT ?
+    ''', (after, batch_size)).fetchall()
+    if not rows:
+        return 0
+    hub.publish_clicks(node_id, [tuple(row) for row in rows])
+    with db:
+        db.execute('UPDATE node_sync SET clicks_pushed = ? WHERE id = 1', (rows[-1]['id'],))
+    return len(rows)
+
+
+def pull_clicks(db, hub, node_id, batch_size, exact_visitors=True):
+    """Merge other nodes' clicks into the local tables. Returns how many."""
+    after = db.execute('SELECT clicks_pulled FROM node_sync WHERE id = 1').fetchone()[0]
+    rows = hub.clicks(node_id, after, batch_size)
+    if not rows:
+        return 0
+    by_node = {}
+    for _id, origin, *click in rows:
+        by_node.setdefault(origin, []).append(tuple(click))
+    begin_write(db)
+    for origin, clicks in by_node.items():
+        insert_clicks(db, clicks, exact_visitors, node_id=origin)
+    db.execute('UPDATE node_sync SET clicks_pulled = ? WHERE id = 1', (rows[-1][0],))
+    db.commit()
+    return len(rows)
+
+
+def sync_once(db, hub, node_id, batch_size=1000, exact_visitors=True):
+    """One full pass, looping until every step has caught up."""
+    report = {'links_pushed': 0, 'clicks_pushed': 0, 'links_pulled': 0, 'clicks_pulled': 0}
+    node_id = join_cluster(db, node_id)
+    steps = (
+        ('links_pushed', push_links, {}),
+        ('clicks_pushed', push_clicks, {}),
+        ('links_pulled', pull_links, {}),
+        ('clicks_pulled', pull_clicks, {'exact_visitors': exact_visitors}),
+    )
+    for key, step, kwargs in steps:
+        while True:
+            count = step(db, hub, node_id, batch_size, **kwargs)
+            report[key] += count
+            if count < batch_size:
+                break
+    return report
+
+
+class NodeSync:
+    """
+    Background thread that keeps this node in sync with the hub. Every
+    worker starts one; only the worker holding the node's sync lock
+    (next to the database) does any work, and another takes over when it
+    exits. It uses its own database connection rather than the worker's
+    pooled writer, and only writes to it between hub round trips, so a
+    slow hub never holds up the worker's requests or click flushes.
+    """
+
+    def __init__(self, app, hub_url, node_id, interval=2.0, batch_size=1000):
+        self.app = app
+        self.hub_url = hub_url
+        self.node_id = node_id
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pid = os.getpid()
+        self._hub = None
+        self._db = None
+        self._lock_file = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='node-sync', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _acquire_leadership(self):
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.app.config['DATABASE_PATH'] + '.sync-lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def sync(self):
+        if self._hub is None:
+            self._hub = open_hub(self.hub_url)
+        if self._db is None:
+            self._db = get_pool(self.app).connect()
+        with self.app.app_context():
+            report = sync_once(self._db, self._hub, self.node_id, self.batch_size,
+                               self.app.config['UNIQUE_VISITOR_MODE'] == 'exact')
+            metrics = get_metrics()
+            for key, count in report.items():
+                if count:
+                    metrics.inc('cluster_sync_rows_total', count, (('kind', key),))
+        return report
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self._acquire_leadership():
+                    self.sync()
+            except Exception:
+                get_metrics(self.app).inc('cluster_sync_errors_total')
+                logger.exception('Cluster sync failed')
+                # Reconnect on the next pass
+                self._disconnect()
+            self._stop.wait(self.interval)
+
+    def _disconnect(self):
+        for name in ('_hub', '_db'):
+            conn = getattr(self, name)
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                setattr(self, name, None)
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=self.interval + 5)
+        self._disconnect()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+def get_node_sync(app):
+    """Return this worker's NodeSync, starting it on first use."""
+    node_sync = app.extensions.get('node_sync')
+    if node_sync is None or node_sync.pid != os.getpid():
+        config = app.config
+        node_sync = NodeSync(app, config['CLUSTER_HUB_URL'], config['NODE_ID'],
+                             config['CLUSTER_SYNC_INTERVAL'], config['CLUSTER_SYNC_BATCH_SIZE'])
+        node_sync.start()
+        atexit.register(node_sync.close)
+        app.extensions['node_sync'] = node_sync
+    return node_sync
+
+
+def stop_node_sync(app):
+    """Stop this worker's sync thread and release the node's sync lock."""
+    node_sync = app.extensions.get('node_sync')
+    if node_sync is not None and node_sync.pid == os.getpid():
+        node_sync.close()
@@ -0,0 +1,145 @@
+"""
+Server-generated short codes.
+
+Codes are numbers from a shared counter, written in base62 at a fixed
+length and then scrambled, so codes for consecutive numbers look
+unrelated: no prefix or position is shared more often than by chance.
+The scrambling is a bijection on codes of one length, so distinct
+numbers always give distinct codes. Each worker reserves a block of
+numbers at a time from the code_counter table (or the cluster hub), so
+handing out a code is normally an increment in memory, with no database
+round trip and no collisions between workers. Numbers left in a block
+when its worker exits are skipped.
+
+A generated code can still clash with a link whose short_link was chosen
+by hand; callers insert without replacing and ask for another code.
+"""
+import os
+import string
+import threading
+
+from flask import current_app
+
+import cluster
+from database import get_pool
+
+ALPHABET = string.digits + string.ascii_letters
+BASE = len(ALPHABET)
+
+# Constants of the multiplicative hash that drives the scrambling
+MULTIPLIER = 2654435761
+OFFSET = 1013904223
+SCRAMBLE_ROUNDS = 3
+
+# hub_counters row shared by every node of a cluster
+HUB_COUNTER = 'short_codes'
+
+
+def encode_base62(number, length):
+    digits = []
+    for _ in range(length):
+        number, digit = divmod(number, BASE)
+        digits.append(ALPHABET[digit])
+    return ''.join(reversed(digits))
+
+
+def _scramble_digits(digits, rounds=SCRAMBLE_ROUNDS):
+    """
+    Scramble a list of base62 digit values in place. Each step adds to one
+    digit a hash of all the others, which can be undone by subtracting the
+    same hash, so the whole is a bijection. A change to any digit feeds
+    into every digit's hash from the first round on.
+    """
+    for round_number in range(rounds):
+        for i in range(len(digits)):
+            others = round_number * len(digits) + i
+            for j, digit in enumerate(digits):
+                if j != i:
+                    others = others * BASE + digit
+            key = ((others * MULTIPLIER + OFFSET) & 0xffffffff) >> 16
+            digits[i] = (digits[i] + key) % BASE
+    return digits
+
+
+def number_to_code(number, length):
+    if number >= BASE ** length:
+        raise RuntimeError(f'All {length}-character short codes are used; raise SHORT_CODE_LENGTH')
+    digits = [ALPHABET.index(char) for char in encode_base62(number, length)]
+    return ''.join(ALPHABET[digit] for digit in _scramble_digits(digits))
+
+
+def reserve_numbers(connect, count, hub_url=''):
+    """
+    Reserve `count` consecutive counter values and return the first. With
+    a cluster hub the hub's counter is used, never going below this
+    node's, so codes stay unique across nodes.
+    """
+    db = connect()
+    try:
+        with db:
+            if not hub_url:
+                return db.execute('''
+                    UPDATE code_counter SET next_id = next_id + ? WHERE id = 1
+                    RETURNING next_id - ?
+                ''', (count, count)).fetchone()[0]
+            floor = db.execute('SELECT next_id FROM code_counter WHERE id = 1').fetchone()[0]
+            hub = cluster.open_hub(hub_url)
+            try:
+                start = hub.reserve_ids(HUB_COUNTER, count, floor)
+            finally:
+                hub.close()
+            db.execute('UPDATE code_counter SET next_id = MAX(next_id, ?) WHERE id = 1',
+                       (start + count,))
+            return start
+    finally:
+        db.close()
+
+
+class CodeAllocator:
+    """
+    Hands out short codes from blocks of counter values reserved through
+    `reserve(count)`, which returns the first value of a fresh range.
+    Thread-safe; one per worker.
+    """
+
+    def __init__(self, reserve, block_size=1000, length=7):
+        self.reserve = reserve
+        self.block_size = block_size
+        self.length = length
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+
+    def allocate(self, count=1):
+        """
+        Return `count` new codes. May reserve a block, so call it outside
+        any write transaction on the app's database.
+        """
+        numbers = []
+        with self._lock:
+            while len(numbers) < count:
+                if self._next >= self._end:
+                    size = max(self.block_size, count - len(numbers))
+                    self._next = self.reserve(size)
+                    self._end = self._next + size
+                take = min(count - len(numbers), self._end - self._next)
+                numbers.extend(range(self._next, self._next + take))
+                self._next += take
+        return [number_to_code(number, self.length) for number in numbers]
+
+
+def get_code_allocator():
+    """Return this worker's code allocator, creating it on first use."""
+    allocator = current_app.extensions.get('code_allocator')
+    if allocator is None or allocator.pid != os.getpid():
+        config = current_app.config
+        pool = get_pool()
+        hub_url = config['CLUSTER_HUB_URL']
+        allocator = CodeAllocator(
+            reserve=lambda count: reserve_numbers(pool.connect, count, hub_url),
+            block_size=config['SHORT_CODE_BLOCK_SIZE'],
+            length=config['SHORT_CODE_LENGTH']
+        )
+        current_app.extensions['code_allocator'] = allocator
+    return allocator
@@ -7,16 +7,130 @@ class Config:
     # Flask config
     SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key')
     DEBUG = os.getenv('FLASK_DEBUG', 'false').lower() == 'true'
+    # Reverse proxies (or CDN hops) in front of the app that append to
+    # X-Forwarded-For; the visitor's address is taken from that header
+    # instead of the connection. 0 trusts no forwarded headers.
+    TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', '0'))
     
     # Database paths
-    DATABASE_PATH = 'shortener.db'
+    DATABASE_PATH = os.getenv('DATABASE_PATH', 'shortener.db')
+    
+    # Create or upgrade the schema when app.py is imported. Under gunicorn,
+    # gunicorn.conf.py does it once in the master and turns this off.
+    INIT_DB_ON_STARTUP = os.getenv('INIT_DB_ON_STARTUP', 'true').lower() == 'true'
+    
+    # SQLite tuning, applied to every pooled connection
+    SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+    SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+    SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', '-20000'))  # negative = KiB
+    SQLITE_READ_POOL_SIZE = int(os.getenv('SQLITE_READ_POOL_SIZE', '4'))
     
     # Upload config
-    UPLOAD_FOLDER = 'uploads'
+    UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'uploads')
     MAX_CONTENT_LENGTH = 500 * 1024 * 1024  # 500MB
+    # Resumable uploads not finished within this many seconds are deleted
+    UPLOAD_SESSION_TTL = float(os.getenv('UPLOAD_SESSION_TTL', '86400'))
+    
+    # How file links are delivered: direct, x-sendfile or x-accel-redirect
+    FILE_DELIVERY_MODE = os.getenv('FILE_DELIVERY_MODE', 'direct')
+    # nginx `internal` location that maps onto UPLOAD_FOLDER (x-accel-redirect)
+    FILE_ACCEL_REDIRECT_PREFIX = os.getenv('FILE_ACCEL_REDIRECT_PREFIX', '/protected-uploads/')
+    
+    # Threads for link lookups and file reads when served through asgi.py
+    ASGI_THREADS = int(os.getenv('ASGI_THREADS', '32'))
+    
+    # Link cache (per worker)
+    LINK_CACHE_SIZE = int(os.getenv('LINK_CACHE_SIZE', '10000'))
+    LINK_CACHE_TTL = float(os.getenv('LINK_CACHE_TTL', '300'))
+    LINK_CACHE_NEGATIVE_TTL = float(os.getenv('LINK_CACHE_NEGATIVE_TTL', '30'))
+    # How often (seconds) a worker checks whether other workers changed links
+    LINK_CACHE_CHECK_INTERVAL = float(os.getenv('LINK_CACHE_CHECK_INTERVAL', '1'))
+    # Serve link cache misses from a memory-mapped snapshot of the links
+    # table, shared by all workers and rewritten whenever links change
+    LINK_SNAPSHOT_ENABLED = os.getenv('LINK_SNAPSHOT_ENABLED', 'false').lower() == 'true'
+    LINK_SNAPSHOT_PATH = os.getenv('LINK_SNAPSHOT_PATH', DATABASE_PATH + '.links')
+    # Seconds browsers and CDNs may reuse a URL link's redirect; capped by
+    # the link's expiry, never applied to Basic Auth or GUID links. With
+    # CLICK_BEACON_ENABLED, clicks on such links are only counted when the
+    # edge reports them to /beacon/<short_link> with an API token.
+    REDIRECT_CACHE_MAX_AGE = int(os.getenv('REDIRECT_CACHE_MAX_AGE', '0'))
+    CLICK_BEACON_ENABLED = os.getenv('CLICK_BEACON_ENABLED', 'false').lower() == 'true'
+    # Admin listing totals are cached until links change or this many seconds pass
+    LINK_COUNT_CACHE_TTL = float(os.getenv('LINK_COUNT_CACHE_TTL', '60'))
+    
+    # Click recording: clicks are buffered per worker and written in batches
+    CLICK_QUEUE_ENABLED = os.getenv('CLICK_QUEUE_ENABLED', 'true').lower() == 'true'
+    CLICK_QUEUE_MAX_SIZE = int(os.getenv('CLICK_QUEUE_MAX_SIZE', '10000'))
+    CLICK_FLUSH_BATCH_SIZE = int(os.getenv('CLICK_FLUSH_BATCH_SIZE', '500'))
+    CLICK_FLUSH_INTERVAL_MS = int(os.getenv('CLICK_FLUSH_INTERVAL_MS', '250'))
+    # What to do with clicks when the buffer is full: block, drop or spill
+    CLICK_QUEUE_OVERFLOW = os.getenv('CLICK_QUEUE_OVERFLOW', 'block')
+    CLICK_QUEUE_BLOCK_TIMEOUT = float(os.getenv('CLICK_QUEUE_BLOCK_TIMEOUT', '1'))
+    CLICK_SPILL_DIR = os.getenv('CLICK_SPILL_DIR', 'click_spill')
+    
+    # Clicks from bots, link scanners and prefetches: 'tag' stores them
+    # apart from the stats, 'drop' doesn't store them, 'off' counts them all.
+    # Optionally, an IP address with more than CLICK_FILTER_RATE_LIMIT
+    # clicks in CLICK_FILTER_RATE_WINDOW seconds is treated as a bot; each
+    # worker tracks up to CLICK_FILTER_TABLE_SIZE addresses. Off by
+    # default: behind a proxy, set TRUSTED_PROXIES first, or every visitor
+    # shares the proxy's address.
+    CLICK_FILTER_MODE = os.getenv('CLICK_FILTER_MODE', 'tag')
+    CLICK_FILTER_RATE_LIMIT = int(os.getenv('CLICK_FILTER_RATE_LIMIT', '0'))
+    CLICK_FILTER_RATE_WINDOW = float(os.getenv('CLICK_FILTER_RATE_WINDOW', '60'))
+    CLICK_FILTER_TABLE_SIZE = int(os.getenv('CLICK_FILTER_TABLE_SIZE', '10000'))
+    
+    # Unique visitors: 'exact' also keeps every (link, IP address) pair in
+    # link_visitors; 'approx' relies on HyperLogLog sketches alone
+    UNIQUE_VISITOR_MODE = os.getenv('UNIQUE_VISITOR_MODE', 'exact')
+    
+    # Click retention (flask prune-clicks): raw clicks in months older than
+    # this many days are archived to CLICK_ARCHIVE_DIR; 0 keeps them forever
+    CLICK_RETENTION_DAYS = int(os.getenv('CLICK_RETENTION_DAYS', '0'))
+    CLICK_ARCHIVE_DIR = os.getenv('CLICK_ARCHIVE_DIR', 'click_archive')
+    CLICK_PRUNE_BATCH_SIZE = int(os.getenv('CLICK_PRUNE_BATCH_SIZE', '5000'))
+    CLICK_PRUNE_PAUSE_MS = int(os.getenv('CLICK_PRUNE_PAUSE_MS', '50'))
+    
+    # Rows per transaction for bulk link imports
+    BULK_IMPORT_BATCH_SIZE = int(os.getenv('BULK_IMPORT_BATCH_SIZE', '1000'))
+    
+    # Metrics: each worker writes a snapshot here; /metrics merges them
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    METRICS_DIR = os.getenv('METRICS_DIR', 'metrics')
+    METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '1'))
+    # /metrics is only served with a token, as "Authorization: Bearer <token>"
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    
+    # Multi-node deployments (cluster.py): each node syncs its database with
+    # this hub, postgresql://... or sqlite:////shared/hub.db; empty = one node
+    CLUSTER_HUB_URL = os.getenv('CLUSTER_HUB_URL', '')
+    # Empty = generated when the node first joins and kept in its database
+    NODE_ID = os.getenv('NODE_ID', '')
+    CLUSTER_SYNC_INTERVAL = float(os.getenv('CLUSTER_SYNC_INTERVAL', '2'))
+    CLUSTER_SYNC_BATCH_SIZE = int(os.getenv('CLUSTER_SYNC_BATCH_SIZE', '1000'))
+    
+    # Service API (/api/...): comma-separated name:token pairs; callers send
+    # "Authorization: Bearer <token>". Empty disables the API.
+    API_TOKENS = os.getenv('API_TOKENS', '')
+    # Most links one JSON /api/resolve request may ask for; NDJSON streams any number
+    API_RESOLVE_MAX_LINKS = int(os.getenv('API_RESOLVE_MAX_LINKS', '1000'))
+    
+    # Most links one /api/links request may create
+    API_CREATE_MAX_LINKS = int(os.getenv('API_CREATE_MAX_LINKS', '1000'))
+    
+    # Server-generated short codes: characters per code, and how many codes
+    # each worker reserves from the shared counter at a time. Changing the
+    # length changes the sequence; clashes with older codes are skipped.
+    SHORT_CODE_LENGTH = int(os.getenv('SHORT_CODE_LENGTH', '7'))
+    SHORT_CODE_BLOCK_SIZE = int(os.getenv('SHORT_CODE_BLOCK_SIZE', '1000'))
     
     # Feature flags
     ENABLE_SSO = os.getenv('ENABLE_SSO', 'false').lower() == 'true'
     
-    # Session config
-    SESSION_TYPE = "filesystem"
\ No newline at end of file
+    # Session config: 'sqlite' (the app's database), 'cookie' (Flask's signed
+    # cookie, no server-side state) or 'filesystem' (Flask-Session files)
+    SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'sqlite')
+    # Seconds between sweeps of expired sessions, per worker (sqlite backend)
+    SESSION_CLEANUP_INTERVAL = float(os.getenv('SESSION_CLEANUP_INTERVAL', '3600'))
\ No newline at end of file
@@ -1,90 +1,928 @@
 import sqlite3
 from flask import current_app, g
+import base64
 import datetime
+import json
 import os
+import time
+import atexit
+import fcntl
+from collections import Counter, defaultdict
+from functools import partial
+
+from db_pool import ConnectionPool
+from link_cache import LinkCache, MISSING
+from link_snapshot import LinkSnapshot, write_snapshot
+from click_queue import ClickQueue
+from click_filter import get_click_filter
+from blob_store import blob_path, collect_garbage, hash_file, remove_garbage, restore_garbage
+from metrics import get_metrics
+from hll import HyperLogLog
+from link_access import AccessPolicy, EXPIRY_FORMAT, hash_link_password, normalize_expiry
+from click_stats import agent_family, referer_host
+
+# Columns redirect_link needs to resolve a short link
+LINK_COLUMNS = (
+    'target_url', 'is_file', 'filename', 'expires_at',
+    'guid_required', 'basic_auth_user', 'basic_auth_pass', 'blob_digest', 'redirect_status'
+)
+
+# Bump whenever schema.sql or MIGRATIONS change so existing databases
+# pick up the new DDL on the next start.
+SCHEMA_VERSION = 15
+
+# Upgrade steps that CREATE ... IF NOT EXISTS in schema.sql can't express
+# (new columns on existing tables, backfills), keyed by the schema version
+# that introduced them. They run after schema.sql and must be idempotent.
+MIGRATIONS = {
+    2: lambda db: backfill_rollups(db),
+    3: lambda db: rebuild_search_index(db),
+    5: lambda db: _add_blob_digest_column(db),
+    6: lambda db: tombstone_orphaned_clicks(db),
+    7: lambda db: _add_visitor_sketches(db),
+    8: lambda db: _upgrade_link_access(db),
+    10: lambda db: _add_click_breakdowns(db),
+    11: lambda db: _add_click_node_id(db),
+    14: lambda db: _add_redirect_status(db),
+    15: lambda db: _add_click_is_bot(db),
+}
+
+def _column_exists(db, table, column):
+    return any(row[1] == column for row in db.execute(f'PRAGMA table_info({table})'))
+
+def _add_blob_digest_column(db):
+    if not _column_exists(db, 'links', 'blob_digest'):
+        db.execute('ALTER TABLE links ADD COLUMN blob_digest TEXT')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_links_blob_digest ON links (blob_digest)')
+
+def _add_visitor_sketches(db):
+    if not _column_exists(db, 'link_click_totals', 'approx_unique_visitors'):
+        db.execute('ALTER TABLE link_click_totals ADD COLUMN approx_unique_visitors INTEGER NOT NULL DEFAULT 0')
+    backfill_visitor_sketches(db)
+
+def _upgrade_link_access(db):
+    """Hash plaintext Basic Auth passwords and store expiries in one format."""
+    rows = db.execute('''
+        SELECT short_link, expires_at, basic_auth_pass FROM links
+        WHERE expires_at IS NOT NULL OR basic_auth_pass IS NOT NULL
+    ''').fetchall()
+    for row in rows:
+        expires_at = row['expires_at']
+        try:
+            expires_at = normalize_expiry(expires_at) if expires_at else None
+        except ValueError:
+            pass
+        db.execute('UPDATE links SET expires_at = ?, basic_auth_pass = ? WHERE short_link = ?',
+                   (expires_at, hash_link_password(row['basic_auth_pass']), row['short_link']))
+
+def _add_click_breakdowns(db):
+    # Weekly series are now summed from link_click_daily
+    db.execute('DROP TABLE IF EXISTS link_click_weekly')
+    backfill_click_breakdowns(db)
+
+def _add_click_node_id(db):
+    # NULL for clicks recorded on this node, else the node that recorded it
+    if not _column_exists(db, 'clicks', 'node_id'):
+        db.execute('ALTER TABLE clicks ADD COLUMN node_id TEXT')
+
+def _add_redirect_status(db):
+    if not _column_exists(db, 'links', 'redirect_status'):
+        db.execute('ALTER TABLE links ADD COLUMN redirect_status INTEGER')
+    # Link caches and snapshots from before the column must not be reused
+    db.execute('UPDATE link_generation SET generation = generation + 1 WHERE id = 1')
+
+def _add_click_is_bot(db):
+    if not _column_exists(db, 'clicks', 'is_bot'):
+        db.execute('ALTER TABLE clicks ADD COLUMN is_bot INTEGER NOT NULL DEFAULT 0')
+
+def get_pool(app=None):
+    """Return this worker's connection pool, creating it on first use."""
+    app = app or current_app._get_current_object()
+    pool = app.extensions.get('db_pool')
+    if pool is None or pool.pid != os.getpid():
+        config = app.config
+        pool = ConnectionPool(
+            config['DATABASE_PATH'],
+            journal_mode=config['SQLITE_JOURNAL_MODE'],
+            synchronous=config['SQLITE_SYNCHRONOUS'],
+            busy_timeout_ms=config['SQLITE_BUSY_TIMEOUT_MS'],
+            mmap_size=config['SQLITE_MMAP_SIZE'],
+            cache_size=config['SQLITE_CACHE_SIZE'],
+            read_pool_size=config['SQLITE_READ_POOL_SIZE'],
+            metrics=get_metrics(app) if config['METRICS_ENABLED'] else None
+        )
+        app.extensions['db_pool'] = pool
+    return pool
 
 def get_db():
+    """The pooled writer connection, held until the end of the request."""
     if 'db' not in g:
-        g.db = sqlite3.connect(current_app.config['DATABASE_PATH'])
-        g.db.row_factory = sqlite3.Row
+        g.db = get_pool().acquire_writer()
     return g.db
 
+def get_read_db():
+    """A pooled read-only connection, held until the end of the request."""
+    if 'read_db' not in g:
+        g.read_db = get_pool().acquire_reader()
+    return g.read_db
+
 def close_db(e=None):
+    pool = get_pool()
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        pool.release_writer(db)
+    read_db = g.pop('read_db', None)
+    if read_db is not None:
+        pool.release_reader(read_db)
 
 def init_db():
-    db = get_db()
-    
-    # Read schema
-    with current_app.open_resource('schema.sql') as f:
-        db.executescript(f.read().decode('utf8'))
-    
+    """
+    Create or upgrade the schema. Skipped when the database's user_version
+    already matches SCHEMA_VERSION, so worker restarts don't re-run DDL.
+    """
     # Create uploads directory if it doesn't exist
     os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-def record_click(short_link, ip_address, user_agent=None, referer=None):
-    db = get_db()
-    db.execute('''
-        INSERT INTO clicks (short_link, ip_address, user_agent, referer)
+    pool = get_pool()
+    db = pool.acquire_writer()
+    try:
+        if db.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return
+
+        # Workers start at the same time; let one of them do the upgrade
+        lock_path = current_app.config['DATABASE_PATH'] + '.init-lock'
+        with open(lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            current = db.execute('PRAGMA user_version').fetchone()[0]
+            if current >= SCHEMA_VERSION:
+                return
+
+            with current_app.open_resource('schema.sql') as f:
+                db.executescript(f.read().decode('utf8'))
+            # Rollup backfills from any version skip bot clicks, so the
+            # column has to exist before the first of them runs
+            _add_click_is_bot(db)
+            for version in range(current + 1, SCHEMA_VERSION + 1):
+                migrate = MIGRATIONS.get(version)
+                if migrate is not None:
+                    migrate(db)
+            db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            db.commit()
+    finally:
+        pool.release_writer(db)
+
+def get_link_cache():
+    """Return this worker's link cache, creating it on first use."""
+    cache = current_app.extensions.get('link_cache')
+    if cache is None:
+        cache = LinkCache(
+            max_size=current_app.config['LINK_CACHE_SIZE'],
+            ttl=current_app.config['LINK_CACHE_TTL'],
+            negative_ttl=current_app.config['LINK_CACHE_NEGATIVE_TTL']
+        )
+        current_app.extensions['link_cache'] = cache
+    return cache
+
+def get_link_generation(db):
+    row = db.execute('SELECT generation FROM link_generation WHERE id = 1').fetchone()
+    return row['generation'] if row else 0
+
+def _sync_link_generation(cache):
+    """
+    Drop the worker's cached links if another worker has changed the links
+    table since we last looked. The shared generation counter is read at
+    most once per LINK_CACHE_CHECK_INTERVAL seconds.
+    """
+    now = time.monotonic()
+    interval = current_app.config['LINK_CACHE_CHECK_INTERVAL']
+    if cache.generation is not None and now - cache.checked_at < interval:
+        return
+
+    generation = get_link_generation(get_read_db())
+    cache.checked_at = now
+    if generation != cache.generation:
+        if cache.generation is not None:
+            cache.clear()
+        cache.generation = generation
+    if current_app.config['LINK_SNAPSHOT_ENABLED']:
+        _sync_link_snapshot(generation)
+
+def build_link_snapshot(db=None):
+    """
+    Export the links table to LINK_SNAPSHOT_PATH and map it in this worker.
+    Returns the new snapshot, or None if another process is already
+    building one.
+    """
+    db = db or get_read_db()
+    path = current_app.config['LINK_SNAPSHOT_PATH']
+    with open(path + '.lock', 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        # One read transaction, so the rows match the generation
+        db.execute('BEGIN')
+        try:
+            generation = get_link_generation(db)
+            rows = db.execute(f'SELECT short_link, {", ".join(LINK_COLUMNS)} FROM links')
+            write_snapshot(path, generation,
+                           ((row[0], tuple(row)[1:]) for row in rows))
+        finally:
+            db.commit()
+    get_metrics().inc('link_snapshot_builds_total')
+    snapshot = LinkSnapshot.open(path)
+    current_app.extensions['link_snapshot'] = snapshot
+    return snapshot
+
+def _sync_link_snapshot(generation):
+    """
+    Make sure this worker has the snapshot for `generation` mapped, picking
+    up one written by another worker or building it if there is none.
+    Until then, lookups go to the database.
+    """
+    snapshot = current_app.extensions.get('link_snapshot')
+    if snapshot is not None and snapshot.generation == generation and snapshot.is_current():
+        return
+    if snapshot is None or not snapshot.is_current():
+        snapshot = LinkSnapshot.open(current_app.config['LINK_SNAPSHOT_PATH'])
+        current_app.extensions['link_snapshot'] = snapshot
+    if snapshot is None or snapshot.generation < generation:
+        build_link_snapshot()
+
+def _snapshot_lookup(short_link, generation):
+    """The link from the mapped snapshot, or MISSING if it isn't up to date."""
+    snapshot = current_app.extensions.get('link_snapshot')
+    if snapshot is None or snapshot.generation != generation:
+        return MISSING
+    values = snapshot.get(short_link)
+    return dict(zip(LINK_COLUMNS, values)) if values is not None else None
+
+def resolve_link(short_link):
+    """
+    Look up the redirect record for short_link, going through the link
+    cache. Returns a dict of LINK_COLUMNS plus its compiled AccessPolicy
+    under 'policy', or None if the link doesn't exist.
+    """
+    cache = get_link_cache()
+    _sync_link_generation(cache)
+    epoch = cache.epoch
+
+    link = cache.get(short_link)
+    if link is MISSING:
+        if current_app.config['LINK_SNAPSHOT_ENABLED']:
+            link = _snapshot_lookup(short_link, cache.generation)
+        if link is MISSING:
+            row = get_read_db().execute(f'''
+                SELECT {', '.join(LINK_COLUMNS)}
+                FROM links
+                WHERE short_link = ?
+            ''', (short_link,)).fetchone()
+            link = dict(row) if row is not None else None
+        if link is not None:
+            link['policy'] = AccessPolicy.from_link(link)
+        cache.put(short_link, link, epoch)
+    return link
+
+def resolve_links(short_links, chunk_size=500):
+    """
+    resolve_link() for many links at once: returns {short_link: link or
+    None}. Cache misses are fetched with one IN (...) query per
+    `chunk_size` links rather than one query each.
+    """
+    cache = get_link_cache()
+    _sync_link_generation(cache)
+    epoch = cache.epoch
+
+    links = {}
+    misses = []
+    for short_link in dict.fromkeys(short_links):
+        link = cache.get(short_link)
+        if link is MISSING and current_app.config['LINK_SNAPSHOT_ENABLED']:
+            link = _snapshot_lookup(short_link, cache.generation)
+            if link is not MISSING:
+                if link is not None:
+                    link['policy'] = AccessPolicy.from_link(link)
+                cache.put(short_link, link, epoch)
+        if link is MISSING:
+            misses.append(short_link)
+        else:
+            links[short_link] = link
+
+    db = get_read_db()
+    for i in range(0, len(misses), chunk_size):
+        chunk = misses[i:i + chunk_size]
+        rows = db.execute(f'''
+            SELECT short_link, {', '.join(LINK_COLUMNS)}
+            FROM links
+            WHERE short_link IN ({', '.join('?' * len(chunk))})
+        ''', chunk).fetchall()
+        found = {row['short_link']: row for row in rows}
+        for short_link in chunk:
+            row = found.get(short_link)
+            link = None
+            if row is not None:
+                link = {column: row[column] for column in LINK_COLUMNS}
+                link['policy'] = AccessPolicy.from_link(link)
+            cache.put(short_link, link, epoch)
+            links[short_link] = link
+    return links
+
+def begin_write(db):
+    """
+    Take SQLite's write lock now rather than at the first write, for
+    changes that have to be made together with file operations.
+    """
+    if not db.in_transaction:
+        db.execute('BEGIN IMMEDIATE')
+
+def commit_link_changes(db, snapshot=True):
+    """
+    Commit pending changes to the links table and invalidate the link
+    cache in every worker by bumping the shared generation counter.
+    Uploaded files that no link references any more are deleted once the
+    commit has succeeded. With link snapshots enabled, a new one is
+    written unless `snapshot` is false, in which case the next lookup
+    after the check interval does it.
+    """
+    garbage = collect_garbage(db)
+    try:
+        db.execute('UPDATE link_generation SET generation = generation + 1 WHERE id = 1')
+        db.commit()
+    except BaseException:
+        restore_garbage(garbage)
+        raise
+    remove_garbage(garbage)
+    get_link_cache().clear()
+    if snapshot and current_app.config['LINK_SNAPSHOT_ENABLED']:
+        build_link_snapshot()
+
+def purge_expired_links(db, batch_size=500):
+    """
+    Delete links whose expiry has passed, in batches, using the partial
+    index on expires_at. Returns the number of links removed.
+    """
+    now = datetime.datetime.utcnow().strftime(EXPIRY_FORMAT)
+    purged = 0
+    while True:
+        begin_write(db)
+        rows = db.execute('''
+            SELECT short_link, is_file, target_url, blob_digest FROM links
+            WHERE expires_at IS NOT NULL AND expires_at <= ?
+            LIMIT ?
+        ''', (now, batch_size)).fetchall()
+        for row in rows:
+            db.execute('DELETE FROM links WHERE short_link = ?', (row['short_link'],))
+            forget_link_clicks(db, row['short_link'])
+        commit_link_changes(db)
+        # Files from before the blob store belong to their link alone
+        for row in rows:
+            if row['is_file'] and row['blob_digest'] is None:
+                try:
+                    os.remove(row['target_url'])
+                except OSError:
+                    pass
+        purged += len(rows)
+        if len(rows) < batch_size:
+            return purged
+
+def encode_cursor(values):
+    """Pack a row's sort-key values into an opaque, URL-safe page cursor."""
+    raw = json.dumps(list(values), separators=(',', ':')).encode('utf8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, num_keys):
+    """Inverse of encode_cursor(); raises ValueError for anything malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+    if not isinstance(values, list) or len(values) != num_keys:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return values
+
+def fetch_keyset_page(db, query, params, keys, cursor=None, before=False,
+                      descending=True, per_page=50):
+    """
+    Fetch one page of `query` ordered by the columns in `keys` (which must
+    end in a unique column), starting just after `cursor`, or just before it
+    when `before` is set. Unlike OFFSET, the cost doesn't grow with how deep
+    into the listing the page is.
+
+    Returns (rows, next_cursor, prev_cursor); a cursor is None when there's
+    no page in that direction.
+    """
+    # Walking backwards means flipping both the comparison and the sort
+    # order, then reversing the rows we get back
+    scan_descending = descending != before
+    direction = 'DESC' if scan_descending else 'ASC'
+    key_list = ', '.join(keys)
+
+    sql = f'SELECT * FROM ({query})'
+    params = list(params)
+    if cursor is not None:
+        op = '<' if scan_descending else '>'
+        placeholders = ', '.join('?' for _ in keys)
+        sql += f' WHERE ({key_list}) {op} ({placeholders})'
+        params.extend(decode_cursor(cursor, len(keys)))
+    sql += ' ORDER BY ' + ', '.join(f'{key} {direction}' for key in keys)
+    sql += ' LIMIT ?'
+    params.append(per_page + 1)
+
+    rows = db.execute(sql, params).fetchall()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if (cursor is not None) if before else has_more:
+            next_cursor = encode_cursor(rows[-1][key] for key in keys)
+        if has_more if before else (cursor is not None):
+            prev_cursor = encode_cursor(rows[0][key] for key in keys)
+    return rows, next_cursor, prev_cursor
+
+def get_count_cache():
+    cache = current_app.extensions.get('count_cache')
+    if cache is None:
+        cache = LinkCache(max_size=256, ttl=current_app.config['LINK_COUNT_CACHE_TTL'])
+        current_app.extensions['count_cache'] = cache
+    return cache
+
+def cached_count(db, query, params=()):
+    """
+    Run a COUNT query, reusing this worker's previous answer until the links
+    table changes or LINK_COUNT_CACHE_TTL passes.
+    """
+    link_cache = get_link_cache()
+    _sync_link_generation(link_cache)
+    key = (link_cache.generation, query, tuple(params))
+
+    cache = get_count_cache()
+    count = cache.get(key)
+    if count is MISSING:
+        count = db.execute(query, params).fetchone()[0]
+        cache.put(key, count)
+    return count
+
+def migrate_legacy_uploads(db, upload_folder):
+    """
+    Move files saved before the blob store ("uploads/<short_link>_<name>")
+    into it, so identical files are stored once. Returns how many links
+    were migrated.
+    """
+    rows = db.execute('''
+        SELECT short_link, target_url FROM links
+        WHERE is_file = 1 AND blob_digest IS NULL
+    ''').fetchall()
+
+    moved = 0
+    for row in rows:
+        old_path = row['target_url']
+        if not os.path.exists(old_path):
+            continue
+        digest, size = hash_file(old_path)
+        path = blob_path(upload_folder, digest)
+
+        begin_write(db)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(old_path)
+        else:
+            os.replace(old_path, path)
+        db.execute('''
+            INSERT OR IGNORE INTO blobs (digest, path, size) VALUES (?, ?, ?)
+        ''', (digest, path, size))
+        db.execute('''
+            UPDATE links SET target_url = ?, blob_digest = ? WHERE short_link = ?
+        ''', (path, digest, row['short_link']))
+        commit_link_changes(db)
+        moved += 1
+    return moved
+
+def build_search_match(search_term):
+    """
+    Turn an admin search box term into an FTS5 MATCH expression for the
+    trigram-tokenized links_fts index. Every whitespace-separated word must
+    appear as a substring of one of the indexed columns. Returns None when
+    a word is shorter than three characters, which trigrams can't match.
+    """
+    words = search_term.split()
+    if not words or any(len(word) < 3 for word in words):
+        return None
+    return ' AND '.join('"' + word.replace('"', '""') + '"' for word in words)
+
+def rebuild_search_index(db):
+    """Repopulate links_fts from the links table."""
+    with db:
+        db.execute("INSERT INTO links_fts (links_fts) VALUES ('rebuild')")
+
+def insert_clicks(db, rows, exact_visitors=True, node_id=None):
+    """
+    Insert click rows of (short_link, ip_address, user_agent, referer,
+    clicked_at[, is_bot]), recorded on another node if `node_id` is given.
+    Bot clicks are stored but left out of the rollups. The caller owns
+    the transaction.
+    """
+    rows = [tuple(row) + (0,) * (6 - len(row)) for row in rows]
+    db.executemany('''
+        INSERT INTO clicks (short_link, ip_address, user_agent, referer, clicked_at, is_bot, node_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [row + (node_id,) for row in rows])
+    update_rollups(db, [row[:5] for row in rows if not row[5]], exact_visitors)
+
+def update_rollups(db, rows, exact_visitors=True):
+    """
+    Fold newly inserted click rows into the per-link rollup tables that the
+    admin listing and stats pages read instead of scanning `clicks`.
+    Unique visitors are always estimated with HyperLogLog sketches; with
+    exact_visitors they are also counted exactly through link_visitors,
+    which grows with every new (link, IP address) pair.
+    """
+    totals = Counter()
+    new_visitors = Counter()
+    daily = Counter()
+    hourly = Counter()
+    referers = Counter()
+    agents = Counter()
+    sketch_values = defaultdict(set)
+
+    for short_link, ip_address, user_agent, referer, clicked_at in rows:
+        day = clicked_at[:10]
+        totals[short_link] += 1
+        daily[(short_link, day)] += 1
+        hourly[(short_link, clicked_at[:13])] += 1
+        referers[(short_link, day, referer_host(referer))] += 1
+        agents[(short_link, day, agent_family(user_agent))] += 1
+        sketch_values[(short_link, 'all')].add(ip_address)
+        sketch_values[(short_link, day)].add(ip_address)
+
+        if exact_visitors:
+            cur = db.execute('''
+                INSERT OR IGNORE INTO link_visitors (short_link, ip_address, first_seen)
+                VALUES (?, ?, ?)
+            ''', (short_link, ip_address, clicked_at))
+            if cur.rowcount:
+                new_visitors[short_link] += 1
+
+    estimates = update_visitor_sketches(db, sketch_values)
+    db.executemany('''
+        INSERT INTO link_click_totals (short_link, total_clicks, unique_visitors, approx_unique_visitors)
         VALUES (?, ?, ?, ?)
-    ''', (short_link, ip_address, user_agent, referer))
-    db.commit()
-
-def get_link_stats(short_link):
-    db = get_db()
-    # Get total clicks
-    total_clicks = db.execute('''
-        SELECT COUNT(*) as count FROM clicks WHERE short_link = ?
-    ''', (short_link,)).fetchone()['count']
-    
-    # Get unique IPs
-    unique_ips = db.execute('''
-        SELECT COUNT(DISTINCT ip_address) as count FROM clicks WHERE short_link = ?
-    ''', (short_link,)).fetchone()['count']
-    
-    # Get recent clicks
+        ON CONFLICT (short_link) DO UPDATE SET
+            total_clicks = total_clicks + excluded.total_clicks,
+            unique_visitors = unique_visitors + excluded.unique_visitors,
+            approx_unique_visitors = excluded.approx_unique_visitors
+    ''', [(link, count, new_visitors[link], estimates[link]) for link, count in totals.items()])
+    db.executemany('''
+        INSERT INTO link_click_daily (short_link, day, clicks)
+        VALUES (?, ?, ?)
+        ON CONFLICT (short_link, day) DO UPDATE SET clicks = clicks + excluded.clicks
+    ''', [(link, day, count) for (link, day), count in daily.items()])
+    db.executemany('''
+        INSERT INTO link_click_hourly (short_link, hour, clicks)
+        VALUES (?, ?, ?)
+        ON CONFLICT (short_link, hour) DO UPDATE SET clicks = clicks + excluded.clicks
+    ''', [(link, hour, count) for (link, hour), count in hourly.items()])
+    db.executemany('''
+        INSERT INTO link_click_referers (short_link, day, referer_host, clicks)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (short_link, day, referer_host) DO UPDATE SET clicks = clicks + excluded.clicks
+    ''', [key + (count,) for key, count in referers.items()])
+    db.executemany('''
+        INSERT INTO link_click_agents (short_link, day, agent_family, clicks)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (short_link, day, agent_family) DO UPDATE SET clicks = clicks + excluded.clicks
+    ''', [key + (count,) for key, count in agents.items()])
+
+def update_visitor_sketches(db, sketch_values):
+    """
+    Add IP addresses to the stored sketches, given a mapping of
+    (short_link, period) -> addresses where period is 'all' or a
+    'YYYY-MM-DD' day. Returns each link's new 'all' estimate.
+    """
+    estimates = {}
+    for (short_link, period), values in sketch_values.items():
+        row = db.execute('''
+            SELECT sketch FROM link_visitor_sketches
+            WHERE short_link = ? AND period = ?
+        ''', (short_link, period)).fetchone()
+        sketch = HyperLogLog.from_bytes(row['sketch']) if row else HyperLogLog()
+        sketch.update(values)
+        db.execute('''
+            INSERT OR REPLACE INTO link_visitor_sketches (short_link, period, sketch)
+            VALUES (?, ?, ?)
+        ''', (short_link, period, sketch.to_bytes()))
+        if period == 'all':
+            estimates[short_link] = sketch.count()
+    return estimates
+
+def merge_visitor_sketches(db, short_link, start=None, end=None):
+    """
+    Estimated unique visitors of short_link, over all time or between the
+    'YYYY-MM-DD' days start and end inclusive (merging the daily sketches).
+    """
+    if start is None and end is None:
+        rows = db.execute('''
+            SELECT sketch FROM link_visitor_sketches
+            WHERE short_link = ? AND period = 'all'
+        ''', (short_link,)).fetchall()
+    else:
+        rows = db.execute('''
+            SELECT sketch FROM link_visitor_sketches
+            WHERE short_link = ? AND period != 'all' AND period BETWEEN ? AND ?
+        ''', (short_link, start or '0000-00-00', end or '9999-99-99')).fetchall()
+    merged = HyperLogLog()
+    for row in rows:
+        merged.merge(HyperLogLog.from_bytes(row['sketch']))
+    return merged.count()
+
+def backfill_visitor_sketches(db):
+    """
+    Rebuild the visitor sketches from the raw `clicks` table, one link at a
+    time. Daily sketches of months archived by prune-clicks are kept, and
+    each link's overall sketch is the merge of its daily ones.
+    """
+    archived = 'SELECT month FROM click_archive_log'
+    with db:
+        db.execute(f'''
+            DELETE FROM link_visitor_sketches
+            WHERE period = 'all' OR substr(period, 1, 7) NOT IN ({archived})
+        ''')
+        daily = {}
+        current = None
+
+        def flush_link(short_link):
+            total = HyperLogLog()
+            for period, sketch in daily.items():
+                db.execute('''
+                    INSERT OR REPLACE INTO link_visitor_sketches (short_link, period, sketch)
+                    VALUES (?, ?, ?)
+                ''', (short_link, period, sketch.to_bytes()))
+            for row in db.execute('''
+                SELECT sketch FROM link_visitor_sketches
+                WHERE short_link = ? AND period != 'all'
+            ''', (short_link,)).fetchall():
+                total.merge(HyperLogLog.from_bytes(row['sketch']))
+            db.execute('''
+                INSERT OR REPLACE INTO link_visitor_sketches (short_link, period, sketch)
+                VALUES (?, 'all', ?)
+            ''', (short_link, total.to_bytes()))
+            db.execute('''
+                UPDATE link_click_totals SET approx_unique_visitors = ?
+                WHERE short_link = ?
+            ''', (total.count(), short_link))
+            daily.clear()
+
+        # A plain cursor streams rows instead of loading them all
+        cursor = db.execute(f'''
+            SELECT c.short_link, c.ip_address, strftime('%Y-%m-%d', c.clicked_at) AS day
+            FROM clicks c
+            WHERE strftime('%Y-%m', c.clicked_at) NOT IN ({archived})
+              AND c.is_bot = 0
+              AND NOT EXISTS (
+                  SELECT 1 FROM link_tombstones t
+                  WHERE t.short_link = c.short_link AND c.clicked_at <= t.deleted_at
+              )
+            ORDER BY c.short_link
+        ''')
+        for short_link, ip_address, day in cursor:
+            if short_link != current:
+                if current is not None:
+                    flush_link(current)
+                current = short_link
+            daily.setdefault(day, HyperLogLog()).add(ip_address)
+        if current is not None:
+            flush_link(current)
+
+# Raw clicks that rollups are rebuilt from: those in months not yet
+# archived by prune-clicks, less those of deleted links and bot clicks
+_ARCHIVED_MONTHS = 'SELECT month FROM click_archive_log'
+_LIVE_CLICKS = f'''
+    FROM clicks c
+    WHERE strftime('%Y-%m', c.clicked_at) NOT IN ({_ARCHIVED_MONTHS})
+      AND c.is_bot = 0
+      AND NOT EXISTS (
+          SELECT 1 FROM link_tombstones t
+          WHERE t.short_link = c.short_link AND c.clicked_at <= t.deleted_at
+      )
+'''
+
+def backfill_click_breakdowns(db, chunk_size=10000):
+    """
+    Rebuild the hourly, referer and user-agent rollups from the raw clicks
+    of months that haven't been archived. Referer hosts and browser
+    families are worked out in Python, reading the clicks in chunks.
+    """
+    for table, column in (('link_click_hourly', 'hour'), ('link_click_referers', 'day'),
+                          ('link_click_agents', 'day')):
+        db.execute(f'DELETE FROM {table} WHERE substr({column}, 1, 7) NOT IN ({_ARCHIVED_MONTHS})')
+    db.execute(f'''
+        INSERT INTO link_click_hourly (short_link, hour, clicks)
+        SELECT c.short_link, strftime('%Y-%m-%d %H', c.clicked_at), COUNT(*)
+        {_LIVE_CLICKS}
+        GROUP BY 1, 2
+    ''')
+    referers = Counter()
+    agents = Counter()
+    cursor = db.execute(f'SELECT c.short_link, c.user_agent, c.referer, c.clicked_at {_LIVE_CLICKS}')
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for short_link, user_agent, referer, clicked_at in rows:
+            day = clicked_at[:10]
+            referers[(short_link, day, referer_host(referer))] += 1
+            agents[(short_link, day, agent_family(user_agent))] += 1
+    db.executemany('''
+        INSERT INTO link_click_referers (short_link, day, referer_host, clicks) VALUES (?, ?, ?, ?)
+    ''', [key + (count,) for key, count in referers.items()])
+    db.executemany('''
+        INSERT INTO link_click_agents (short_link, day, agent_family, clicks) VALUES (?, ?, ?, ?)
+    ''', [key + (count,) for key, count in agents.items()])
+
+def backfill_rollups(db):
+    """
+    Rebuild every rollup table from the raw `clicks` table. Runs in a single
+    transaction, so clicks written meanwhile wait rather than get lost.
+
+    Months archived by prune-clicks have no raw clicks left, so their
+    daily, hourly and breakdown counts and first-seen visitors are kept as
+    they are; totals are then recomputed from the daily counts. The visitor
+    sketches are rebuilt afterwards in their own transaction.
+    """
+    with db:
+        db.execute(f'DELETE FROM link_visitors WHERE substr(first_seen, 1, 7) NOT IN ({_ARCHIVED_MONTHS})')
+        db.execute(f'DELETE FROM link_click_daily WHERE substr(day, 1, 7) NOT IN ({_ARCHIVED_MONTHS})')
+        db.execute('DELETE FROM link_click_totals')
+        db.execute(f'''
+            INSERT OR IGNORE INTO link_visitors (short_link, ip_address, first_seen)
+            SELECT c.short_link, c.ip_address, MIN(c.clicked_at)
+            {_LIVE_CLICKS}
+            GROUP BY c.short_link, c.ip_address
+        ''')
+        db.execute(f'''
+            INSERT INTO link_click_daily (short_link, day, clicks)
+            SELECT c.short_link, strftime('%Y-%m-%d', c.clicked_at), COUNT(*)
+            {_LIVE_CLICKS}
+            GROUP BY 1, 2
+        ''')
+        backfill_click_breakdowns(db)
+        db.execute('''
+            INSERT INTO link_click_totals (short_link, total_clicks, unique_visitors)
+            SELECT d.short_link, SUM(d.clicks),
+                   (SELECT COUNT(*) FROM link_visitors v WHERE v.short_link = d.short_link)
+            FROM link_click_daily d
+            GROUP BY d.short_link
+        ''')
+    backfill_visitor_sketches(db)
+
+def forget_link_clicks(db, short_link):
+    """
+    Drop the rollups and visitors of a link being deleted or renamed away
+    and leave a tombstone, so prune-clicks purges its raw clicks later in
+    small batches. Visitors go now, or a new link with the same name would
+    count them as already seen. Call inside the transaction that deletes
+    the link.
+    """
+    deleted_at = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    db.execute('DELETE FROM link_click_totals WHERE short_link = ?', (short_link,))
+    db.execute('DELETE FROM link_click_daily WHERE short_link = ?', (short_link,))
+    db.execute('DELETE FROM link_click_hourly WHERE short_link = ?', (short_link,))
+    db.execute('DELETE FROM link_click_referers WHERE short_link = ?', (short_link,))
+    db.execute('DELETE FROM link_click_agents WHERE short_link = ?', (short_link,))
+    db.execute('DELETE FROM link_visitor_sketches WHERE short_link = ?', (short_link,))
+    db.execute('DELETE FROM link_visitors WHERE short_link = ?', (short_link,))
+    db.execute('''
+        INSERT OR IGNORE INTO link_tombstones (short_link, deleted_at)
+        VALUES (?, ?)
+    ''', (short_link, deleted_at))
+
+def tombstone_orphaned_clicks(db):
+    """Queue up the clicks of links deleted before tombstones existed."""
+    rows = db.execute('''
+        SELECT short_link FROM link_click_totals
+        WHERE short_link NOT IN (SELECT short_link FROM links)
+    ''').fetchall()
+    for row in rows:
+        forget_link_clicks(db, row['short_link'])
+
+def get_click_queue():
+    """Return this worker's click queue, starting its flusher on first use."""
+    queue = current_app.extensions.get('click_queue')
+    if queue is None or queue.pid != os.getpid():
+        config = current_app.config
+        queue = ClickQueue(
+            connect=get_pool().connect,
+            insert=partial(insert_clicks,
+                           exact_visitors=config['UNIQUE_VISITOR_MODE'] == 'exact'),
+            batch_size=config['CLICK_FLUSH_BATCH_SIZE'],
+            flush_interval=config['CLICK_FLUSH_INTERVAL_MS'] / 1000.0,
+            max_size=config['CLICK_QUEUE_MAX_SIZE'],
+            overflow=config['CLICK_QUEUE_OVERFLOW'],
+            block_timeout=config['CLICK_QUEUE_BLOCK_TIMEOUT'],
+            spill_dir=config['CLICK_SPILL_DIR']
+        )
+        queue.start()
+        atexit.register(queue.close)
+        current_app.extensions['click_queue'] = queue
+    return queue
+
+def drain_click_queue(app):
+    """Flush any buffered clicks; called when a worker shuts down."""
+    queue = app.extensions.get('click_queue')
+    if queue is not None and queue.pid == os.getpid():
+        queue.close()
+
+def record_click(short_link, ip_address, user_agent=None, referer=None, headers=None, method='GET'):
+    """
+    Record a click, unless the click filter drops it as a bot or prefetch.
+    `headers` and `method` are the request's, for spotting prefetches.
+    """
+    is_bot = 0
+    click_filter = get_click_filter()
+    if click_filter.mode != 'off':
+        reason = click_filter.classify(ip_address, user_agent, headers, method)
+        if reason is not None:
+            get_metrics().inc('clicks_filtered_total',
+                              labels=(('reason', reason), ('action', click_filter.mode)))
+            if click_filter.mode == 'drop':
+                return
+            is_bot = 1
+
+    # Match the format of SQLite's CURRENT_TIMESTAMP so queued clicks sort
+    # and group the same way as ones written directly.
+    clicked_at = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    row = (short_link, ip_address, user_agent, referer, clicked_at, is_bot)
+
+    if current_app.config['CLICK_QUEUE_ENABLED']:
+        get_click_queue().put(row)
+    else:
+        db = get_db()
+        insert_clicks(db, [row], current_app.config['UNIQUE_VISITOR_MODE'] == 'exact')
+        db.commit()
+
+def get_link_stats(short_link, unique_mode=None, start=None, end=None):
+    """
+    Click totals, unique visitors and recent clicks for a link. start and
+    end ('YYYY-MM-DD', inclusive) limit the totals to a date range.
+    unique_mode is 'approx' (HyperLogLog sketches) or 'exact'; it defaults
+    to UNIQUE_VISITOR_MODE. Exact counts over a date range, or in 'approx'
+    mode where link_visitors isn't kept, count distinct IP addresses in the
+    raw clicks, which only go back as far as the retention window.
+    """
+    db = get_read_db()
+    configured_mode = current_app.config['UNIQUE_VISITOR_MODE']
+    unique_mode = unique_mode or configured_mode
+    ranged = start is not None or end is not None
+    start = start or '0000-00-00'
+    end = end or '9999-99-99'
+
+    # Totals come from the rollup maintained as clicks are recorded
+    totals = db.execute('''
+        SELECT total_clicks, unique_visitors, approx_unique_visitors
+        FROM link_click_totals
+        WHERE short_link = ?
+    ''', (short_link,)).fetchone()
+    total_clicks = totals['total_clicks'] if totals else 0
+    if ranged:
+        total_clicks = db.execute('''
+            SELECT COALESCE(SUM(clicks), 0) FROM link_click_daily
+            WHERE short_link = ? AND day BETWEEN ? AND ?
+        ''', (short_link, start, end)).fetchone()[0]
+
+    if unique_mode == 'approx':
+        if ranged:
+            unique_visitors = merge_visitor_sketches(db, short_link, start, end)
+        else:
+            unique_visitors = totals['approx_unique_visitors'] if totals else 0
+    elif not ranged and configured_mode == 'exact':
+        unique_visitors = totals['unique_visitors'] if totals else 0
+    else:
+        unique_visitors = db.execute('''
+            SELECT COUNT(DISTINCT ip_address) FROM clicks
+            WHERE short_link = ? AND is_bot = 0
+              AND clicked_at >= ? AND clicked_at < date(?, '+1 day')
+              AND clicked_at > COALESCE(
+                  (SELECT MAX(deleted_at) FROM link_tombstones WHERE short_link = ?), '')
+        ''', (short_link, start, end if ranged else '9999-12-30', short_link)).fetchone()[0]
+
+    # Get recent clicks, skipping those of an earlier link with the same
+    # name that prune-clicks hasn't purged yet
     recent_clicks = db.execute('''
         SELECT ip_address, user_agent, referer, clicked_at
         FROM clicks
-        WHERE short_link = ?
+        WHERE short_link = ? AND is_bot = 0
+          AND clicked_at > COALESCE(
+              (SELECT MAX(deleted_at) FROM link_tombstones WHERE short_link = ?), '')
         ORDER BY clicked_at DESC
         LIMIT 10
-    ''', (short_link,)).fetchall()
+    ''', (short_link, short_link)).fetchall()
     
     return {
         'total_clicks': total_clicks,
-        'unique_visitors': unique_ips,
+        'unique_visitors': unique_visitors,
+        'unique_mode': unique_mode,
         'recent_clicks': recent_clicks
     }
-    
-def get_weekly_click_data(short_link, num_weeks=26):
-    """
-    Return a list of dicts, each with:
-    { 'label': 'YYYY-WW', 'count': <number_of_clicks_in_that_week> }
-    for the last `num_weeks` weeks.
-    """
-    now = datetime.datetime.utcnow()
-    cutoff = now - datetime.timedelta(weeks=num_weeks)
-    
-    db = get_db()
-    # We'll assume your `clicked_at` column is stored as a TEXT or TIMESTAMP.
-    # We'll group by year-week using strftime('%Y-%W', clicked_at).
-    rows = db.execute('''
-        SELECT strftime('%Y-%W', clicked_at) as week_label,
-               COUNT(*) as clicks
-        FROM clicks
-        WHERE short_link = ?
-          AND clicked_at >= ?
-        GROUP BY week_label
-        ORDER BY week_label
-    ''', (short_link, cutoff)).fetchall()
-    
-    results = []
-    for row in rows:
-        results.append({
-            'label': row['week_label'],  # e.g., "2025-03"
-            'count': row['clicks']
-        })
-    return results
\ No newline at end of file
@@ -0,0 +1,113 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from metrics import TimedConnection
+
+
+class ConnectionPool:
+    """
+    Per-worker pool of SQLite connections that stay open across requests.
+
+    There is a single writer connection, handed to one user at a time, and
+    up to `read_pool_size` idle read-only connections. Read-only connections
+    never take SQLite's write lock, so redirects and stats pages don't queue
+    behind admin writes or click inserts once the database is in WAL mode.
+
+    With a `metrics` object, connections time their statements and waits
+    for the writer connection are counted.
+    """
+
+    def __init__(self, database_path, journal_mode='WAL', synchronous='NORMAL',
+                 busy_timeout_ms=5000, mmap_size=0, cache_size=-2000, read_pool_size=4,
+                 metrics=None):
+        self.database_path = database_path
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.busy_timeout_ms = busy_timeout_ms
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.metrics = metrics
+        self.pid = os.getpid()
+
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._readers = queue.LifoQueue(maxsize=read_pool_size)
+        self._journal_mode_set = False
+
+    def connect(self, readonly=False):
+        """Open a new connection with the pool's pragmas applied."""
+        started = time.perf_counter()
+        factory = TimedConnection if self.metrics is not None else sqlite3.Connection
+        if readonly:
+            db = sqlite3.connect(f'file:{self.database_path}?mode=ro', uri=True,
+                                 check_same_thread=False, factory=factory)
+        else:
+            db = sqlite3.connect(self.database_path, check_same_thread=False, factory=factory)
+        if self.metrics is not None:
+            db.metrics = self.metrics
+        db.row_factory = sqlite3.Row
+
+        # journal_mode is stored in the database file, so it only needs
+        # setting once, and only a writable connection can change it
+        if not readonly and not self._journal_mode_set:
+            db.execute(f'PRAGMA journal_mode = {self.journal_mode}')
+            self._journal_mode_set = True
+        db.execute(f'PRAGMA synchronous = {self.synchronous}')
+        db.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        db.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        db.execute(f'PRAGMA cache_size = {int(self.cache_size)}')
+        # INSERT OR REPLACE only fires the links_fts delete trigger for the
+        # replaced row when recursive triggers are on
+        db.execute('PRAGMA recursive_triggers = ON')
+        if self.metrics is not None:
+            self.metrics.observe('sqlite_connect_duration_seconds', time.perf_counter() - started,
+                                 (('mode', 'ro' if readonly else 'rw'),))
+        return db
+
+    def acquire_writer(self):
+        if not self._writer_lock.acquire(blocking=False):
+            started = time.perf_counter()
+            acquired = self._writer_lock.acquire(timeout=self.busy_timeout_ms / 1000.0)
+            if self.metrics is not None:
+                self.metrics.inc('sqlite_writer_lock_waits_total')
+                self.metrics.observe('sqlite_writer_wait_seconds', time.perf_counter() - started)
+            if not acquired:
+                raise sqlite3.OperationalError('Timed out waiting for the writer connection')
+        if self._writer is None:
+            try:
+                self._writer = self.connect()
+            except Exception:
+                self._writer_lock.release()
+                raise
+        return self._writer
+
+    def release_writer(self, db):
+        if db.in_transaction:
+            db.rollback()
+        self._writer_lock.release()
+
+    def acquire_reader(self):
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            return self.connect(readonly=True)
+
+    def release_reader(self, db):
+        try:
+            self._readers.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+    def close(self):
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
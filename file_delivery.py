@@ -0,0 +1,85 @@
+import mimetypes
+import os
+
+from flask import current_app, request, send_file, abort, make_response
+from werkzeug.wsgi import wrap_file
+
+DELIVERY_MODES = ('direct', 'x-sendfile', 'x-accel-redirect')
+
+
+def _file_etag(st):
+    """Cheap validator for files we don't have a content digest for."""
+    return f'{st.st_size:x}-{st.st_mtime_ns:x}'
+
+
+def _offload(path, download_name, mode):
+    """
+    Hand the transfer to the front-end web server, which then handles Range
+    and conditional requests itself; the worker is free as soon as the
+    headers are sent. nginx serves X-Accel-Redirect URIs from an `internal`
+    location mapped to UPLOAD_FOLDER; Apache/lighttpd take an X-Sendfile path.
+    """
+    upload_folder = os.path.abspath(current_app.config['UPLOAD_FOLDER'])
+    path = os.path.abspath(path)
+    relative = os.path.relpath(path, upload_folder)
+    if relative.startswith(os.pardir):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    response = make_response('')
+    response.headers['Content-Type'] = mimetype
+    response.headers.set('Content-Disposition', 'inline', filename=download_name)
+
+    if mode == 'x-accel-redirect':
+        prefix = current_app.config['FILE_ACCEL_REDIRECT_PREFIX'].rstrip('/')
+        response.headers['X-Accel-Redirect'] = f'{prefix}/{relative}'
+    else:
+        response.headers['X-Sendfile'] = path
+    return response
+
+
+def send_upload(path, download_name, etag=None):
+    """
+    Serve an uploaded file for a file link according to FILE_DELIVERY_MODE:
+
+    - 'direct': the worker sends the file itself. Range requests get 206
+      responses and If-None-Match / If-Modified-Since get 304s. Gunicorn
+      sends whole files with os.sendfile() through wsgi.file_wrapper; for
+      ranges we seek the file ourselves so the slice is still zero-copy
+      instead of Werkzeug reading up to the start offset.
+    - 'x-sendfile': send an X-Sendfile header for Apache/lighttpd to serve.
+    - 'x-accel-redirect': send an X-Accel-Redirect header pointing at
+      FILE_ACCEL_REDIRECT_PREFIX for nginx to serve.
+    """
+    mode = current_app.config['FILE_DELIVERY_MODE']
+    if mode not in DELIVERY_MODES:
+        raise ValueError(f"Unknown FILE_DELIVERY_MODE: {mode!r}")
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        abort(404)
+
+    if mode != 'direct':
+        return _offload(path, download_name, mode)
+
+    response = send_file(
+        path,
+        download_name=download_name,
+        conditional=True,
+        etag=etag or _file_etag(st),
+        last_modified=st.st_mtime
+    )
+    environ = request.environ
+    if (response.status_code == 206
+            and 'wsgi.file_wrapper' in environ
+            and environ.get('SERVER_SOFTWARE', '').startswith('gunicorn')):
+        # Gunicorn's sendfile() starts at the file's current offset and stops
+        # after Content-Length bytes, which is exactly the requested range.
+        start = response.content_range.start
+        response.response.close()
+        f = open(path, 'rb')
+        f.seek(start)
+        response.response = wrap_file(environ, f)
+
+    return response
@@ -0,0 +1,62 @@
+# Gunicorn loads ./gunicorn.conf.py automatically; command-line flags in the
+# Dockerfile still take precedence over anything set here.
+
+import os
+import time
+
+
+def _init_schema():
+    """Create or upgrade the schema with a bare app, without importing app.py."""
+    from flask import Flask
+    from config import Config
+    from database import init_db, get_pool
+    app = Flask('app', root_path=os.path.dirname(os.path.abspath(__file__)))
+    app.config.from_object(Config)
+    app.config['METRICS_ENABLED'] = False
+    with app.app_context():
+        init_db()
+        # Connections must not be inherited by the forked workers
+        get_pool().close()
+
+
+def on_starting(server):
+    """
+    Forget metrics snapshots from the previous run's workers, and create or
+    upgrade the schema once here instead of in every worker.
+    """
+    from config import Config
+    from metrics import clear_snapshots
+    clear_snapshots(Config.METRICS_DIR)
+    if Config.INIT_DB_ON_STARTUP:
+        started = time.perf_counter()
+        _init_schema()
+        # Workers are forked from this process and share its Config
+        Config.INIT_DB_ON_STARTUP = False
+        server.log.info('Schema ready in %.0f ms', (time.perf_counter() - started) * 1000)
+
+
+def post_fork(server, worker):
+    worker.boot_started = time.perf_counter()
+
+
+def post_worker_init(worker):
+    """Report how long the worker took to import and set up the app."""
+    elapsed = time.perf_counter() - worker.boot_started
+    worker.log.info('Worker %s ready in %.0f ms', worker.pid, elapsed * 1000)
+    if worker.wsgi.config['METRICS_ENABLED']:
+        from metrics import get_metrics
+        get_metrics(worker.wsgi).observe('worker_startup_seconds', elapsed)
+
+
+def worker_exit(server, worker):
+    """
+    Write out any clicks and metrics still buffered in the exiting worker
+    and hand cluster sync over to another worker.
+    """
+    from cluster import stop_node_sync
+    from database import drain_click_queue
+    drain_click_queue(worker.wsgi)
+    stop_node_sync(worker.wsgi)
+    metrics = worker.wsgi.extensions.get('metrics')
+    if metrics is not None:
+        metrics.close()
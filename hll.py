@@ -0,0 +1,61 @@
+import math
+import zlib
+from hashlib import blake2b
+
+# 2**10 registers: ~3.3% standard error, at most 1 KiB per sketch before
+# compression and a few dozen bytes for links with few visitors
+DEFAULT_PRECISION = 10
+
+_INVERSE_POWERS = [2.0 ** -rank for rank in range(65)]
+
+
+class HyperLogLog:
+    """
+    HyperLogLog distinct-value sketch with one byte per register.
+
+    Sketches of the same precision merge by taking the per-register
+    maximum, so the sketch of a date range is the merge of its daily ones.
+    to_bytes() gives a zlib-compressed form for storing in a BLOB column.
+    """
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError(f'HyperLogLog precision must be 4-16, not {precision}')
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    def add(self, value):
+        x = int.from_bytes(blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+        width = 64 - self.precision
+        index = x >> width
+        rank = width - (x & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge HyperLogLog sketches of different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(_INVERSE_POWERS[r] for r in self.registers)
+        zeros = self.registers.count(0)
+        # Small cardinalities: linear counting is far more accurate
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes([self.precision]) + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data[0], bytearray(zlib.decompress(data[1:])))
@@ -0,0 +1,134 @@
+import base64
+import calendar
+import hashlib
+import hmac
+import time
+from datetime import datetime
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Outcomes of check_access()
+ALLOWED = 'allowed'
+NOT_FOUND = 'not_found'          # expired; served as a 404
+AUTH_REQUIRED = 'auth_required'  # missing or wrong Basic Auth; 401
+FORBIDDEN = 'forbidden'          # missing or wrong GUID; 403
+
+# expires_at is stored in the first format; the others are accepted on input
+# (the admin forms send datetime-local values like 2025-01-31T17:00)
+EXPIRY_FORMAT = '%Y-%m-%d %H:%M:%S'
+EXPIRY_INPUT_FORMATS = (EXPIRY_FORMAT, '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M',
+                        '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+# Authorization headers remembered per link after a successful check, so
+# repeat visitors skip the deliberately slow password hash
+VERIFIED_CACHE_SIZE = 16
+
+_HASH_METHODS = ('scrypt:', 'pbkdf2:')
+
+
+def normalize_expiry(value):
+    """Parse an expiry in any accepted format into EXPIRY_FORMAT; ValueError if invalid."""
+    for fmt in EXPIRY_INPUT_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).strftime(EXPIRY_FORMAT)
+        except ValueError:
+            pass
+    raise ValueError(f'Invalid expiry date: {value!r}')
+
+
+def is_password_hash(value):
+    return value.startswith(_HASH_METHODS) and value.count('$') == 2
+
+
+def hash_link_password(password):
+    """Hash a Basic Auth password for storage; values already hashed pass through."""
+    if password is None or is_password_hash(password):
+        return password
+    return generate_password_hash(password)
+
+
+class AccessPolicy:
+    """
+    A link's access rules, compiled once when the link is loaded and cached
+    with it: the expiry as a UTC timestamp, the Basic Auth user and
+    password hash, and the GUID.
+    """
+
+    __slots__ = ('expires', 'auth_user', 'auth_hash', 'guid', '_verified')
+
+    def __init__(self, expires=None, auth_user=None, auth_hash=None, guid=None):
+        self.expires = expires
+        self.auth_user = auth_user
+        self.auth_hash = auth_hash
+        self.guid = guid
+        self._verified = {}
+
+    @classmethod
+    def from_link(cls, link):
+        expires = None
+        if link['expires_at']:
+            try:
+                parsed = datetime.strptime(normalize_expiry(link['expires_at']), EXPIRY_FORMAT)
+                expires = calendar.timegm(parsed.timetuple())
+            except ValueError:
+                # Unparseable expiry: never expire, as before
+                pass
+        return cls(expires, link['basic_auth_user'], link['basic_auth_pass'], link['guid_required'])
+
+    def check(self, authorization=None, guid=None, now=None):
+        # 1) Check if expired
+        if self.expires is not None and (now or time.time()) > self.expires:
+            return NOT_FOUND
+
+        # 2) Check Basic Auth
+        if self.auth_user is not None and not self._check_auth(authorization):
+            return AUTH_REQUIRED
+
+        # 3) Check GUID
+        if self.guid and not (guid and hmac.compare_digest(guid.encode(), self.guid.encode())):
+            return FORBIDDEN
+
+        return ALLOWED
+
+    def _check_auth(self, authorization):
+        if not authorization or not authorization.startswith('Basic '):
+            return False
+        key = hashlib.sha256(authorization.encode('utf-8', 'surrogateescape')).digest()
+        if key in self._verified:
+            return True
+
+        # Decode base64
+        try:
+            decoded_str = base64.b64decode(authorization.split(' ', 1)[1].strip()).decode('utf-8')
+            incoming_user, incoming_pass = decoded_str.split(':', 1)
+        except Exception:
+            return False
+
+        # Compare with stored credentials
+        user_ok = hmac.compare_digest(incoming_user.encode(), self.auth_user.encode())
+        stored = self.auth_hash or ''
+        if is_password_hash(stored):
+            pass_ok = check_password_hash(stored, incoming_pass)
+        else:
+            # Not yet migrated to a hash
+            pass_ok = hmac.compare_digest(incoming_pass.encode(), stored.encode())
+        if not (user_ok and pass_ok and self.auth_hash is not None):
+            return False
+
+        if len(self._verified) >= VERIFIED_CACHE_SIZE:
+            self._verified.clear()
+        self._verified[key] = True
+        return True
+
+
+def check_access(link, authorization=None, guid=None):
+    """
+    Decide whether a request may follow `link`, a record from
+    database.resolve_link(). `authorization` is the raw Authorization
+    header and `guid` the `s` query parameter. Shared by the WSGI view and
+    the ASGI redirect path so both apply exactly the same rules.
+    """
+    policy = link.get('policy')
+    if policy is None:
+        policy = AccessPolicy.from_link(link)
+    return policy.check(authorization, guid)
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Returned by LinkCache.get() when nothing usable is cached. A cached
+# ``None`` means "we looked this up and the link does not exist".
+MISSING = object()
+
+
+class LinkCache:
+    """
+    Bounded LRU cache of resolved link records with a TTL.
+
+    One instance lives in each gunicorn worker. Entries are dicts with the
+    columns redirect_link needs, or None for negatively cached 404s (which
+    get their own, shorter TTL).
+    """
+
+    def __init__(self, max_size=10000, ttl=300, negative_ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Bumped by every clear(). A lookup notes it before reading the
+        # database and passes it to put(), so a row read before the links
+        # changed can't be cached after the cache was cleared for them.
+        self.epoch = 0
+        # Last link generation seen by this worker and when it was read;
+        # maintained by database.resolve_link().
+        self.generation = None
+        self.checked_at = 0.0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+
+            value, expires = entry
+            if time.monotonic() >= expires:
+                del self._entries[key]
+                self.misses += 1
+                return MISSING
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, epoch=None):
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self._lock:
+            if epoch is not None and epoch != self.epoch:
+                return  # Read before the last clear(); may be stale
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.epoch += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_ratio': (self.hits / lookups) if lookups else 0.0,
+            }
@@ -0,0 +1,113 @@
+"""
+Read-only, memory-mapped snapshot of the links table for redirect lookups.
+
+The snapshot is a single file that every worker maps into memory, so the
+operating system keeps one shared copy in its page cache. Layout (all
+integers little-endian):
+
+    header   magic, links generation, slot count, record count
+    slots    open-addressing hash table of record offsets (0 = empty),
+             indexed by crc32(short_link) with linear probing
+    records  key length, value length, UTF-8 short_link, JSON value
+
+A new snapshot is written to a temporary file and swapped in with
+os.replace(), so readers only ever see a complete file. Workers that
+still have the old file mapped keep reading it until they remap.
+"""
+import json
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = b'LNKSNAP1'
+HEADER = struct.Struct('<8sQII')
+SLOT = struct.Struct('<I')
+RECORD = struct.Struct('<HI')
+
+# Slots per link; keeps probe sequences short
+LOAD_FACTOR = 0.5
+
+
+def write_snapshot(path, generation, links):
+    """
+    Write (short_link, value) pairs to a new snapshot at `path`, where
+    value is any JSON-serializable object. Returns the number of links.
+    """
+    records = bytearray()
+    entries = []
+    for short_link, value in links:
+        key = short_link.encode('utf-8')
+        data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        entries.append((zlib.crc32(key), len(records)))
+        records += RECORD.pack(len(key), len(data)) + key + data
+
+    num_slots = 8
+    while num_slots * LOAD_FACTOR < len(entries):
+        num_slots *= 2
+    mask = num_slots - 1
+    base = HEADER.size + num_slots * SLOT.size
+    slots = [0] * num_slots
+    for key_hash, offset in entries:
+        index = key_hash & mask
+        while slots[index]:
+            index = (index + 1) & mask
+        slots[index] = base + offset
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, generation, num_slots, len(entries)))
+        f.write(struct.pack(f'<{num_slots}I', *slots))
+        f.write(records)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(entries)
+
+
+class LinkSnapshot:
+    """A mapped snapshot file. Lookups decode only the matching record."""
+
+    __slots__ = ('path', 'inode', 'generation', 'count', '_map', '_mask')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, num_slots, self.count = HEADER.unpack_from(self._map)
+        if magic != MAGIC or num_slots & (num_slots - 1):
+            raise ValueError(f'Not a link snapshot: {path}')
+        self.path = path
+        self.inode = (stat.st_dev, stat.st_ino)
+        self._mask = num_slots - 1
+
+    @classmethod
+    def open(cls, path):
+        """The snapshot at `path`, or None if it's missing or unreadable."""
+        try:
+            return cls(path)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def is_current(self):
+        """Whether `path` still names the file this snapshot has mapped."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_dev, stat.st_ino) == self.inode
+
+    def get(self, short_link):
+        """The stored value for short_link, or None if it isn't in the snapshot."""
+        key = short_link.encode('utf-8')
+        mm = self._map
+        index = zlib.crc32(key) & self._mask
+        while True:
+            offset = SLOT.unpack_from(mm, HEADER.size + index * SLOT.size)[0]
+            if not offset:
+                return None
+            key_len, value_len = RECORD.unpack_from(mm, offset)
+            start = offset + RECORD.size
+            if key_len == len(key) and mm[start:start + key_len] == key:
+                return json.loads(mm[start + key_len:start + key_len + value_len])
+            index = (index + 1) & self._mask
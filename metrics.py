@@ -0,0 +1,356 @@
+import atexit
+import bisect
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help). Only metrics listed here are exported.
+DEFINITIONS = {
+    'http_request_duration_seconds': (
+        'histogram', 'Time spent in the Flask view and its hooks, by endpoint, method and status.'),
+    'redirect_stage_duration_seconds': (
+        'histogram', 'Time spent in each stage of serving a short link.'),
+    'sqlite_query_duration_seconds': (
+        'histogram', 'Time to execute a statement (first step only for SELECTs), by statement type.'),
+    'sqlite_connect_duration_seconds': (
+        'histogram', 'Time to open a SQLite connection and apply its pragmas.'),
+    'sqlite_writer_wait_seconds': (
+        'histogram', 'Time spent waiting for the worker\'s writer connection when it was in use.'),
+    'sqlite_writer_lock_waits_total': (
+        'counter', 'Writer connection acquisitions that had to wait for another thread.'),
+    'sqlite_busy_errors_total': (
+        'counter', 'Statements that failed because the database was locked by another process.'),
+    'click_queue_depth': ('gauge', 'Clicks buffered in memory and not yet written.'),
+    'click_queue_clicks_total': (
+        'counter', 'Clicks handled by the click queue, by outcome.'),
+    'click_queue_flush_errors_total': ('counter', 'Failed click queue flushes.'),
+    'clicks_filtered_total': (
+        'counter', 'Clicks from bots, scanners and prefetches, by reason and whether tagged or dropped.'),
+    'cache_entries': ('gauge', 'Entries held in each per-worker cache.'),
+    'cache_hits_total': ('counter', 'Cache hits, by cache.'),
+    'cache_misses_total': ('counter', 'Cache misses, by cache.'),
+    'cache_evictions_total': ('counter', 'Entries evicted to stay under the size limit, by cache.'),
+    'cache_invalidations_total': ('counter', 'Full cache invalidations, by cache.'),
+    'worker_startup_seconds': ('histogram', 'Time from fork until a worker had loaded the app.'),
+    'link_snapshot_builds_total': ('counter', 'Link snapshots written by this worker.'),
+    'link_snapshot_links': ('gauge', 'Links in the snapshot this worker has mapped.'),
+    'cluster_sync_rows_total': ('counter', 'Links and clicks exchanged with the cluster hub, by direction.'),
+    'cluster_sync_errors_total': ('counter', 'Failed cluster sync passes.'),
+}
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, self.labels)
+
+
+class Metrics:
+    """
+    Per-worker counters, gauges and histograms.
+
+    Recording only updates in-process dicts. A daemon thread writes a
+    snapshot to `directory`/worker-<pid>.json every `flush_interval`
+    seconds, and collect() merges every worker's snapshot, so /metrics
+    covers all gunicorn workers whichever one serves the scrape. Gauges
+    from workers that have exited are dropped; their counters are kept.
+
+    Collectors registered with add_collector() run just before each
+    snapshot and set values that other objects already count themselves
+    (cache hits, click queue depth).
+    """
+
+    def __init__(self, directory=None, flush_interval=1.0, enabled=True):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self.pid = os.getpid()
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        if not self.enabled or not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='metrics-flusher', daemon=True)
+        self._thread.start()
+
+    def inc(self, name, value=1, labels=()):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        """Set an absolute value: a gauge, or a counter kept elsewhere."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if DEFINITIONS[name][0] == 'gauge':
+                self._gauges[(name, labels)] = value
+            else:
+                self._counters[(name, labels)] = value
+
+    def observe(self, name, seconds, labels=()):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # One slot per bucket plus +Inf, then sum and count
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 3)
+            histogram[index] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def timer(self, name, **labels):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, name, tuple(labels.items()))
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def snapshot(self):
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception:
+                logger.exception('Metrics collector failed')
+        with self._lock:
+            return {
+                'pid': self.pid,
+                'counters': [[n, list(l), v] for (n, l), v in self._counters.items()],
+                'gauges': [[n, list(l), v] for (n, l), v in self._gauges.items()],
+                'histograms': [[n, list(l), list(h)] for (n, l), h in self._histograms.items()],
+            }
+
+    def flush(self):
+        if not self.enabled or not self.directory or self.pid != os.getpid():
+            return
+        path = os.path.join(self.directory, f'worker-{self.pid}.json')
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception('Failed to write metrics snapshot')
+
+    def close(self):
+        self._stopping.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            self.flush()
+
+
+def collect(directory):
+    """Merge all worker snapshots in `directory` into Prometheus text format."""
+    counters, gauges, histograms = {}, {}, {}
+    for path in glob.glob(os.path.join(directory, 'worker-*.json')):
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        if _pid_alive(snapshot['pid']):
+            for name, labels, value in snapshot['gauges']:
+                key = (name, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = list(values)
+            else:
+                histograms[key] = [a + b for a, b in zip(merged, values)]
+
+    by_name = {}
+    for source in (counters, gauges, histograms):
+        for (name, labels), value in source.items():
+            by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(by_name):
+        if name not in DEFINITIONS:
+            continue
+        kind, help_text = DEFINITIONS[name]
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(by_name[name]):
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), value):
+                cumulative += count
+                le = bound if bound == '+Inf' else repr(float(bound))
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value[-2])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def clear_snapshots(directory):
+    """Remove snapshots left by a previous run; call before workers start."""
+    for path in glob.glob(os.path.join(directory, 'worker-*.json*')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@lru_cache(maxsize=1024)
+def _statement_type(sql):
+    words = sql.lstrip()[:16].split(None, 1)
+    return words[0].upper() if words else ''
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording statement timings and lock errors to connection.metrics."""
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def _timed(self, method, sql, parameters):
+        metrics = self.connection.metrics
+        started = time.perf_counter()
+        try:
+            return method(sql, parameters)
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e) or 'busy' in str(e):
+                metrics.inc('sqlite_busy_errors_total')
+            raise
+        finally:
+            metrics.observe('sqlite_query_duration_seconds', time.perf_counter() - started,
+                            (('statement', _statement_type(sql)),))
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection factory whose statements are timed; set .metrics after connecting."""
+
+    metrics = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            self.metrics.observe('sqlite_query_duration_seconds', time.perf_counter() - started,
+                                 (('statement', 'COMMIT'),))
+
+
+def _collect_extensions(app):
+    """Collector reporting the stats of this worker's caches, link snapshot and click queue."""
+    def collector(metrics):
+        extensions = app.extensions
+        queue = extensions.get('click_queue')
+        if queue is not None and queue.pid == metrics.pid:
+            stats = queue.stats()
+            metrics.set('click_queue_depth', stats['depth'])
+            for outcome in ('enqueued', 'written', 'dropped', 'spilled'):
+                metrics.set('click_queue_clicks_total', stats[outcome], (('outcome', outcome),))
+            metrics.set('click_queue_flush_errors_total', stats['flush_errors'])
+        for name in ('link_cache', 'count_cache'):
+            cache = extensions.get(name)
+            if cache is None:
+                continue
+            stats = cache.stats()
+            labels = (('cache', name),)
+            metrics.set('cache_entries', stats['size'], labels)
+            metrics.set('cache_hits_total', stats['hits'], labels)
+            metrics.set('cache_misses_total', stats['misses'], labels)
+            metrics.set('cache_evictions_total', stats['evictions'], labels)
+            metrics.set('cache_invalidations_total', stats['invalidations'], labels)
+        snapshot = extensions.get('link_snapshot')
+        if snapshot is not None:
+            metrics.set('link_snapshot_links', snapshot.count)
+    return collector
+
+
+def get_metrics(app=None):
+    """Return this worker's metrics, starting the snapshot writer on first use."""
+    # The collector outlives the request, so keep the real app, not the proxy
+    app = app or current_app._get_current_object()
+    metrics = app.extensions.get('metrics')
+    if metrics is None or metrics.pid != os.getpid():
+        config = app.config
+        metrics = Metrics(
+            directory=config['METRICS_DIR'],
+            flush_interval=config['METRICS_FLUSH_INTERVAL'],
+            enabled=config['METRICS_ENABLED']
+        )
+        metrics.add_collector(_collect_extensions(app))
+        metrics.start()
+        atexit.register(metrics.close)
+        app.extensions['metrics'] = metrics
+    return metrics
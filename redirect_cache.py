@@ -0,0 +1,58 @@
+"""
+Redirect responses for URL links: the link's own status code, and cache
+headers that let browsers and CDNs reuse a redirect for up to
+REDIRECT_CACHE_MAX_AGE seconds, never past the link's expiry. Links behind
+Basic Auth or a GUID are never cached.
+"""
+import time
+
+from werkzeug.http import http_date
+from werkzeug.utils import redirect
+
+REDIRECT_STATUSES = (301, 302, 307, 308)
+DEFAULT_REDIRECT_STATUS = 302
+
+
+def parse_redirect_status(value):
+    """A redirect status from a form or import; None for the default."""
+    if value is None or str(value).strip() == '':
+        return None
+    try:
+        status = int(str(value).strip())
+    except ValueError:
+        status = None
+    if status not in REDIRECT_STATUSES:
+        raise ValueError(f'Redirect status must be one of {", ".join(map(str, REDIRECT_STATUSES))}')
+    return status
+
+
+def is_cacheable(link):
+    policy = link['policy']
+    return policy.auth_user is None and not policy.guid
+
+
+def counted_by_beacon(link):
+    """
+    Whether, with CLICK_BEACON_ENABLED, the link's clicks are counted only
+    through the beacon: URL links whose redirects may be cached.
+    """
+    return not link['is_file'] and is_cacheable(link)
+
+
+def cache_headers(link, max_age, now=None):
+    """Cache-Control (and Expires) for serving this link's redirect."""
+    if not is_cacheable(link):
+        return {'Cache-Control': 'private, no-store'}
+    now = now or time.time()
+    expires = link['policy'].expires
+    if expires is not None:
+        max_age = min(max_age, int(expires - now))
+    if max_age <= 0:
+        return {'Cache-Control': 'no-cache'}
+    return {'Cache-Control': f'public, max-age={max_age}', 'Expires': http_date(now + max_age)}
+
+
+def redirect_response(link, max_age):
+    response = redirect(link['target_url'], code=link['redirect_status'] or DEFAULT_REDIRECT_STATUS)
+    response.headers.update(cache_headers(link, max_age))
+    return response
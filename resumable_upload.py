@@ -0,0 +1,252 @@
+"""
+Resumable uploads for file links, in the style of tus: the client creates
+an upload with the file's length and link fields, sends the file in
+chunks with PATCH requests at any offsets (several at once if it likes),
+and finalizes it to create the link.
+
+Chunks are written straight into a part file in the blob store's staging
+directory, so finalizing hashes the file once and renames it into place;
+nothing is buffered in memory or copied. The chunks received so far are
+recorded in upload_chunks, so any worker can take the next one and an
+interrupted upload resumes from what is missing.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+import secrets
+import time
+import uuid
+
+from werkzeug.utils import secure_filename
+
+from blob_store import CHUNK_SIZE, DIGEST_ALGORITHM, commit_blob, hash_file, staging_dir
+from database import begin_write, commit_link_changes
+from link_access import hash_link_password, normalize_expiry
+
+def _optional(values, field):
+    value = values.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def validate_link_fields(values, reserved=()):
+    """
+    Check the link fields of a new upload up front, the way upload_file
+    does, so that finalizing it can't fail on them after the transfer.
+    Returns the normalized fields or raises ValueError.
+    """
+    short_link = _optional(values, 'short_link')
+    if not short_link:
+        raise ValueError('Missing short_link')
+    if '/' in short_link:
+        raise ValueError('short_link cannot contain "/"')
+    if short_link in reserved:
+        raise ValueError(f'Cannot use reserved word "{short_link}"')
+    filename = secure_filename(_optional(values, 'filename') or '')
+    if not filename:
+        raise ValueError('Missing filename')
+
+    expires_at = _optional(values, 'expires_at')
+    if expires_at:
+        expires_at = normalize_expiry(expires_at)
+
+    return {
+        'short_link': short_link,
+        'filename': filename,
+        'description': _optional(values, 'description') or '',
+        'expires_at': expires_at,
+        'require_guid': values.get('require_guid') in (True, 'on', 'true', '1'),
+        'basic_auth_user': _optional(values, 'basic_auth_user'),
+        'basic_auth_pass': hash_link_password(_optional(values, 'basic_auth_pass')),
+    }
+
+
+def _part_path(upload_folder, upload_id):
+    return os.path.join(staging_dir(upload_folder), upload_id + '.part')
+
+
+def create_upload(db, upload_folder, length, link, created_by=None, checksum=None, ttl=86400):
+    """
+    Start an upload of `length` bytes for the link fields from
+    validate_link_fields(). `checksum` is the file's hex SHA-256, checked
+    when the upload is finalized. Returns the upload id.
+    """
+    upload_id = secrets.token_urlsafe(16)
+    # A sparse file of the final size, so chunks can land in any order
+    with open(_part_path(upload_folder, upload_id), 'xb') as f:
+        f.truncate(length)
+    with db:
+        db.execute('''
+            INSERT INTO upload_sessions (id, length, checksum, link, created_by, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (upload_id, length, checksum, json.dumps(link), created_by, time.time() + ttl))
+    return upload_id
+
+
+def get_upload(db, upload_id):
+    """The upload's row, or None if it doesn't exist or has expired."""
+    return db.execute('SELECT * FROM upload_sessions WHERE id = ? AND expires_at > ?',
+                      (upload_id, time.time())).fetchone()
+
+
+def received_ranges(db, upload_id):
+    """The byte ranges received so far, merged, as sorted (start, end) pairs."""
+    ranges = []
+    rows = db.execute('''
+        SELECT start_offset, end_offset FROM upload_chunks
+        WHERE upload_id = ? ORDER BY start_offset
+    ''', (upload_id,))
+    for start, end in rows:
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def missing_ranges(ranges, length):
+    """The gaps between received ranges, up to `length`."""
+    missing = []
+    position = 0
+    for start, end in ranges:
+        if start > position:
+            missing.append((position, start))
+        position = max(position, end)
+    if position < length:
+        missing.append((position, length))
+    return missing
+
+
+def upload_offset(ranges):
+    """How many bytes from the start of the file have been received."""
+    return ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+
+
+def parse_file_checksum(value):
+    """A whole-file checksum from a request: hex SHA-256, lower-cased, or None."""
+    if value is None:
+        return None
+    if not isinstance(value, str) or not re.fullmatch(r'[0-9a-fA-F]{64}', value):
+        raise ValueError('checksum must be a hex SHA-256 digest')
+    return value.lower()
+
+
+def parse_chunk_checksum(header):
+    """Digest from an 'Upload-Checksum: sha256 <base64>' header, or None."""
+    if not header:
+        return None
+    algorithm, _, value = header.strip().partition(' ')
+    if algorithm.lower() != DIGEST_ALGORITHM:
+        raise ValueError(f'Unsupported checksum algorithm: {algorithm!r}')
+    try:
+        return base64.b64decode(value.strip(), validate=True)
+    except ValueError:
+        raise ValueError('Invalid Upload-Checksum')
+
+
+def write_chunk(db, upload, offset, stream, length, upload_folder, checksum=None):
+    """
+    Write `length` bytes from `stream` at `offset` and record the range.
+    With a `checksum` (raw digest) the range is recorded only if the
+    bytes match it. Returns the received ranges. Raises FileNotFoundError
+    if the upload was finalized, deleted or purged meanwhile.
+    """
+    if offset < 0 or offset + length > upload['length']:
+        raise ValueError('Chunk is outside the upload')
+    hasher = hashlib.new(DIGEST_ALGORITHM) if checksum is not None else None
+    written = 0
+    with open(_part_path(upload_folder, upload['id']), 'r+b') as f:
+        f.seek(offset)
+        while written < length:
+            chunk = stream.read(min(CHUNK_SIZE, length - written))
+            if not chunk:
+                break
+            if hasher is not None:
+                hasher.update(chunk)
+            f.write(chunk)
+            written += len(chunk)
+    if written != length:
+        raise ValueError('Chunk is shorter than its Content-Length')
+    if hasher is not None and not hmac.compare_digest(hasher.digest(), checksum):
+        raise ValueError('Chunk checksum mismatch')
+    if length:
+        with db:
+            db.execute('''
+                INSERT OR IGNORE INTO upload_chunks (upload_id, start_offset, end_offset)
+                VALUES (?, ?, ?)
+            ''', (upload['id'], offset, offset + length))
+    return received_ranges(db, upload['id'])
+
+
+def _forget_upload(db, upload_id, upload_folder):
+    db.execute('DELETE FROM upload_chunks WHERE upload_id = ?', (upload_id,))
+    db.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+    try:
+        os.remove(_part_path(upload_folder, upload_id))
+    except FileNotFoundError:
+        pass
+
+
+def delete_upload(db, upload_id, upload_folder):
+    with db:
+        _forget_upload(db, upload_id, upload_folder)
+
+
+def finalize_upload(db, upload, upload_folder, checksum=None):
+    """
+    Check that the whole file has arrived and matches the checksum given
+    here or when the upload was created, then move it into the blob store
+    and create the link. A file that fails the checksum is discarded.
+    Returns the new link's short_link.
+    """
+    if missing_ranges(received_ranges(db, upload['id']), upload['length']):
+        raise ValueError('Upload is incomplete')
+    path = _part_path(upload_folder, upload['id'])
+    digest, size = hash_file(path)
+    expected = checksum or upload['checksum'] or ''
+    if expected and not hmac.compare_digest(expected, digest):
+        delete_upload(db, upload['id'], upload_folder)
+        raise ValueError('Checksum mismatch; the upload was discarded')
+
+    link = json.loads(upload['link'])
+    begin_write(db)
+    try:
+        if db.execute('SELECT 1 FROM upload_sessions WHERE id = ?', (upload['id'],)).fetchone() is None:
+            raise ValueError('Upload was already finalized')
+        file_path = commit_blob(db, path, digest, size, upload_folder)
+        db.execute('''
+            INSERT OR REPLACE INTO links
+            (short_link, target_url, is_file, filename, blob_digest, created_by, description,
+             expires_at, guid_required, basic_auth_user, basic_auth_pass)
+            VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            link['short_link'],
+            file_path,
+            link['filename'],
+            digest,
+            upload['created_by'],
+            link['description'],
+            link['expires_at'],
+            str(uuid.uuid4()) if link['require_guid'] else None,
+            link['basic_auth_user'],
+            link['basic_auth_pass'],
+        ))
+        _forget_upload(db, upload['id'], upload_folder)
+    except BaseException:
+        db.rollback()
+        raise
+    commit_link_changes(db)
+    return link['short_link']
+
+
+def purge_expired_uploads(db, upload_folder):
+    """Delete abandoned uploads and their part files. Returns how many."""
+    rows = db.execute('SELECT id FROM upload_sessions WHERE expires_at <= ?', (time.time(),)).fetchall()
+    for row in rows:
+        delete_upload(db, row['id'], upload_folder)
+    return len(rows)
@@ -7,12 +7,78 @@ CREATE TABLE IF NOT EXISTS clicks (
     user_agent TEXT,
     referer TEXT,
     clicked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    node_id TEXT,
+    is_bot INTEGER NOT NULL DEFAULT 0,
     FOREIGN KEY (short_link) REFERENCES links(short_link) ON DELETE CASCADE
 );
 
 CREATE INDEX IF NOT EXISTS idx_clicks_short_link ON clicks(short_link);
 CREATE INDEX IF NOT EXISTS idx_clicks_ip_address ON clicks(ip_address);
 CREATE INDEX IF NOT EXISTS clicks_short_link_IDX ON clicks (short_link);
+CREATE INDEX IF NOT EXISTS idx_clicks_short_link_clicked_at ON clicks (short_link, clicked_at);
+CREATE INDEX IF NOT EXISTS idx_clicks_clicked_at ON clicks (clicked_at);
+
+-- click retention: months of raw clicks moved out to compressed archive
+-- files by `flask prune-clicks`; their rollups stay. A month is logged
+-- once its file is written and marked completed once its rows are deleted.
+
+CREATE TABLE IF NOT EXISTS click_archive_log (
+    month TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    clicks INTEGER NOT NULL,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP
+);
+
+-- deleted or renamed links whose raw clicks and visitors are still to be
+-- purged; clicks up to deleted_at belong to the old link
+
+CREATE TABLE IF NOT EXISTS link_tombstones (
+    short_link TEXT NOT NULL,
+    deleted_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (short_link, deleted_at)
+) WITHOUT ROWID;
+
+-- Server-side sessions (SESSION_BACKEND=sqlite); data is Flask's tagged JSON
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at);
+
+-- resumable uploads (resumable_upload.py): the link to create once the
+-- file is complete, and the byte ranges received so far
+
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    id TEXT PRIMARY KEY,
+    length INTEGER NOT NULL,
+    checksum TEXT,
+    link TEXT NOT NULL,
+    created_by TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_expires_at ON upload_sessions (expires_at);
+
+CREATE TABLE IF NOT EXISTS upload_chunks (
+    upload_id TEXT NOT NULL,
+    start_offset INTEGER NOT NULL,
+    end_offset INTEGER NOT NULL,
+    PRIMARY KEY (upload_id, start_offset, end_offset)
+) WITHOUT ROWID;
+
+-- next number for server-generated short codes; workers reserve blocks
+-- of them (code_allocator.py)
+
+CREATE TABLE IF NOT EXISTS code_counter (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    next_id INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO code_counter (id, next_id) VALUES (1, 0);
 
 -- links definition
 
@@ -27,7 +93,179 @@ CREATE TABLE IF NOT EXISTS links (
     expires_at TEXT,
     guid_required TEXT,
     basic_auth_user TEXT,
-    basic_auth_pass TEXT
+    basic_auth_pass TEXT,
+    blob_digest TEXT,
+    redirect_status INTEGER  -- 301, 302, 307 or 308; NULL = 302
+);
+
+CREATE INDEX IF NOT EXISTS links_short_link_IDX ON links (short_link);
+CREATE INDEX IF NOT EXISTS idx_links_created_at ON links (created_at, short_link);
+CREATE INDEX IF NOT EXISTS idx_links_expires_at ON links (expires_at) WHERE expires_at IS NOT NULL;
+
+-- link cache generation counter, bumped on every change to links so each
+-- worker knows when to drop its in-process link cache
+
+CREATE TABLE IF NOT EXISTS link_generation (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    generation INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO link_generation (id, generation) VALUES (1, 0);
+
+-- click rollups, maintained by database.update_rollups() as clicks are
+-- written and rebuilt from `clicks` by `flask backfill-rollups`
+
+CREATE TABLE IF NOT EXISTS link_click_totals (
+    short_link TEXT PRIMARY KEY,
+    total_clicks INTEGER NOT NULL DEFAULT 0,
+    unique_visitors INTEGER NOT NULL DEFAULT 0,
+    approx_unique_visitors INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS link_click_daily (
+    short_link TEXT NOT NULL,
+    day TEXT NOT NULL,
+    clicks INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (short_link, day)
+) WITHOUT ROWID;
+
+-- Covering index for top links over a date range
+CREATE INDEX IF NOT EXISTS idx_link_click_daily_day ON link_click_daily (day, clicks);
+
+-- hour is 'YYYY-MM-DD HH' (UTC)
+CREATE TABLE IF NOT EXISTS link_click_hourly (
+    short_link TEXT NOT NULL,
+    hour TEXT NOT NULL,
+    clicks INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (short_link, hour)
+) WITHOUT ROWID;
+
+-- Daily clicks by referer host ('' for direct visits) and by browser
+-- family (click_stats.agent_family)
+CREATE TABLE IF NOT EXISTS link_click_referers (
+    short_link TEXT NOT NULL,
+    day TEXT NOT NULL,
+    referer_host TEXT NOT NULL,
+    clicks INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (short_link, day, referer_host)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS link_click_agents (
+    short_link TEXT NOT NULL,
+    day TEXT NOT NULL,
+    agent_family TEXT NOT NULL,
+    clicks INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (short_link, day, agent_family)
+) WITHOUT ROWID;
+
+-- HyperLogLog sketches (hll.py) of each link's visitor IP addresses, for
+-- all time (period 'all') and per day ('YYYY-MM-DD'); day sketches merge
+-- into estimates for any date range
+
+CREATE TABLE IF NOT EXISTS link_visitor_sketches (
+    short_link TEXT NOT NULL,
+    period TEXT NOT NULL,
+    sketch BLOB NOT NULL,
+    PRIMARY KEY (short_link, period)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS link_visitors (
+    short_link TEXT NOT NULL,
+    ip_address TEXT NOT NULL,
+    first_seen TIMESTAMP,
+    PRIMARY KEY (short_link, ip_address)
+) WITHOUT ROWID;
+
+-- full-text index for the admin search; trigram tokens give substring
+-- matching, and the triggers keep it in step with links
+
+CREATE VIRTUAL TABLE IF NOT EXISTS links_fts USING fts5(
+    short_link,
+    target_url,
+    filename,
+    description,
+    content='links',
+    content_rowid='rowid',
+    tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS links_fts_ai AFTER INSERT ON links BEGIN
+    INSERT INTO links_fts (rowid, short_link, target_url, filename, description)
+    VALUES (new.rowid, new.short_link, new.target_url, new.filename, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS links_fts_ad AFTER DELETE ON links BEGIN
+    INSERT INTO links_fts (links_fts, rowid, short_link, target_url, filename, description)
+    VALUES ('delete', old.rowid, old.short_link, old.target_url, old.filename, old.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS links_fts_au AFTER UPDATE ON links BEGIN
+    INSERT INTO links_fts (links_fts, rowid, short_link, target_url, filename, description)
+    VALUES ('delete', old.rowid, old.short_link, old.target_url, old.filename, old.description);
+    INSERT INTO links_fts (rowid, short_link, target_url, filename, description)
+    VALUES (new.rowid, new.short_link, new.target_url, new.filename, new.description);
+END;
+
+-- content-addressed upload storage; links.blob_digest points here and the
+-- triggers keep refcount equal to the number of links using each blob
+
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs (refcount) WHERE refcount <= 0;
+
+CREATE TRIGGER IF NOT EXISTS blobs_ref_ai AFTER INSERT ON links
+WHEN new.blob_digest IS NOT NULL BEGIN
+    UPDATE blobs SET refcount = refcount + 1 WHERE digest = new.blob_digest;
+END;
+
+CREATE TRIGGER IF NOT EXISTS blobs_ref_ad AFTER DELETE ON links
+WHEN old.blob_digest IS NOT NULL BEGIN
+    UPDATE blobs SET refcount = refcount - 1 WHERE digest = old.blob_digest;
+END;
+
+CREATE TRIGGER IF NOT EXISTS blobs_ref_au AFTER UPDATE OF blob_digest ON links
+WHEN old.blob_digest IS NOT new.blob_digest BEGIN
+    UPDATE blobs SET refcount = refcount - 1 WHERE digest = old.blob_digest;
+    UPDATE blobs SET refcount = refcount + 1 WHERE digest = new.blob_digest;
+END;
+
+-- multi-node sync (cluster.py): this node's id and its positions in the
+-- hub's feeds, plus the links changed locally since the last push. The
+-- triggers only queue changes once the node has joined a cluster.
+
+CREATE TABLE IF NOT EXISTS node_sync (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    node_id TEXT,
+    links_pulled INTEGER NOT NULL DEFAULT 0,
+    clicks_pushed INTEGER NOT NULL DEFAULT 0,
+    clicks_pulled INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT OR IGNORE INTO node_sync (id) VALUES (1);
+
+CREATE TABLE IF NOT EXISTS link_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    short_link TEXT NOT NULL
 );
 
-CREATE INDEX IF NOT EXISTS links_short_link_IDX ON links (short_link);
\ No newline at end of file
+CREATE TRIGGER IF NOT EXISTS link_outbox_ai AFTER INSERT ON links
+WHEN (SELECT node_id FROM node_sync) IS NOT NULL BEGIN
+    INSERT INTO link_outbox (short_link) VALUES (new.short_link);
+END;
+
+CREATE TRIGGER IF NOT EXISTS link_outbox_ad AFTER DELETE ON links
+WHEN (SELECT node_id FROM node_sync) IS NOT NULL BEGIN
+    INSERT INTO link_outbox (short_link) VALUES (old.short_link);
+END;
+
+CREATE TRIGGER IF NOT EXISTS link_outbox_au AFTER UPDATE ON links
+WHEN (SELECT node_id FROM node_sync) IS NOT NULL BEGIN
+    INSERT INTO link_outbox (short_link) VALUES (old.short_link);
+    INSERT INTO link_outbox (short_link) SELECT new.short_link WHERE new.short_link <> old.short_link;
+END;
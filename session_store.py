@@ -0,0 +1,180 @@
+"""
+Server-side sessions stored in the app's SQLite database.
+
+Flask opens the session for every request, including short-link
+redirects. Here opening a session only notes the id from the cookie: the
+row is read the first time the view touches the session and written back
+only when it changed (or is half-way to expiring), so requests that never
+use the session never reach the database.
+"""
+import secrets
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+
+SESSION_BACKENDS = ('sqlite', 'cookie', 'filesystem')
+
+_serializer = TaggedJSONSerializer()
+
+
+class SqliteSession(SessionMixin):
+    """Session data loaded from the sessions table on first access."""
+
+    def __init__(self, sid=None, loader=None):
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        self.expires_at = None
+        self._loader = loader
+        self._data = {} if sid is None else None
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def _load(self):
+        self.accessed = True
+        if self._data is None:
+            row = self._loader(self.sid)
+            if row is None:
+                # Unknown or expired: start afresh under a new id
+                self.sid = None
+                self.new = True
+                self._data = {}
+            else:
+                self._data, self.expires_at = row
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def clear(self):
+        if self._load():
+            self._data.clear()
+            self.modified = True
+
+
+class SqliteSessionInterface(SessionInterface):
+    """
+    Keeps session data in the `sessions` table, keyed by a random id sent
+    in the session cookie. Expired rows are removed by
+    purge_expired_sessions(), which saves also run about once every
+    `cleanup_interval` seconds per worker.
+    """
+
+    def __init__(self, get_db, get_read_db, cleanup_interval=3600):
+        self.get_db = get_db
+        self.get_read_db = get_read_db
+        self.cleanup_interval = cleanup_interval
+        self._cleaned_at = time.monotonic()
+        self._cleanup_lock = threading.Lock()
+
+    def _load(self, sid):
+        row = self.get_read_db().execute(
+            'SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?',
+            (sid, time.time())).fetchone()
+        if row is None:
+            return None
+        return _serializer.loads(row['data']), row['expires_at']
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        return SqliteSession(sid or None, self._load)
+
+    def save_session(self, app, session, response):
+        if not session.loaded:
+            return
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.modified and not session.new:
+                db = self.get_db()
+                db.execute('DELETE FROM sessions WHERE id = ?', (session.sid,))
+                db.commit()
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            return
+
+        now = time.time()
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        # Unchanged sessions are only written to push their expiry back
+        if session.new or session.modified or session.expires_at - now < lifetime / 2:
+            if session.new:
+                session.sid = secrets.token_urlsafe(32)
+            db = self.get_db()
+            db.execute('INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)',
+                       (session.sid, _serializer.dumps(dict(session)), now + lifetime))
+            db.commit()
+            self._maybe_cleanup(db)
+
+        if session.new or self.should_set_cookie(app, session):
+            response.set_cookie(name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+
+    def _maybe_cleanup(self, db):
+        if time.monotonic() - self._cleaned_at < self.cleanup_interval:
+            return
+        if not self._cleanup_lock.acquire(blocking=False):
+            return
+        try:
+            self._cleaned_at = time.monotonic()
+            purge_expired_sessions(db)
+        finally:
+            self._cleanup_lock.release()
+
+
+def purge_expired_sessions(db, batch_size=1000):
+    """Delete expired sessions in short batches. Returns the number removed."""
+    purged = 0
+    while True:
+        with db:
+            count = db.execute('''
+                DELETE FROM sessions WHERE id IN (
+                    SELECT id FROM sessions WHERE expires_at <= ? LIMIT ?
+                )
+            ''', (time.time(), batch_size)).rowcount
+        purged += count
+        if count < batch_size:
+            return purged
+
+
+def init_sessions(app, get_db, get_read_db):
+    """Install the session interface selected by SESSION_BACKEND."""
+    backend = app.config['SESSION_BACKEND']
+    if backend == 'sqlite':
+        app.session_interface = SqliteSessionInterface(
+            get_db, get_read_db, app.config['SESSION_CLEANUP_INTERVAL'])
+    elif backend == 'filesystem':
+        from flask_session import Session
+        app.config['SESSION_TYPE'] = 'filesystem'
+        Session(app)
+    elif backend != 'cookie':
+        # 'cookie' is Flask's built-in signed cookie session
+        raise ValueError(f'Unknown SESSION_BACKEND {backend!r}; expected one of {SESSION_BACKENDS}')
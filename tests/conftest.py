@@ -0,0 +1,66 @@
+import os
+import sys
+import tempfile
+
+import pytest
+from flask import Flask
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py reads its configuration and creates its database when imported,
+# so point everything it writes at a scratch directory first
+_scratch = tempfile.mkdtemp(prefix='shortener-tests-')
+os.environ.update(
+    DATABASE_PATH=os.path.join(_scratch, 'shortener.db'),
+    UPLOAD_FOLDER=os.path.join(_scratch, 'uploads'),
+    CLICK_SPILL_DIR=os.path.join(_scratch, 'click_spill'),
+    CLICK_ARCHIVE_DIR=os.path.join(_scratch, 'click_archive'),
+    METRICS_DIR=os.path.join(_scratch, 'metrics'),
+    METRICS_ENABLED='false',
+    CLICK_QUEUE_ENABLED='false',
+    ENABLE_SSO='false',
+    CLUSTER_HUB_URL='',
+    NODE_ID='',
+)
+
+import database  # noqa: E402
+from config import Config  # noqa: E402
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """
+    Build a bare app on its own database under tmp_path, for testing the
+    database layer without app.py's routes. Keyword arguments override
+    config values; `name` keeps several apps (cluster nodes) apart.
+    """
+    def make(name='app', init=True, **config):
+        app = Flask('app', root_path=ROOT)
+        app.config.from_object(Config)
+        app.config.update(
+            DATABASE_PATH=str(tmp_path / f'{name}.db'),
+            LINK_SNAPSHOT_PATH=str(tmp_path / f'{name}.db.links'),
+            UPLOAD_FOLDER=str(tmp_path / 'uploads'),
+            LINK_CACHE_CHECK_INTERVAL=0,
+        )
+        app.config.update(config)
+        app.teardown_appcontext(database.close_db)
+        if init:
+            with app.app_context():
+                database.init_db()
+        return app
+    return make
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def client():
+    """Test client for the real app, on the scratch database."""
+    from app import app
+    app.config['TESTING'] = True
+    return app.test_client()
@@ -0,0 +1,87 @@
+import io
+import os
+
+import database
+from blob_store import collect_garbage, commit_blob, restore_garbage, stage_upload
+
+
+def upload(db, upload_folder, short_link, data):
+    """Store `data` as a file link, as the upload routes do. Returns its path."""
+    staged_path, digest, size = stage_upload(io.BytesIO(data), upload_folder)
+    database.begin_write(db)
+    path = commit_blob(db, staged_path, digest, size, upload_folder)
+    db.execute('''
+        INSERT OR REPLACE INTO links (short_link, target_url, is_file, filename, blob_digest)
+        VALUES (?, ?, 1, 'file.txt', ?)
+    ''', (short_link, path, digest))
+    database.commit_link_changes(db)
+    return path
+
+
+def delete_link(db, short_link):
+    database.begin_write(db)
+    db.execute('DELETE FROM links WHERE short_link = ?', (short_link,))
+    database.commit_link_changes(db)
+
+
+def refcounts(db):
+    return {row['digest']: row['refcount'] for row in db.execute('SELECT digest, refcount FROM blobs')}
+
+
+def test_same_content_is_stored_once(app):
+    with app.app_context():
+        db = database.get_db()
+        upload_folder = app.config['UPLOAD_FOLDER']
+        first = upload(db, upload_folder, 'one', b'same content')
+        second = upload(db, upload_folder, 'two', b'same content')
+        assert first == second
+        assert list(refcounts(db).values()) == [2]
+        assert os.path.basename(first) in os.listdir(os.path.dirname(first))
+
+
+def test_blob_is_removed_with_its_last_link(app):
+    with app.app_context():
+        db = database.get_db()
+        upload_folder = app.config['UPLOAD_FOLDER']
+        path = upload(db, upload_folder, 'one', b'same content')
+        upload(db, upload_folder, 'two', b'same content')
+
+        delete_link(db, 'one')
+        assert list(refcounts(db).values()) == [1]
+        assert os.path.exists(path)
+
+        delete_link(db, 'two')
+        assert refcounts(db) == {}
+        assert not os.path.exists(path)
+        # Nothing is left behind in the staging area or as an empty prefix
+        assert not os.path.exists(os.path.dirname(path))
+        assert os.listdir(os.path.join(upload_folder, 'blobs', 'tmp')) == []
+
+
+def test_replacing_a_file_moves_the_reference(app):
+    with app.app_context():
+        db = database.get_db()
+        upload_folder = app.config['UPLOAD_FOLDER']
+        old = upload(db, upload_folder, 'doc', b'first version')
+        new = upload(db, upload_folder, 'doc', b'second version')
+        assert list(refcounts(db).values()) == [1]
+        assert os.path.exists(new)
+        assert not os.path.exists(old)
+
+
+def test_failed_commit_restores_garbage(app):
+    with app.app_context():
+        db = database.get_db()
+        upload_folder = app.config['UPLOAD_FOLDER']
+        path = upload(db, upload_folder, 'one', b'content')
+
+        database.begin_write(db)
+        db.execute("DELETE FROM links WHERE short_link = 'one'")
+        garbage = collect_garbage(db)
+        assert garbage and not os.path.exists(path)
+        db.rollback()
+        restore_garbage(garbage)
+
+        assert os.path.exists(path)
+        assert list(refcounts(db).values()) == [1]
+
@@ -0,0 +1,58 @@
+import pytest
+
+from click_filter import AGENT, HEAD, PREFETCH, RATE, ClickFilter, RateTable, is_bot_agent
+
+BROWSER = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/120.0 Safari/537.36'
+
+
+@pytest.mark.parametrize('user_agent', [
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)',
+    'Mozilla/5.0 (compatible; AhrefsBot/7.0; +http://ahrefs.com/robot/)',
+    'Mozilla/5.0 (compatible; PetalBot;+https://webmaster.petalsearch.com/site/petalbot)',
+    'Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)',
+    'facebookexternalhit/1.1',
+    'curl/8.4.0',
+    'python-requests/2.31.0',
+    'Mozilla/5.0 HeadlessChrome/120.0',
+])
+def test_bot_agents(user_agent):
+    assert is_bot_agent(user_agent)
+
+
+@pytest.mark.parametrize('user_agent', [
+    BROWSER,
+    'Mozilla/5.0 (Linux; Android 10; CUBOT_X30 Build/QP1A.190711.020) AppleWebKit/537.36 '
+    'Chrome/120.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (Linux; Android 9; CUBOT KING KONG) AppleWebKit/537.36 Chrome/100.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148 Safari/604.1',
+    None,
+    '',
+])
+def test_human_agents(user_agent):
+    assert not is_bot_agent(user_agent)
+
+
+def test_classify():
+    click_filter = ClickFilter()
+    assert click_filter.classify('10.0.0.1', BROWSER) is None
+    assert click_filter.classify('10.0.0.1', BROWSER, method='HEAD') == HEAD
+    assert click_filter.classify('10.0.0.1', BROWSER, {'sec-purpose': 'prefetch'}) == PREFETCH
+    assert click_filter.classify('10.0.0.1', 'curl/8.4.0') == AGENT
+
+
+def test_rate_limit_is_opt_in():
+    assert ClickFilter().rates is None
+    click_filter = ClickFilter(rate_limit=2)
+    assert [click_filter.classify('10.0.0.1', BROWSER) for _ in range(3)] == [None, None, RATE]
+    assert click_filter.classify('10.0.0.2', BROWSER) is None
+
+
+def test_rate_table_windows_and_size():
+    table = RateTable(limit=1, window=60, max_size=2)
+    assert not table.hit('a', now=100)
+    assert table.hit('a', now=110)
+    assert not table.hit('a', now=160)  # A new window
+    table.hit('b', now=160)
+    table.hit('c', now=160)
+    assert len(table) == 2
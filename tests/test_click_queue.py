@@ -0,0 +1,47 @@
+import json
+import os
+import sqlite3
+
+from click_queue import ClickQueue
+
+DEAD_PID = 2 ** 22 + 1  # Above Linux's pid_max, so never running
+
+
+def make_queue(spill_dir, written):
+    return ClickQueue(lambda: sqlite3.connect(':memory:'),
+                      lambda db, rows: written.extend(rows),
+                      overflow='spill', spill_dir=str(spill_dir))
+
+
+def write_spill(path, rows):
+    with open(path, 'w') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+
+
+def test_loads_spill_files_of_dead_workers(tmp_path):
+    write_spill(tmp_path / f'clicks-{DEAD_PID}.jsonl', [['a', '10.0.0.1']])
+    written = []
+    make_queue(tmp_path, written)._load_spilled(orphans=True)
+    assert written == [('a', '10.0.0.1')]
+    assert os.listdir(tmp_path) == []
+
+
+def test_recovers_files_claimed_by_a_worker_that_died(tmp_path):
+    write_spill(tmp_path / f'clicks-{DEAD_PID}.jsonl.{DEAD_PID + 1}.loading', [['a', '10.0.0.1']])
+    # A claim under our own pid is left over from an earlier process
+    write_spill(tmp_path / f'clicks-{DEAD_PID + 2}.jsonl.{os.getpid()}.loading', [['b', '10.0.0.2']])
+    written = []
+    make_queue(tmp_path, written)._load_spilled(orphans=True)
+    assert sorted(written) == [('a', '10.0.0.1'), ('b', '10.0.0.2')]
+    assert os.listdir(tmp_path) == []
+
+
+def test_leaves_files_of_live_workers(tmp_path):
+    parent = os.getppid()
+    write_spill(tmp_path / f'clicks-{parent}.jsonl', [['a', '10.0.0.1']])
+    write_spill(tmp_path / f'clicks-{DEAD_PID}.jsonl.{parent}.loading', [['b', '10.0.0.2']])
+    written = []
+    make_queue(tmp_path, written)._load_spilled(orphans=True)
+    assert written == []
+    assert len(os.listdir(tmp_path)) == 2
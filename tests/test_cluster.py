@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+import cluster
+import database
+from test_blob_store import delete_link, refcounts, upload
+
+
+@pytest.fixture
+def hub(tmp_path):
+    hub = cluster.open_hub(f'sqlite:///{tmp_path / "hub.db"}')
+    yield hub
+    hub.close()
+
+
+@pytest.fixture
+def nodes(make_app):
+    return make_app('a'), make_app('b')
+
+
+def sync(app, hub, node_id):
+    with app.app_context():
+        return cluster.sync_once(database.get_db(), hub, node_id)
+
+
+def test_links_and_deletions_reach_the_other_node(nodes, hub):
+    a, b = nodes
+    with a.app_context():
+        db = database.get_db()
+        database.begin_write(db)
+        db.execute("INSERT INTO links (short_link, target_url) VALUES ('docs', 'https://example.com')")
+        database.commit_link_changes(db)
+    sync(a, hub, 'a')
+    assert sync(b, hub, 'b')['links_pulled'] == 1
+    with b.app_context():
+        assert database.resolve_link('docs')['target_url'] == 'https://example.com'
+
+    with a.app_context():
+        delete_link(database.get_db(), 'docs')
+    sync(a, hub, 'a')
+    sync(b, hub, 'b')
+    with b.app_context():
+        assert database.resolve_link('docs') is None
+
+
+def test_pulled_file_link_keeps_shared_blob_alive(nodes, hub):
+    a, b = nodes
+    upload_folder = a.config['UPLOAD_FOLDER']  # Shared by both nodes
+    with a.app_context():
+        path = upload(database.get_db(), upload_folder, 'from-a', b'same content')
+    sync(a, hub, 'a')
+    sync(b, hub, 'b')
+
+    with b.app_context():
+        db = database.get_db()
+        assert list(refcounts(db).values()) == [1]
+        # b uploads the same content itself, then deletes its own link
+        upload(db, upload_folder, 'from-b', b'same content')
+        assert list(refcounts(db).values()) == [2]
+        delete_link(db, 'from-b')
+        assert list(refcounts(db).values()) == [1]
+    assert os.path.exists(path)
+
+    with a.app_context():
+        delete_link(database.get_db(), 'from-a')
+    sync(a, hub, 'a')
+    sync(b, hub, 'b')
+    with b.app_context():
+        assert refcounts(database.get_db()) == {}
+    assert not os.path.exists(path)
+
+
+def test_clicks_are_merged_once(nodes, hub):
+    a, b = nodes
+    for app in nodes:
+        with app.app_context():
+            db = database.get_db()
+            database.begin_write(db)
+            db.execute("INSERT INTO links (short_link, target_url) VALUES ('docs', 'https://example.com')")
+            database.commit_link_changes(db)
+    for app, ip_address in ((a, '10.0.0.1'), (b, '10.0.0.2')):
+        with app.app_context():
+            db = database.get_db()
+            with db:
+                database.insert_clicks(db, [('docs', ip_address, 'Mozilla/5.0', None, '2024-01-01 10:00:00')])
+
+    for _ in range(2):
+        sync(a, hub, 'a')
+        sync(b, hub, 'b')
+    for app in nodes:
+        with app.app_context():
+            assert database.get_link_stats('docs')['total_clicks'] == 2
+
+
+def test_node_id_is_kept(app, hub):
+    with app.app_context():
+        db = database.get_db()
+        node_id = cluster.join_cluster(db)
+        assert node_id
+        assert cluster.join_cluster(db) == node_id
+        assert cluster.join_cluster(db, node_id) == node_id
+        with pytest.raises(RuntimeError):
+            cluster.join_cluster(db, 'renamed')
+    sync(app, hub, '')
+    with app.app_context():
+        assert database.get_db().execute('SELECT node_id FROM node_sync').fetchone()[0] == node_id
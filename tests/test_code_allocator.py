@@ -0,0 +1,66 @@
+import sqlite3
+import threading
+
+import pytest
+
+from code_allocator import ALPHABET, BASE, CodeAllocator, number_to_code, reserve_numbers
+
+
+@pytest.mark.parametrize('length', [1, 2])
+def test_codes_are_a_bijection(length):
+    codes = {number_to_code(number, length) for number in range(BASE ** length)}
+    assert len(codes) == BASE ** length
+    assert all(len(code) == length and set(code) <= set(ALPHABET) for code in codes)
+
+
+def test_consecutive_codes_look_unrelated():
+    codes = [number_to_code(number, 7) for number in range(5000)]
+    pairs = list(zip(codes, codes[1:]))
+    same_position = sum(x == y for a, b in pairs for x, y in zip(a, b))
+    # By chance one position in 62 matches; a prefix-preserving scramble
+    # would match far more often
+    assert same_position / (len(pairs) * 7) < 2 / BASE
+    assert sum(a[0] == b[0] for a, b in pairs) / len(pairs) < 2 / BASE
+
+
+def test_code_space_exhausted():
+    with pytest.raises(RuntimeError):
+        number_to_code(BASE ** 2, 2)
+
+
+def test_allocator_reserves_blocks():
+    reserved = []
+
+    def reserve(count):
+        start = sum(reserved)
+        reserved.append(count)
+        return start
+
+    allocator = CodeAllocator(reserve, block_size=10, length=5)
+    codes = allocator.allocate(3) + allocator.allocate(25) + allocator.allocate()
+    assert len(set(codes)) == 29
+    assert reserved == [10, 18, 10]
+    assert codes == [number_to_code(number, 5) for number in range(28)] + [number_to_code(28, 5)]
+
+
+def test_reserved_ranges_do_not_overlap(tmp_path):
+    path = str(tmp_path / 'codes.db')
+    db = sqlite3.connect(path)
+    db.executescript('''
+        CREATE TABLE code_counter (id INTEGER PRIMARY KEY, next_id INTEGER NOT NULL);
+        INSERT INTO code_counter VALUES (1, 0);
+    ''')
+    db.close()
+
+    starts = []
+
+    def worker():
+        for _ in range(20):
+            starts.append(reserve_numbers(lambda: sqlite3.connect(path, timeout=10), 100))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(starts) == list(range(0, 8000, 100))
@@ -0,0 +1,47 @@
+import database
+from link_cache import MISSING, LinkCache
+
+
+def add_link(db, short_link, target_url):
+    database.begin_write(db)
+    db.execute('INSERT OR REPLACE INTO links (short_link, target_url) VALUES (?, ?)',
+               (short_link, target_url))
+    database.commit_link_changes(db)
+
+
+def test_put_after_clear_is_dropped():
+    cache = LinkCache()
+    epoch = cache.epoch
+    cache.clear()
+    cache.put('a', {'target_url': 'https://old.example'}, epoch)
+    assert cache.get('a') is MISSING
+
+    cache.put('a', {'target_url': 'https://new.example'}, cache.epoch)
+    assert cache.get('a') == {'target_url': 'https://new.example'}
+
+
+def test_resolve_link_sees_changes(app):
+    with app.app_context():
+        db = database.get_db()
+        add_link(db, 'docs', 'https://old.example')
+        assert database.resolve_link('docs')['target_url'] == 'https://old.example'
+        add_link(db, 'docs', 'https://new.example')
+        assert database.resolve_link('docs')['target_url'] == 'https://new.example'
+
+
+def test_resolve_link_does_not_cache_row_read_during_invalidation(app, monkeypatch):
+    with app.app_context():
+        add_link(database.get_db(), 'docs', 'https://old.example')
+        cache = database.get_link_cache()
+        read_db = database.get_read_db()
+
+        class ClearingReader:
+            """A reader during whose query another thread commits a change."""
+            def execute(self, *args):
+                cache.clear()
+                return read_db.execute(*args)
+
+        monkeypatch.setattr(database, 'get_read_db', lambda: ClearingReader())
+        cache.checked_at = float('inf')  # Skip the generation check
+        assert database.resolve_link('docs')['target_url'] == 'https://old.example'
+        assert cache.get('docs') is MISSING
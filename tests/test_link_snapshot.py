@@ -0,0 +1,60 @@
+import database
+from link_snapshot import LinkSnapshot, write_snapshot
+
+
+def test_lookups(tmp_path):
+    path = str(tmp_path / 'links')
+    links = [(f'link-{i}', [f'https://example.com/{i}', i]) for i in range(1000)]
+    links.append(('ünïcode', ['https://example.com/u', None]))
+    assert write_snapshot(path, 7, links) == len(links)
+
+    snapshot = LinkSnapshot.open(path)
+    assert snapshot.generation == 7
+    assert snapshot.count == len(links)
+    for short_link, value in links:
+        assert snapshot.get(short_link) == value
+    assert snapshot.get('missing') is None
+    assert snapshot.get('link-') is None
+
+
+def test_empty_snapshot(tmp_path):
+    path = str(tmp_path / 'links')
+    write_snapshot(path, 0, [])
+    assert LinkSnapshot.open(path).get('anything') is None
+
+
+def test_open_rejects_other_files(tmp_path):
+    assert LinkSnapshot.open(str(tmp_path / 'missing')) is None
+    other = tmp_path / 'other'
+    other.write_bytes(b'not a snapshot at all, just some bytes')
+    assert LinkSnapshot.open(str(other)) is None
+
+
+def test_replaced_file_is_not_current(tmp_path):
+    path = str(tmp_path / 'links')
+    write_snapshot(path, 1, [('a', 1)])
+    snapshot = LinkSnapshot.open(path)
+    write_snapshot(path, 2, [('a', 2)])
+    assert not snapshot.is_current()
+    assert snapshot.get('a') == 1  # Still reads the file it mapped
+    assert LinkSnapshot.open(path).get('a') == 2
+
+
+def test_resolve_link_reads_the_current_snapshot(make_app):
+    app = make_app(LINK_SNAPSHOT_ENABLED=True)
+    with app.app_context():
+        db = database.get_db()
+        database.begin_write(db)
+        db.execute("INSERT INTO links (short_link, target_url) VALUES ('docs', 'https://old.example')")
+        database.commit_link_changes(db)
+
+        snapshot = app.extensions['link_snapshot']
+        assert snapshot.generation == database.get_link_generation(db)
+        assert snapshot.get('docs')[0] == 'https://old.example'
+        assert database.resolve_link('docs')['target_url'] == 'https://old.example'
+
+        database.begin_write(db)
+        db.execute("UPDATE links SET target_url = 'https://new.example' WHERE short_link = 'docs'")
+        database.commit_link_changes(db)
+        assert database.resolve_link('docs')['target_url'] == 'https://new.example'
+        assert database.resolve_link('missing') is None
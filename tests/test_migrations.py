@@ -0,0 +1,97 @@
+import sqlite3
+
+import database
+from link_access import is_password_hash
+
+# schema.sql as of the first release, before any migrations
+BASELINE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS clicks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    short_link TEXT NOT NULL,
+    ip_address TEXT NOT NULL,
+    user_agent TEXT,
+    referer TEXT,
+    clicked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (short_link) REFERENCES links(short_link) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_clicks_short_link ON clicks(short_link);
+CREATE INDEX IF NOT EXISTS idx_clicks_ip_address ON clicks(ip_address);
+CREATE INDEX IF NOT EXISTS clicks_short_link_IDX ON clicks (short_link);
+
+CREATE TABLE IF NOT EXISTS links (
+    short_link TEXT PRIMARY KEY,
+    target_url TEXT NOT NULL,
+    is_file INTEGER NOT NULL DEFAULT 0,
+    filename TEXT,
+    created_by TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    description TEXT,
+    expires_at TEXT,
+    guid_required TEXT,
+    basic_auth_user TEXT,
+    basic_auth_pass TEXT
+);
+
+CREATE INDEX IF NOT EXISTS links_short_link_IDX ON links (short_link);
+'''
+
+
+def make_baseline(path):
+    db = sqlite3.connect(path)
+    db.executescript(BASELINE_SCHEMA)
+    db.executemany('INSERT INTO links (short_link, target_url, description, basic_auth_user, basic_auth_pass) '
+                   'VALUES (?, ?, ?, ?, ?)', [
+                       ('docs', 'https://example.com/docs', 'Team docs', None, None),
+                       ('private', 'https://example.com/private', None, 'user', 'plain'),
+                   ])
+    db.executemany('INSERT INTO clicks (short_link, ip_address, user_agent, clicked_at) VALUES (?, ?, ?, ?)', [
+        ('docs', '10.0.0.1', 'Mozilla/5.0', '2024-01-01 10:00:00'),
+        ('docs', '10.0.0.1', 'Mozilla/5.0', '2024-01-02 10:00:00'),
+        ('docs', '10.0.0.2', 'Mozilla/5.0', '2024-01-02 11:00:00'),
+    ])
+    db.commit()
+    db.close()
+
+
+def test_upgrade_from_baseline(make_app, tmp_path):
+    make_baseline(str(tmp_path / 'app.db'))
+    app = make_app(UNIQUE_VISITOR_MODE='exact')
+
+    with app.app_context():
+        db = database.get_db()
+        assert db.execute('PRAGMA user_version').fetchone()[0] == database.SCHEMA_VERSION
+        links = {row['short_link']: row for row in db.execute('SELECT * FROM links')}
+        assert set(links) == {'docs', 'private'}
+        assert links['docs']['target_url'] == 'https://example.com/docs'
+        assert is_password_hash(links['private']['basic_auth_pass'])
+
+        # Rollups and the search index are backfilled from existing rows
+        stats = database.get_link_stats('docs')
+        assert stats['total_clicks'] == 3
+        assert stats['unique_visitors'] == 2
+        assert len(stats['recent_clicks']) == 3
+        match = database.build_search_match('team')
+        assert [row[0] for row in db.execute(
+            'SELECT short_link FROM links_fts WHERE links_fts MATCH ?', (match,))] == ['docs']
+
+        # New columns exist with their defaults
+        assert tuple(db.execute('SELECT is_bot, node_id FROM clicks LIMIT 1').fetchone()) == (0, None)
+        assert tuple(db.execute('SELECT blob_digest, redirect_status FROM links LIMIT 1').fetchone()) == (None, None)
+
+
+def test_init_db_is_idempotent(make_app, tmp_path):
+    make_baseline(str(tmp_path / 'app.db'))
+    app = make_app(UNIQUE_VISITOR_MODE='exact')
+    with app.app_context():
+        database.init_db()
+        db = database.get_db()
+        assert database.get_link_stats('docs')['total_clicks'] == 3
+        assert db.execute('SELECT COUNT(*) FROM links').fetchone()[0] == 2
+
+
+def test_fresh_database(app):
+    with app.app_context():
+        db = database.get_db()
+        assert db.execute('PRAGMA user_version').fetchone()[0] == database.SCHEMA_VERSION
+        assert db.execute('SELECT COUNT(*) FROM links').fetchone()[0] == 0
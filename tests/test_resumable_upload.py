@@ -0,0 +1,97 @@
+import base64
+import hashlib
+import uuid
+
+import pytest
+
+import database
+import resumable_upload
+
+DATA = b'0123456789' * 1000
+
+
+@pytest.fixture
+def short_link():
+    return f'upload-{uuid.uuid4().hex[:8]}'
+
+
+def create(client, short_link, data=DATA, **fields):
+    response = client.post('/admin/api/uploads', json={
+        'length': len(data), 'short_link': short_link, 'filename': 'data.txt', **fields})
+    assert response.status_code == 201, response.json
+    return response.json['id']
+
+
+def send(client, upload_id, offset, chunk, checksum=None):
+    headers = {'Upload-Offset': str(offset)}
+    if checksum is not None:
+        headers['Upload-Checksum'] = checksum
+    return client.patch(f'/admin/api/uploads/{upload_id}', data=chunk, headers=headers)
+
+
+def test_chunks_in_any_order(client, short_link):
+    upload_id = create(client, short_link, checksum=hashlib.sha256(DATA).hexdigest())
+    assert send(client, upload_id, 5000, DATA[5000:]).json['missing'] == [[0, 5000]]
+    status = client.get(f'/admin/api/uploads/{upload_id}').json
+    assert status['offset'] == 0 and status['missing'] == [[0, 5000]]
+    assert send(client, upload_id, 0, DATA[:5000]).json['offset'] == len(DATA)
+
+    response = client.post(f'/admin/api/uploads/{upload_id}/finalize')
+    assert response.status_code == 201
+    assert response.json['short_link'] == short_link
+    assert client.get(f'/{short_link}').data == DATA
+    assert client.get(f'/admin/api/uploads/{upload_id}').status_code == 404
+
+
+def test_incomplete_upload_is_not_finalized(client, short_link):
+    upload_id = create(client, short_link)
+    send(client, upload_id, 0, DATA[:100])
+    assert client.post(f'/admin/api/uploads/{upload_id}/finalize').status_code == 400
+    assert client.get(f'/admin/api/uploads/{upload_id}').status_code == 200
+
+
+def test_checksum_mismatch_discards_the_upload(client, short_link):
+    upload_id = create(client, short_link, checksum=hashlib.sha256(b'other').hexdigest())
+    send(client, upload_id, 0, DATA)
+    assert client.post(f'/admin/api/uploads/{upload_id}/finalize').status_code == 400
+    assert client.get(f'/admin/api/uploads/{upload_id}').status_code == 404
+    assert client.get(f'/{short_link}').status_code == 404
+
+
+def test_bad_chunk_checksum_is_not_recorded(client, short_link):
+    upload_id = create(client, short_link)
+    wrong = 'sha256 ' + base64.b64encode(hashlib.sha256(b'other').digest()).decode()
+    assert send(client, upload_id, 0, DATA, wrong).status_code == 400
+    assert client.get(f'/admin/api/uploads/{upload_id}').json['offset'] == 0
+
+
+@pytest.mark.parametrize('checksum', ['not-hex', 'ab' * 16, 42])
+def test_malformed_checksum_is_rejected(client, short_link, checksum):
+    response = client.post('/admin/api/uploads', json={
+        'length': 1, 'short_link': short_link, 'filename': 'data.txt', 'checksum': checksum})
+    assert response.status_code == 400
+
+
+def test_chunk_after_finalize(client, short_link):
+    upload_id = create(client, short_link)
+    send(client, upload_id, 0, DATA)
+    assert client.post(f'/admin/api/uploads/{upload_id}/finalize').status_code == 201
+    assert send(client, upload_id, 0, DATA[:10]).status_code == 404
+    assert client.post(f'/admin/api/uploads/{upload_id}/finalize').status_code == 404
+
+
+def test_finalize_race(client, short_link):
+    """A request that read the upload before another one finalized it."""
+    upload_id = create(client, short_link)
+    send(client, upload_id, 0, DATA)
+    app = client.application
+    with app.app_context():
+        db = database.get_db()
+        upload = resumable_upload.get_upload(db, upload_id)
+        assert resumable_upload.finalize_upload(db, upload, app.config['UPLOAD_FOLDER']) == short_link
+        with pytest.raises((FileNotFoundError, ValueError)):
+            resumable_upload.finalize_upload(db, upload, app.config['UPLOAD_FOLDER'])
+        blobs = db.execute('SELECT refcount FROM blobs WHERE digest = ?',
+                           (hashlib.sha256(DATA).hexdigest(),)).fetchone()
+        assert blobs['refcount'] >= 1
+    assert client.get(f'/{short_link}').data == DATA
@@ -0,0 +1,39 @@
+from flask import session
+
+import database
+from session_store import init_sessions
+
+
+def count_sessions(app):
+    with app.app_context():
+        return database.get_db().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+
+def test_admin_without_sso_stores_no_session(client):
+    before = count_sessions(client.application)
+    for _ in range(3):
+        response = client.application.test_client().get('/admin')
+        assert response.status_code == 200
+        assert 'Set-Cookie' not in response.headers
+    assert count_sessions(client.application) == before
+
+
+def test_session_round_trip(app):
+    init_sessions(app, database.get_db, database.get_read_db)
+
+    @app.route('/count')
+    def count():
+        session['count'] = session.get('count', 0) + 1
+        return str(session['count'])
+
+    @app.route('/peek')
+    def peek():
+        return str(session.get('count'))
+
+    client = app.test_client()
+    assert client.get('/peek').data == b'None'
+    assert count_sessions(app) == 0
+    assert client.get('/count').data == b'1'
+    assert client.get('/count').data == b'2'
+    assert count_sessions(app) == 1
+    assert app.test_client().get('/peek').data == b'None'
@@ -0,0 +1,13 @@
+from urllib.parse import urlparse
+
+
+def is_valid_url(url):
+    """Minimal check to ensure URL is http or https, and has a netloc."""
+    parsed = urlparse(url)
+    return parsed.scheme in ['http', 'https'] and parsed.netloc
+
+def normalize_url(url):
+    """If the URL doesn’t start with http:// or https://, prepend https://."""
+    if url and not (url.startswith('http://') or url.startswith('https://')):
+        return 'https://' + url
+    return url